@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+import argparse
+import os
+import random
+import shutil
+import struct
+import tempfile
+from decimal import Decimal
+
+from benchutils import BENCH_SEED, measure, write_results, compare_results
+
+from podcomm.crc import crc8, crc16
+from podcomm.journal import NonceReservation
+from podcomm.message import Message, MessageType
+from podcomm.nonce import Nonce
+from podcomm.packet import Packet
+from podcomm.pdmutils import getPulsesForHalfHours, getInsulinScheduleTableFromPulses, \
+    getPulseIntervalEntries, getStringBodyFromTable
+from podcomm.pod import Pod
+
+LOT = 44147
+TID = 1100256
+ADDRESS = 0x1f0e89f0
+NONCE_SEEK_DEPTH = 1000
+
+
+def random_bytes(rnd, length):
+    return bytes(rnd.getrandbits(8) for _ in range(length))
+
+
+def get_basal_schedule(rnd):
+    return [Decimal(rnd.randint(1, 60)) / Decimal(20) for _ in range(48)]
+
+
+def get_pod_message(rnd, body_length):
+    msg = Message(MessageType.POD, ADDRESS, sequence=5)
+    msg.addCommand(0x02, random_bytes(rnd, body_length))
+    return msg
+
+
+def get_cases(work_dir):
+    rnd = random.Random(BENCH_SEED)
+    cases = {}
+
+    packet_data = random_bytes(rnd, 31)
+    message_data = random_bytes(rnd, 120)
+    cases["crc8_31b"] = lambda: crc8(packet_data)
+    cases["crc16_120b"] = lambda: crc16(message_data)
+
+    nonce = Nonce(LOT, TID)
+    cases["nonce_get_next"] = lambda: nonce.getNext(True)
+
+    seeker = Nonce(LOT, TID)
+    for _ in range(NONCE_SEEK_DEPTH):
+        seeker.getNext(True)
+    seek_nonce = seeker.lastNonce
+    cases["nonce_seek_%d" % NONCE_SEEK_DEPTH] = lambda: Nonce(LOT, TID, seekNonce=seek_nonce)
+
+    reservation = NonceReservation(os.path.join(work_dir, "pod.json.nonce"), LOT, TID)
+    reserved_nonce = Nonce(LOT, TID)
+
+    def nonce_reserve_get_next():
+        # one in NONCE_RESERVATION_BLOCK calls writes the reservation
+        reservation.reserve(reserved_nonce)
+        return reserved_nonce.getNext(True)
+
+    cases["nonce_reserve_get_next"] = nonce_reserve_get_next
+
+    schedule = get_basal_schedule(rnd)
+    pulses = getPulsesForHalfHours(schedule)
+    cases["pdmutils_pulses_for_half_hours"] = lambda: getPulsesForHalfHours(schedule)
+    cases["pdmutils_insulin_schedule_table"] = lambda: getInsulinScheduleTableFromPulses(pulses)
+    cases["pdmutils_pulse_interval_entries"] = lambda: getPulseIntervalEntries(schedule)
+
+    ise_body = getStringBodyFromTable(getInsulinScheduleTableFromPulses(pulses))
+    command_body = struct.pack(">I", 0) + b"\x00" + random_bytes(rnd, 5) + ise_body
+    schedule_body = random_bytes(rnd, 40)
+
+    def add_command():
+        msg = Message(MessageType.PDM, ADDRESS, sequence=3)
+        msg.addCommand(0x1a, command_body)
+        msg.addCommand(0x13, schedule_body)
+        return msg
+
+    cases["message_add_command"] = add_command
+    pdm_message = add_command()
+    cases["message_get_packets"] = lambda: pdm_message.getPackets()
+
+    single = get_pod_message(rnd, 10).getPackets()
+    multi = get_pod_message(rnd, 90).getPackets()
+    single_data = single[0].data
+    multi_data = [p.data for p in multi]
+
+    cases["packet_from_data"] = lambda: Packet.from_data(single_data)
+
+    def message_from_packets():
+        m = Message.fromPacket(Packet.from_data(multi_data[0]))
+        for data in multi_data[1:]:
+            m.addConPacket(Packet.from_data(data))
+        return m
+
+    cases["message_from_packet_single"] = lambda: Message.fromPacket(Packet.from_data(single_data))
+    cases["message_from_packets_%d" % len(multi_data)] = message_from_packets
+
+    pod_path = os.path.join(work_dir, "pod.json")
+    pod = Pod()
+    pod.lot = LOT
+    pod.tid = TID
+    pod.address = ADDRESS
+    pod.basalSchedule = [float(x) for x in schedule]
+    pod.Save(pod_path)
+    cases["pod_save"] = lambda: pod.Save()
+    cases["pod_load"] = lambda: Pod.Load(pod_path)
+
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark omnipy protocol codec functions")
+    parser.add_argument("-o", "--output", type=str, default="bench_codec.json", help="Result file")
+    parser.add_argument("-c", "--compare", type=str, default=None, help="Previous result file to compare with")
+    parser.add_argument("-f", "--filter", type=str, default=None, help="Run only cases containing this text")
+    parser.add_argument("-t", "--min-time", type=float, default=0.2, help="Minimum seconds per case")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="omnipy-bench-")
+    try:
+        results = {}
+        for name, func in sorted(get_cases(work_dir).items()):
+            if args.filter is not None and args.filter not in name:
+                continue
+            results[name] = measure(func, min_time=args.min_time)
+            print("%-40s %12.2f us" % (name, results[name]["median_us"]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    write_results(args.output, "codec", results)
+    if args.compare is not None:
+        compare_results(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+import argparse
+import base64
+import os
+import shutil
+import sys
+import tempfile
+
+import simplejson as json
+
+import benchutils
+from bench_scenarios import LOT, TID, ADDRESS, create_pod
+from emulator import EmulatedRileyLink, PodEmulator, RfConditions
+
+from podcomm import memory
+from podcomm.definitions import *
+
+MB = 1024 * 1024
+DEFAULT_MAX_RSS_MB = 64
+DEFAULT_MAX_GROWTH_MB = 4
+
+REQUESTS = [
+    (REST_URL_STATUS, {"type": "0"}),
+    (REST_URL_SET_TEMP_BASAL, {"amount": "1.2", "hours": "0.5"}),
+    (REST_URL_CANCEL_TEMP_BASAL, {}),
+    (REST_URL_POD_LIST, {}),
+    (REST_URL_PDM_BUSY, {}),
+    (REST_URL_METRICS, {}),
+]
+
+
+class ApiClient:
+    def __init__(self, app, key):
+        from Crypto.Cipher import AES
+        self.aes = AES
+        self.client = app.test_client()
+        self.key = key
+
+    def get(self, url, args):
+        token = base64.b64decode(json.loads(self.client.get(REST_URL_TOKEN).data)["result"]["token"])
+        iv = os.urandom(16)
+        auth = self.aes.new(self.key, self.aes.MODE_CBC, iv).encrypt(token)
+        query = {"i": base64.b64encode(iv).decode("ascii"), "auth": base64.b64encode(auth).decode("ascii")}
+        query.update(args)
+        response = self.client.get(url, query_string=query)
+        if url == REST_URL_METRICS:
+            return response.status_code == 200
+        return json.loads(response.data)["success"]
+
+
+def start_server(work_dir, time_scale):
+    # restapi keeps its state under the working directory, so it is imported after switching to a scratch one
+    os.chdir(work_dir)
+    os.makedirs("data")
+    key = os.urandom(32)
+    with open(KEY_FILE, "wb") as stream:
+        stream.write(key)
+
+    import restapi
+    from podcomm.podstore import get_pod_path
+    from podcomm.scheduler import SharedRileyLink
+
+    create_pod(get_pod_path())
+    conditions = RfConditions()
+    rileylink = EmulatedRileyLink(PodEmulator(LOT, TID, ADDRESS, conditions), conditions, time_scale)
+    restapi.scheduler.rileylinks = [SharedRileyLink(rileylink)]
+    restapi.scheduler.assignments = {}
+    return ApiClient(restapi.app, key)
+
+
+def run_requests(client, count, samples, sample_interval):
+    failures = 0
+    for i in range(count):
+        url, args = REQUESTS[i % len(REQUESTS)]
+        if not client.get(url, args):
+            failures += 1
+        if samples is not None and i % sample_interval == 0:
+            samples.append(memory.get_rss())
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the memory use of the rest api under a steady request load")
+    parser.add_argument("-o", "--output", type=str, default="bench_memory.json", help="Result file")
+    parser.add_argument("-c", "--compare", type=str, default=None, help="Previous result file to compare with")
+    parser.add_argument("-w", "--warmup", type=int, default=200, help="Requests sent before measuring")
+    parser.add_argument("-n", "--requests", type=int, default=2000, help="Requests sent while measuring")
+    parser.add_argument("--max-rss", type=float, default=DEFAULT_MAX_RSS_MB,
+                        help="Fail if the resident set size ends above this many megabytes")
+    parser.add_argument("--max-growth", type=float, default=DEFAULT_MAX_GROWTH_MB,
+                        help="Fail if the resident set size grows more than this many megabytes while measuring")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="Multiplier for emulated radio and BLE delays, 0 disables them")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Trace allocations and print the largest allocation sites")
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        memory.start_tracing()
+
+    output = os.path.abspath(args.output)
+    compare = None if args.compare is None else os.path.abspath(args.compare)
+    work_dir = tempfile.mkdtemp(prefix="omnipy-bench-")
+    try:
+        rss_initial = memory.get_rss()
+        client = start_server(work_dir, args.time_scale)
+        rss_imported = memory.get_rss()
+        failures = run_requests(client, args.warmup, None, 1)
+        samples = [memory.get_rss()]
+        failures += run_requests(client, args.requests, samples, 50)
+        samples.append(memory.get_rss())
+        report = memory.report() if args.tracemalloc else None
+    finally:
+        os.chdir(benchutils.ROOT_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {"steady_state": {"requests": args.warmup + args.requests,
+                                "failures": failures,
+                                "rss_initial_mb": rss_initial / MB,
+                                "rss_imported_mb": rss_imported / MB,
+                                "rss_start_mb": samples[0] / MB,
+                                "rss_end_mb": samples[-1] / MB,
+                                "rss_peak_mb": max(samples) / MB,
+                                "rss_growth_mb": (samples[-1] - samples[0]) / MB}}
+    r = results["steady_state"]
+    print("requests=%d fail=%d rss initial=%.1fMB imported=%.1fMB start=%.1fMB end=%.1fMB peak=%.1fMB growth=%.2fMB"
+          % (r["requests"], r["failures"], r["rss_initial_mb"], r["rss_imported_mb"], r["rss_start_mb"],
+             r["rss_end_mb"], r["rss_peak_mb"], r["rss_growth_mb"]))
+    if report is not None:
+        print("traced current=%.1fMB peak=%.1fMB" % (report["traced_current"] / MB, report["traced_peak"] / MB))
+        for entry in report["top"]:
+            print("%10d B %7d  %s:%d" % (entry["size"], entry["count"], entry["file"], entry["line"]))
+
+    parameters = {"warmup": args.warmup, "requests": args.requests, "max_rss": args.max_rss,
+                  "max_growth": args.max_growth, "time_scale": args.time_scale, "tracemalloc": args.tracemalloc}
+    benchutils.write_results(output, "memory", results, parameters)
+    if compare is not None:
+        benchutils.compare_results(compare, results, "rss_end_mb")
+
+    errors = []
+    if r["failures"] > 0:
+        errors.append("%d requests failed" % r["failures"])
+    if r["rss_end_mb"] > args.max_rss:
+        errors.append("resident set size %.1fMB is above the %.1fMB ceiling" % (r["rss_end_mb"], args.max_rss))
+    if r["rss_growth_mb"] > args.max_growth:
+        errors.append("resident set size grew %.2fMB under steady load, more than %.2fMB"
+                      % (r["rss_growth_mb"], args.max_growth))
+    if len(errors) > 0:
+        print("FAILED: " + "; ".join(errors))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+import benchutils
+from emulator import EmulatedListener, EmulatedRileyLink, PodEmulator, RfConditions
+
+from podcomm import metrics
+from podcomm.definitions import PodProgress, getLogger
+from podcomm.exceptions import OmnipyError
+from podcomm.pdm import Pdm
+from podcomm.pod import Pod
+
+LOT = 44147
+TID = 1100256
+ADDRESS = 0x1f0e89f0
+DEFAULT_OPERATIONS = "status,bolus,tempbasal,tempbasal,canceltempbasal,ack,deactivate"
+
+
+def run_status(pdm):
+    pdm.pod.lastUpdated = None
+    pdm.updatePodStatus()
+
+
+def run_interrupted(pdm):
+    # the pod file is not saved afterwards, as if omnipy was stopped right after the command was sent
+    with pdm.session(save=False):
+        pdm.setTempBasal(Decimal("1.2"), Decimal("0.5"))
+    pdm.radio.disconnect()
+
+
+def run_bolus(pdm):
+    pdm.bolus(Decimal("0.1"))
+    pdm.pod.last_enacted_bolus_start = None
+    pdm.pod.last_enacted_bolus_amount = None
+    pdm.pod.Save()
+
+
+OPERATIONS = {
+    "status": run_status,
+    "bolus": run_bolus,
+    "tempbasal": lambda pdm: pdm.setTempBasal(Decimal("1.2"), Decimal("0.5")),
+    "canceltempbasal": lambda pdm: pdm.cancelTempBasal(),
+    "ack": lambda pdm: pdm.acknowledge_alerts(0x10),
+    "deactivate": lambda pdm: pdm.deactivate_pod(),
+    "interrupted": run_interrupted,
+}
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    index = max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def counter_value(counter):
+    return counter.values.get((), 0)
+
+
+def create_pod(path, tid=TID):
+    pod = Pod()
+    pod.lot = LOT
+    pod.tid = tid
+    pod.address = ADDRESS
+    pod.progress = PodProgress.Running
+    pod.Save(path)
+    return pod
+
+
+def run_iteration(work_dir, iteration, operations, conditions, time_scale, diversity, samples):
+    # every iteration is a new pod stored under the same path, like a pod change does
+    pod_path = os.path.join(work_dir, "pod.json")
+    tid = TID + iteration
+    create_pod(pod_path, tid)
+    emulated_pod = PodEmulator(LOT, tid, ADDRESS, conditions)
+    rileylink = EmulatedRileyLink(emulated_pod, conditions, time_scale)
+    listener = None
+    if diversity:
+        listener = EmulatedListener(rileylink, conditions, time_scale)
+
+    for name in operations:
+        pdm = Pdm(Pod.Load(pod_path), rileylink, listener)
+        exchanges = counter_value(metrics.RADIO_EXCHANGES)
+        retries = counter_value(metrics.RADIO_RETRIES)
+        timeouts = counter_value(metrics.RADIO_TIMEOUTS)
+        diversity_receptions = counter_value(metrics.RADIO_DIVERSITY_RECEPTIONS)
+        resyncs = counter_value(metrics.RADIO_RESYNCS)
+        nonce_resyncs = counter_value(metrics.PDM_NONCE_RESYNCS)
+        reservations = counter_value(metrics.PDM_NONCE_RESERVATIONS)
+        reservation_seconds = metrics.PDM_NONCE_RESERVATION_SECONDS.series.get((), [0, 0])[-2]
+        start = time.perf_counter()
+        error = None
+        try:
+            OPERATIONS[name](pdm)
+        except OmnipyError as oe:
+            getLogger().warning("Operation %s failed: %s" % (name, oe.error_message))
+            error = oe.error_message
+        sample = samples.setdefault(name, {"wall": [], "exchanges": [], "retries": [], "timeouts": 0,
+                                           "diversity": 0, "resyncs": 0, "nonce_resyncs": 0, "reservations": 0,
+                                           "reservation_seconds": 0, "failures": 0, "errors": {}})
+        sample["wall"].append(time.perf_counter() - start)
+        sample["exchanges"].append(counter_value(metrics.RADIO_EXCHANGES) - exchanges)
+        sample["retries"].append(counter_value(metrics.RADIO_RETRIES) - retries)
+        sample["timeouts"] += counter_value(metrics.RADIO_TIMEOUTS) - timeouts
+        sample["diversity"] += counter_value(metrics.RADIO_DIVERSITY_RECEPTIONS) - diversity_receptions
+        sample["resyncs"] += counter_value(metrics.RADIO_RESYNCS) - resyncs
+        sample["nonce_resyncs"] += counter_value(metrics.PDM_NONCE_RESYNCS) - nonce_resyncs
+        sample["reservations"] += counter_value(metrics.PDM_NONCE_RESERVATIONS) - reservations
+        sample["reservation_seconds"] += \
+            metrics.PDM_NONCE_RESERVATION_SECONDS.series.get((), [0, 0])[-2] - reservation_seconds
+        if error is not None:
+            # the remaining operations of the pod are skipped, they would run against a state it never reached
+            sample["failures"] += 1
+            sample["errors"][error] = sample["errors"].get(error, 0) + 1
+            break
+
+
+def summarize(samples):
+    results = {}
+    for name, sample in samples.items():
+        wall = [w * 1000 for w in sample["wall"]]
+        count = len(wall)
+        results[name] = {"count": count,
+                         "failures": sample["failures"],
+                         "errors": sample["errors"],
+                         "p50_ms": percentile(wall, 50),
+                         "p95_ms": percentile(wall, 95),
+                         "p99_ms": percentile(wall, 99),
+                         "max_ms": max(wall),
+                         "median_us": percentile(wall, 50) * 1000,
+                         "exchanges_per_op": sum(sample["exchanges"]) / float(count),
+                         "retries_per_op": sum(sample["retries"]) / float(count),
+                         "timeouts": sample["timeouts"],
+                         "diversity_receptions": sample["diversity"],
+                         "resyncs": sample["resyncs"],
+                         "nonce_resyncs": sample["nonce_resyncs"],
+                         "nonce_reservations": sample["reservations"],
+                         "nonce_reservation_ms": sample["reservation_seconds"] * 1000 / float(count)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pdm operations against an emulated pod")
+    parser.add_argument("-o", "--output", type=str, default="bench_scenarios.json", help="Result file")
+    parser.add_argument("-c", "--compare", type=str, default=None, help="Previous result file to compare with")
+    parser.add_argument("-n", "--iterations", type=int, default=10, help="Number of pod lifecycles to run")
+    parser.add_argument("--operations", type=str, default=DEFAULT_OPERATIONS,
+                        help="Comma separated operations run in order for each pod")
+    parser.add_argument("--loss", type=float, default=0.0, help="Probability of losing a packet")
+    parser.add_argument("--duplicate", type=float, default=0.0,
+                        help="Probability of receiving the previous response instead of the current one")
+    parser.add_argument("--out-of-sequence", type=float, default=0.0,
+                        help="Probability of the pod answering a message with an unexpected sequence")
+    parser.add_argument("--rssi", type=float, default=-70,
+                        help="Signal strength in dBm reported for packets received from the pod")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Multiplier for emulated radio and BLE delays, 0 disables them")
+    parser.add_argument("--diversity", action="store_true",
+                        help="Listen for pod replies with a second emulated RileyLink")
+    parser.add_argument("--seed", type=int, default=benchutils.BENCH_SEED, help="Random seed for RF conditions")
+    parser.add_argument("--allow-failures", action="store_true",
+                        help="Exit successfully even if operations failed, for runs under harsh RF conditions")
+    args = parser.parse_args()
+
+    operations = args.operations.split(",")
+    for name in operations:
+        if name not in OPERATIONS:
+            parser.error("Unknown operation: %s" % name)
+
+    conditions = RfConditions(args.loss, args.duplicate, args.out_of_sequence, args.rssi, args.seed)
+    samples = {}
+    output = os.path.abspath(args.output)
+    compare = None if args.compare is None else os.path.abspath(args.compare)
+    # the pdm lock and pod logs live under data/ of the working directory, so the run gets a scratch one
+    work_dir = tempfile.mkdtemp(prefix="omnipy-bench-")
+    try:
+        os.chdir(work_dir)
+        os.makedirs("data")
+        for iteration in range(args.iterations):
+            run_iteration(work_dir, iteration, operations, conditions, args.time_scale, args.diversity, samples)
+    finally:
+        os.chdir(benchutils.ROOT_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = summarize(samples)
+    for name in sorted(results, key=operations.index):
+        r = results[name]
+        print("%-16s n=%-4d fail=%-3d p50=%8.1fms p95=%8.1fms p99=%8.1fms max=%8.1fms exch=%5.2f retry=%5.2f "
+              "timeout=%d diversity=%d resync=%d nonce=%d reserve=%d/%.2fms"
+              % (name, r["count"], r["failures"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["max_ms"],
+                 r["exchanges_per_op"], r["retries_per_op"], r["timeouts"], r["diversity_receptions"],
+                 r["resyncs"], r["nonce_resyncs"], r["nonce_reservations"], r["nonce_reservation_ms"]))
+
+    parameters = {"iterations": args.iterations, "operations": args.operations, "loss": args.loss,
+                  "duplicate": args.duplicate, "out_of_sequence": args.out_of_sequence,
+                  "rssi": args.rssi, "time_scale": args.time_scale, "diversity": args.diversity, "seed": args.seed}
+    benchutils.write_results(output, "scenarios", results, parameters)
+    if compare is not None:
+        benchutils.compare_results(compare, results)
+
+    failed = [name for name in operations if name in results and results[name]["failures"] > 0]
+    for name in sorted(set(failed), key=operations.index):
+        for error, count in sorted(results[name]["errors"].items()):
+            print("FAILED %-16s %dx %s" % (name, count, error))
+    if len(failed) > 0 and not args.allow_failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
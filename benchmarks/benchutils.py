@@ -0,0 +1,70 @@
+import os
+import platform
+import subprocess
+import sys
+import time
+import simplejson as json
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+BENCH_SEED = 20190308
+
+
+def get_environment():
+    revision = None
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                                           stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except Exception:
+        pass
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "revision": revision,
+            "time": time.time()}
+
+
+def measure(func, min_time=0.2, repeat=5):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeat or number >= 1 << 20:
+            break
+        number *= 2
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    timings.sort()
+    return {"loops": number,
+            "repeat": repeat,
+            "min_us": timings[0] * 1e6,
+            "median_us": timings[len(timings) // 2] * 1e6,
+            "max_us": timings[-1] * 1e6}
+
+
+def write_results(path, suite, results, parameters=None):
+    report = {"suite": suite, "environment": get_environment(), "parameters": parameters, "results": results}
+    with open(path, "w") as stream:
+        json.dump(report, stream, indent=4, sort_keys=True)
+
+
+def compare_results(path, results, key="median_us"):
+    with open(path, "r") as stream:
+        previous = json.load(stream)["results"]
+    for name in sorted(results):
+        if name not in previous or key not in results[name]:
+            continue
+        old = previous[name][key]
+        new = results[name][key]
+        if old > 0:
+            print("%-40s %12.2f -> %12.2f  %+7.1f%%" % (name, old, new, (new - old) * 100 / old))
@@ -0,0 +1,315 @@
+import queue
+import random
+import struct
+import time
+
+import benchutils
+from podcomm.crc import crc8, crc16_table
+from podcomm.exceptions import ProtocolError
+from podcomm.message import Message, MessageType, MessageState
+from podcomm.nonce import Nonce
+from podcomm.packet import Packet
+from podcomm.definitions import PodProgress
+
+BLE_COMMAND_LATENCY = 0.015
+BLE_CONNECT_LATENCY = 1.0
+POD_RESPONSE_DELAY = 0.01
+POD_RETRANSMIT_INTERVAL = 0.25
+PULSE_LOG_RECENT_ENTRIES = 50
+PULSE_LOG_PREVIOUS_ENTRIES = 60
+RF_BITRATE = 40625
+
+
+def airtime(data, preamble_ms=0):
+    return len(data) * 16.0 / RF_BITRATE + preamble_ms / 1000.0
+
+
+class RfConditions:
+    def __init__(self, loss=0.0, duplicate=0.0, out_of_sequence=0.0, rssi=-70, seed=benchutils.BENCH_SEED):
+        self.loss = loss
+        self.duplicate = duplicate
+        self.out_of_sequence = out_of_sequence
+        self.rssi = rssi
+        self.random = random.Random(seed)
+
+    def lost(self):
+        return self.random.random() < self.loss
+
+    def duplicated(self):
+        return self.random.random() < self.duplicate
+
+    def desynced(self):
+        return self.random.random() < self.out_of_sequence
+
+    def rssi_byte(self):
+        # inverse of the cc111x conversion the rileylink reports
+        return int((self.rssi + 73) * 2) & 0xff
+
+
+class PodEmulator:
+    def __init__(self, lot, tid, address, conditions):
+        self.lot = lot
+        self.tid = tid
+        self.address = address
+        self.conditions = conditions
+        self.nonce = Nonce(lot, tid, seed=0)
+        self.expected_nonce = self.nonce.getNext(True)
+        self.progress = PodProgress.Running
+        self.delivery = 1
+        self.alerts = 0
+        self.pulses = 0
+        self.minutes = 600
+        self.expected_sequence = None
+        self.last_received_sequence = None
+        self.last_response = None
+        self.previous_response = None
+        self.request = None
+        self.response_packets = []
+        self.awaiting_final_ack = False
+
+    def receive(self, packet):
+        if packet.address != self.address:
+            return None
+
+        if packet.type == "ACK" and packet.address2 == 0:
+            self.awaiting_final_ack = False
+            self.last_received_sequence = packet.sequence
+            self.expected_sequence = (packet.sequence + 1) % 32
+            return None
+
+        if packet.sequence == self.last_received_sequence and self.last_response is not None:
+            return self.last_response
+
+        if self.expected_sequence is not None and packet.sequence != self.expected_sequence \
+                and packet.type != "PDM":
+            return None
+
+        self.last_received_sequence = packet.sequence
+        if packet.type == "PDM":
+            if self.conditions.desynced():
+                return self._desync(packet)
+            self.request = Message.fromPacket(packet)
+        elif packet.type == "CON" and self.request is not None:
+            self.request.addConPacket(packet)
+        elif packet.type == "ACK" and len(self.response_packets) > 0:
+            return self._respond(self.response_packets.pop(0), packet.sequence)
+        else:
+            return None
+
+        if self.request.state == MessageState.Incomplete:
+            return self._respond(Packet.Ack(self.address, False), packet.sequence)
+
+        response = self._handle_message(self.request)
+        self.request = None
+        self.response_packets = response.getPackets()
+        return self._respond(self.response_packets.pop(0), packet.sequence)
+
+    def retransmission(self):
+        if self.awaiting_final_ack:
+            return self.last_response
+        return None
+
+    def _respond(self, packet, received_sequence):
+        packet.setSequence((received_sequence + 1) % 32)
+        self.expected_sequence = (received_sequence + 2) % 32
+        self.previous_response = self.last_response
+        self.last_response = packet
+        self.awaiting_final_ack = packet.type != "ACK" and len(self.response_packets) == 0
+        return packet
+
+    def _desync(self, packet):
+        shift = self.conditions.random.randint(2, 6)
+        response = self._status_message(0).getPackets()[0]
+        response.setSequence((packet.sequence + shift) % 32)
+        self.expected_sequence = (packet.sequence + shift + 1) % 32
+        self.last_received_sequence = None
+        self.last_response = None
+        return response
+
+    def _handle_message(self, request):
+        sequence = (request.sequence + 1) % 16
+        contents = request.getContents()
+        nonce_checked = False
+        for ctype, content in contents:
+            if ctype in (0x1a, 0x1f, 0x11, 0x1c) and not nonce_checked:
+                nonce_checked = True
+                nonce = struct.unpack(">I", content[0:4])[0]
+                if nonce != self.expected_nonce:
+                    return self._bad_nonce(nonce, request.sequence, sequence)
+                self.expected_nonce = self.nonce.getNext(True)
+
+        for ctype, content in contents:
+            if ctype == 0x1a:
+                if content[4] == 0x02:
+                    self.delivery |= 0x04
+                elif content[4] == 0x01:
+                    self.delivery |= 0x02
+            elif ctype == 0x17:
+                self.pulses += struct.unpack(">H", content[1:3])[0] // 10
+            elif ctype == 0x1f:
+                if content[4] & 0x04:
+                    self.delivery &= ~0x04
+                if content[4] & 0x02:
+                    self.delivery &= ~0x02
+            elif ctype == 0x11:
+                self.alerts &= ~content[4]
+            elif ctype == 0x1c:
+                self.progress = PodProgress.Inactive
+                self.delivery = 0
+            elif ctype == 0x0e and content[0] in (0x03, 0x50, 0x51):
+                return self._pulse_log_message(sequence, content[0])
+
+        response = self._status_message(sequence)
+        self.delivery &= ~0x04
+        return response
+
+    def _bad_nonce(self, nonce, request_sequence, sequence):
+        seed = self.conditions.random.getrandbits(16)
+        w_sum = (nonce & 0xFFFF) + (crc16_table[request_sequence] & 0xFFFF) \
+            + (self.lot & 0xFFFF) + (self.tid & 0xFFFF)
+        sync_word = (w_sum & 0xFFFF) ^ seed
+        self.nonce = Nonce(self.lot, self.tid, seed=seed)
+        self.expected_nonce = self.nonce.getNext(True)
+        msg = Message(MessageType.POD, self.address, sequence=sequence)
+        msg.addCommand(0x06, bytes([0x14]) + struct.pack(">H", sync_word))
+        return msg
+
+    def _pulse_log_message(self, sequence, info_type):
+        last = self.pulses
+        if info_type == 0x50:
+            first = max(1, last - PULSE_LOG_RECENT_ENTRIES + 1)
+            header = struct.pack(">H", last)
+        elif info_type == 0x51:
+            last = max(0, last - PULSE_LOG_RECENT_ENTRIES)
+            first = max(1, last - PULSE_LOG_PREVIOUS_ENTRIES + 1)
+            header = struct.pack(">H", last - first + 1)
+        else:
+            first = max(1, last - PULSE_LOG_PREVIOUS_ENTRIES + 1)
+            header = struct.pack(">BHHBB", 0, 0, self.minutes, 4, PULSE_LOG_PREVIOUS_ENTRIES)
+        entries = b"".join(struct.pack(">I", (pulse & 0x3f) << 26 | 0x00010000 | (pulse * 7) & 0xff00)
+                           for pulse in range(first, last + 1))
+        msg = Message(MessageType.POD, self.address, sequence=sequence)
+        msg.addCommand(0x02, bytes([info_type]) + header + entries)
+        return msg
+
+    def _status_message(self, sequence):
+        status = struct.pack(">BII", (self.delivery << 4) | self.progress,
+                             (self.pulses << 15) | (sequence << 11),
+                             (self.alerts << 23) | (self.minutes << 10) | 0x3ff)
+        msg = Message(MessageType.POD, self.address, sequence=sequence)
+        body = b"\x1d" + status
+        msg.length = len(body)
+        msg.body = body + msg.calculateChecksum(body)
+        msg.state = MessageState.Complete
+        return msg
+
+
+class EmulatedRileyLink:
+    def __init__(self, pod, conditions, time_scale=1.0):
+        self.pod = pod
+        self.conditions = conditions
+        self.time_scale = time_scale
+        self.connected = False
+        self.connects = 0
+        self.counter = 0
+        self.address = "emulated"
+        self.listeners = []
+
+    def connect(self, force_initialize=False):
+        if not self.connected:
+            self._wait(BLE_CONNECT_LATENCY)
+            self.connected = True
+            self.connects += 1
+
+    def disconnect(self, ignore_errors=True):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    def receive(self, timeout):
+        return self.get_packet(timeout)
+
+    def get_packet(self, timeout=5.0):
+        self.connect()
+        self._wait(BLE_COMMAND_LATENCY)
+        retransmission = self.pod.retransmission()
+        if retransmission is not None and not self.conditions.lost():
+            self._wait(POD_RETRANSMIT_INTERVAL + airtime(retransmission.data))
+            return self._rl_data(retransmission)
+        self._wait(timeout)
+        return None
+
+    def send_packet(self, packet, repeat_count, delay_ms, preamble_extension_ms):
+        self.connect()
+        self._wait(BLE_COMMAND_LATENCY + airtime(packet, preamble_extension_ms))
+        if not self.conditions.lost():
+            self.pod.receive(self._parse(packet))
+        return b""
+
+    def send_and_receive_packet(self, packet, repeat_count, delay_ms, timeout_ms, retry_count, preamble_ext_ms):
+        self.connect()
+        elapsed = BLE_COMMAND_LATENCY
+        request = self._parse(packet)
+        for _ in range(retry_count + 1):
+            elapsed += airtime(packet, preamble_ext_ms)
+            self._broadcast(request)
+            response = None
+            if not self.conditions.lost():
+                response = self.pod.receive(request)
+            if response is not None:
+                self._broadcast(response)
+            if response is not None and not self.conditions.lost():
+                if self.conditions.duplicated() and self.pod.previous_response is not None:
+                    response = self.pod.previous_response
+                self._wait(elapsed + POD_RESPONSE_DELAY + airtime(response.data))
+                return self._rl_data(response)
+            elapsed += timeout_ms / 1000.0
+        self._wait(elapsed)
+        return None
+
+    def _broadcast(self, packet):
+        for listener in self.listeners:
+            listener.hear(packet)
+
+    def _rl_data(self, packet):
+        self.counter = (self.counter + 1) % 256
+        return bytes([self.conditions.rssi_byte(), self.counter]) + packet.data + bytes([crc8(packet.data)])
+
+    @staticmethod
+    def _parse(packet):
+        if crc8(packet[:-1]) != packet[-1]:
+            raise ProtocolError("Emulated radio received a packet with a bad crc")
+        return Packet.from_data(packet[:-1])
+
+    def _wait(self, seconds):
+        if self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+
+class EmulatedListener:
+    def __init__(self, transmitter, conditions, time_scale=1.0):
+        self.conditions = conditions
+        self.time_scale = time_scale
+        self.address = "emulated-listener"
+        self.heard = queue.Queue()
+        self.counter = 0
+        transmitter.listeners.append(self)
+
+    def hear(self, packet):
+        if not self.conditions.lost():
+            self.heard.put(packet)
+
+    def connect(self, force_initialize=False):
+        pass
+
+    def disconnect(self, ignore_errors=True):
+        pass
+
+    def get_packet(self, timeout=5.0):
+        try:
+            packet = self.heard.get(timeout=max(timeout * self.time_scale, 0.001))
+        except queue.Empty:
+            return None
+        self.counter = (self.counter + 1) % 256
+        return bytes([self.conditions.rssi_byte(), self.counter]) + packet.data + bytes([crc8(packet.data)])
@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+from podcomm.decoder import decode_files, ConversationSummary
+import simplejson as json
+import argparse
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild pdm and pod conversations from omnipy logs "
+                                                 "or capture files")
+    parser.add_argument("files", type=str, nargs="+", help="omnipy.log files or capture ring files")
+    parser.add_argument("-o", "--output-dir", type=str, default=None,
+                        help="Write decoded conversations of each file as json lines into this directory")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="Number of worker processes, 0 uses one per cpu")
+    args = parser.parse_args()
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    total = ConversationSummary()
+    for path, summary in decode_files(args.files, args.output_dir, args.processes or None):
+        total.merge(summary)
+        print("%s: %s" % (path, json.dumps(summary.as_dict(), sort_keys=True)))
+    if len(args.files) > 1:
+        print("total: %s" % json.dumps(total.as_dict(), sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
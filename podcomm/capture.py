@@ -0,0 +1,143 @@
+from .definitions import *
+from .exceptions import OmnipyError, ProtocolError
+from .linkquality import decode_rssi
+from .packet import Packet
+from podcomm import crc
+import binascii
+import mmap
+import os
+import struct
+import threading
+import time
+
+CAPTURE_MAGIC = b"OPCB"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct(">4sHHIQ")
+# slot: capture sequence, timestamp, rssi byte, rileylink counter, flags, data length
+CAPTURE_SLOT = struct.Struct(">QdBBBB")
+CAPTURE_SLOT_SIZE = CAPTURE_SLOT.size + CAPTURE_MAX_DATA
+
+FLAG_VALID = 0x01
+FLAG_TRANSMITTED = 0x02
+
+
+class CaptureBuffer:
+    def __init__(self, path=CAPTURE_FILE, slots=CAPTURE_SLOTS, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        size = CAPTURE_HEADER.size + slots * CAPTURE_SLOT_SIZE
+        if readonly:
+            with open(path, "rb") as stream:
+                self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                self.map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        magic, version, slot_size, self.slots, _ = CAPTURE_HEADER.unpack_from(self.map, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION or slot_size != CAPTURE_SLOT_SIZE:
+            if readonly:
+                raise OmnipyError("Not a capture buffer: %s" % path)
+            self.slots = slots
+            CAPTURE_HEADER.pack_into(self.map, 0, CAPTURE_MAGIC, CAPTURE_VERSION, CAPTURE_SLOT_SIZE, slots, 0)
+
+    def next_sequence(self):
+        return CAPTURE_HEADER.unpack_from(self.map, 0)[4]
+
+    def append(self, data, transmitted=False, timestamp=None):
+        if data is None or len(data) == 0:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        if transmitted:
+            rssi, counter, packet = 0, 0, data
+            flags = FLAG_TRANSMITTED
+        else:
+            rssi, counter, packet = data[0], data[1] if len(data) > 1 else 0, data[2:]
+            flags = 0
+        if len(packet) > 1 and crc.crc8(packet[:-1]) == packet[-1]:
+            flags |= FLAG_VALID
+        packet = packet[:CAPTURE_MAX_DATA]
+
+        with self.lock:
+            sequence = self.next_sequence()
+            offset = CAPTURE_HEADER.size + (sequence % self.slots) * CAPTURE_SLOT_SIZE
+            # readers skip a slot while its sequence does not match, so it is invalidated first
+            struct.pack_into(">Q", self.map, offset, 0xffffffffffffffff)
+            self.map[offset + CAPTURE_SLOT.size:offset + CAPTURE_SLOT.size + len(packet)] = packet
+            CAPTURE_SLOT.pack_into(self.map, offset, sequence, timestamp, rssi, counter, flags, len(packet))
+            struct.pack_into(">Q", self.map, CAPTURE_HEADER.size - 8, sequence + 1)
+
+    def read(self, since=0, limit=None):
+        end = self.next_sequence()
+        start = max(since, end - self.slots, 0)
+        if limit is not None:
+            end = min(end, start + limit)
+        records = []
+        for sequence in range(start, end):
+            offset = CAPTURE_HEADER.size + (sequence % self.slots) * CAPTURE_SLOT_SIZE
+            slot = CAPTURE_SLOT.unpack_from(self.map, offset)
+            data = bytes(self.map[offset + CAPTURE_SLOT.size:offset + CAPTURE_SLOT.size + slot[5]])
+            if slot[0] != sequence or struct.unpack_from(">Q", self.map, offset)[0] != sequence:
+                continue
+            records.append(decode_record(slot, data))
+        return records
+
+    def close(self):
+        self.map.close()
+
+
+def decode_record(slot, data):
+    sequence, timestamp, rssi, counter, flags, length = slot
+    transmitted = flags & FLAG_TRANSMITTED != 0
+    record = {"sequence": sequence,
+              "time": timestamp,
+              "rssi": None if transmitted else decode_rssi(rssi),
+              "counter": None if transmitted else counter,
+              "transmitted": transmitted,
+              "valid": flags & FLAG_VALID != 0,
+              "data": binascii.hexlify(data).decode("ascii"),
+              "address": None,
+              "type": None,
+              "packet_sequence": None}
+    if record["valid"]:
+        try:
+            p = Packet.from_data(data[:-1])
+            record["address"] = p.address
+            record["type"] = p.type
+            record["packet_sequence"] = p.sequence
+        except ProtocolError:
+            record["valid"] = False
+    return record
+
+
+class CaptureListener:
+    def __init__(self, rileylink, buffer):
+        self.rileylink = rileylink
+        self.buffer = buffer
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._listen, name="omnipy-capture", daemon=True)
+        self.logger = getLogger()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, wait=True):
+        self.stop_event.set()
+        if wait:
+            self.thread.join()
+
+    def _listen(self):
+        while not self.stop_event.is_set():
+            try:
+                if not self.rileylink.listen(CAPTURE_LISTEN_WINDOW):
+                    self.stop_event.wait(CAPTURE_LISTEN_WINDOW)
+            except OmnipyError as e:
+                self.logger.warning("Capture paused after radio error: %s" % e)
+                self.rileylink.disconnect()
+                self.stop_event.wait(CAPTURE_RETRY_DELAY)
@@ -0,0 +1,268 @@
+from .definitions import *
+from .exceptions import ProtocolError
+from .message import Message, MessageState, MessageType
+from .packet import Packet
+from .responses import decode_content, ErrorResponse
+from datetime import datetime
+from multiprocessing import Pool
+import simplejson as json
+import os
+import re
+import struct
+
+LOG_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) .*"
+                      r"(SENDING PACKET EXP RESPONSE|SENDING FINAL PACKET|RECEIVED PACKET): (Pkt .*)$")
+LOG_PACKET = re.compile(r"^Pkt (PDM|POD|CON|ACK) Addr: 0x([0-9a-fA-F]{8})(?: Addr2: 0x([0-9a-fA-F]{8}))?\s+"
+                        r"Seq: 0x([0-9a-fA-F]{2})(?: Body: b'([0-9a-f]*)')?")
+PACKET_TYPE_BITS = {"PDM": 5, "POD": 7, "ACK": 2, "CON": 4}
+
+CONTENT_NAMES = {0x01: "version", 0x02: "information", 0x03: "setup", 0x06: "error", 0x07: "assign address",
+                 0x0e: "status request", 0x11: "acknowledge alerts", 0x13: "basal schedule",
+                 0x16: "temp basal", 0x17: "bolus", 0x19: "configure alerts", 0x1a: "insulin schedule",
+                 0x1c: "deactivate", 0x1d: "status", 0x1f: "cancel delivery"}
+
+SUMMARY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60)
+
+
+def read_log(path):
+    with open(path, "r", errors="replace") as stream:
+        for line in stream:
+            m = LOG_LINE.match(line.rstrip("\n"))
+            if m is None:
+                continue
+            data = _packet_data_from_log(m.group(3))
+            if data is None:
+                continue
+            timestamp = datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S,%f").timestamp()
+            yield timestamp, m.group(2) != "RECEIVED PACKET", data, None
+
+
+def read_capture(path, chunk=DECODER_CAPTURE_CHUNK):
+    from .capture import CaptureBuffer
+    buffer = CaptureBuffer(path, readonly=True)
+    try:
+        end = buffer.next_sequence()
+        since = max(0, end - buffer.slots)
+        while since < end:
+            for record in buffer.read(since, chunk):
+                if record["valid"]:
+                    yield record["time"], record["transmitted"], bytes.fromhex(record["data"])[:-1], record["rssi"]
+            since += chunk
+    finally:
+        buffer.close()
+
+
+def read_packets(path):
+    with open(path, "rb") as stream:
+        is_capture = stream.read(4) == b"OPCB"
+    if is_capture:
+        return read_capture(path)
+    return read_log(path)
+
+
+def conversations(raw_packets):
+    conversation = None
+    for timestamp, transmitted, data, rssi in raw_packets:
+        try:
+            p = Packet.from_data(data)
+        except ProtocolError:
+            continue
+
+        if conversation is not None and (timestamp - conversation.last_time > DECODER_CONVERSATION_GAP
+                                         or p.address != conversation.address
+                                         or p.type == "PDM" and not conversation.is_repeat(p)):
+            yield conversation.as_dict()
+            conversation = None
+
+        if conversation is None:
+            if p.type != "PDM":
+                continue
+            conversation = Conversation(p.address, timestamp)
+
+        conversation.add(timestamp, transmitted, p, rssi)
+        if conversation.finished:
+            yield conversation.as_dict()
+            conversation = None
+
+    if conversation is not None:
+        yield conversation.as_dict()
+
+
+class Conversation:
+    def __init__(self, address, timestamp):
+        self.address = address
+        self.start_time = timestamp
+        self.last_time = timestamp
+        self.response_time = None
+        self.request = None
+        self.response = None
+        self.packets = 0
+        self.retries = 0
+        self.rssi = []
+        self.errors = []
+        self.finished = False
+        self.seen = set()
+
+    def is_repeat(self, p):
+        return (p.type, p.sequence, p.data) in self.seen
+
+    def add(self, timestamp, transmitted, p, rssi):
+        self.last_time = timestamp
+        key = (p.type, p.sequence, p.data)
+        if key in self.seen:
+            self.retries += 1
+            return
+        self.seen.add(key)
+        self.packets += 1
+        if rssi is not None and not transmitted:
+            self.rssi.append(rssi)
+
+        try:
+            if p.type == "PDM" and self.request is None:
+                self.request = Message.fromPacket(p)
+            elif p.type == "POD" and self.response is None:
+                self.response_time = timestamp
+                self._complete_request()
+                self.response = Message.fromPacket(p)
+            elif p.type == "CON":
+                message = self.request if self.response is None else self.response
+                if message is not None and message.state == MessageState.Incomplete:
+                    message.addConPacket(p)
+            elif p.type == "ACK" and p.address2 == 0:
+                self.finished = True
+        except ProtocolError as pe:
+            self.errors.append(pe.error_message)
+
+    def _complete_request(self):
+        # logged packets do not carry the message crc, it is added back when the message is short of it
+        if self.request is not None and self.request.state == MessageState.Incomplete \
+                and len(self.request.body) == self.request.length:
+            self.request.body += self.request.calculateChecksum(self.request.body)
+            self.request.state = MessageState.Complete
+
+    def as_dict(self):
+        self._complete_request()
+        return {"address": "%08x" % self.address,
+                "start": self.start_time,
+                "duration": self.last_time - self.start_time,
+                "response_delay": None if self.response_time is None else self.response_time - self.start_time,
+                "packets": self.packets,
+                "retries": self.retries,
+                "complete": self.response is not None and self.response.state == MessageState.Complete,
+                "rssi": None if len(self.rssi) == 0 else sum(self.rssi) / len(self.rssi),
+                "sequence": None if self.request is None else self.request.sequence,
+                "request": decode_contents(self.request),
+                "response": decode_contents(self.response),
+                "errors": self.errors}
+
+
+def decode_contents(message):
+    if message is None or message.state != MessageState.Complete:
+        return None
+    contents = []
+    for ctype, content in message.getContents():
+        decoded = {"type": "%02x" % ctype, "name": CONTENT_NAMES.get(ctype), "data": content.hex()}
+        if message.type == MessageType.POD:
+            try:
+                record = decode_content(ctype, content)
+            except ProtocolError as pe:
+                decoded["error"] = pe.error_message
+                record = None
+            if record is not None:
+                decoded["record"] = record.as_dict()
+                if isinstance(record, ErrorResponse) and record.is_bad_nonce():
+                    decoded["name"] = "bad nonce"
+        contents.append(decoded)
+    return contents
+
+
+class ConversationSummary:
+    def __init__(self):
+        self.conversations = 0
+        self.complete = 0
+        self.retries = 0
+        self.errors = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+        self.buckets = [0] * (len(SUMMARY_BUCKETS) + 1)
+
+    def add(self, conversation):
+        self.conversations += 1
+        self.complete += 1 if conversation["complete"] else 0
+        self.retries += conversation["retries"]
+        self.errors += len(conversation["errors"])
+        duration = conversation["duration"]
+        self.duration_total += duration
+        self.duration_max = max(self.duration_max, duration)
+        for i, bound in enumerate(SUMMARY_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def merge(self, other):
+        self.conversations += other.conversations
+        self.complete += other.complete
+        self.retries += other.retries
+        self.errors += other.errors
+        self.duration_total += other.duration_total
+        self.duration_max = max(self.duration_max, other.duration_max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def as_dict(self):
+        return {"conversations": self.conversations,
+                "complete": self.complete,
+                "retries": self.retries,
+                "errors": self.errors,
+                "duration_avg": self.duration_total / self.conversations if self.conversations > 0 else None,
+                "duration_max": self.duration_max,
+                "duration_buckets": dict(zip([str(b) for b in SUMMARY_BUCKETS] + ["+Inf"], self.buckets))}
+
+
+def decode_file(path, output_path=None):
+    summary = ConversationSummary()
+    stream = None
+    try:
+        if output_path is not None:
+            stream = open(output_path, "w")
+        for conversation in conversations(read_packets(path)):
+            summary.add(conversation)
+            if stream is not None:
+                stream.write(json.dumps(conversation) + "\n")
+    finally:
+        if stream is not None:
+            stream.close()
+    return summary
+
+
+def _decode_file_job(args):
+    path, output_dir = args
+    output_path = None
+    if output_dir is not None:
+        output_path = os.path.join(output_dir, os.path.basename(path) + DECODER_OUTPUT_SUFFIX)
+    return path, decode_file(path, output_path)
+
+
+def decode_files(paths, output_dir=None, processes=None):
+    jobs = [(path, output_dir) for path in paths]
+    if processes == 1:
+        for result in map(_decode_file_job, jobs):
+            yield result
+    else:
+        with Pool(processes) as pool:
+            for result in pool.imap_unordered(_decode_file_job, jobs):
+                yield result
+
+
+def _packet_data_from_log(text):
+    m = LOG_PACKET.match(text)
+    if m is None:
+        return None
+    packet_type, address, address2, sequence, body = m.groups()
+    data = struct.pack(">I", int(address, 16)) + bytes([PACKET_TYPE_BITS[packet_type] << 5 | int(sequence, 16)])
+    if address2 is not None:
+        data += struct.pack(">I", int(address2, 16))
+    if body is not None:
+        data += bytes.fromhex(body)
+    return data
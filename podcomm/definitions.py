@@ -1,9 +1,14 @@
 from enum import IntEnum
+import atexit
+import copy
 import logging
+import logging.handlers
+import queue
 import sys
 
 RILEYLINK_MAC_FILE = "data/rladdr"
 RILEYLINK_VERSION_FILE = "data/rlversion"
+RILEYLINK_REGISTRY_FILE = "data/rlregistry.json"
 PDM_LOCK_FILE = "data/.pdmlock"
 TOKENS_FILE = "data/tokens"
 KEY_FILE = "data/key"
@@ -11,25 +16,97 @@ RESPONSE_FILE = "data/response"
 POD_FILE = "data/pod"
 POD_FILE_SUFFIX = ".json"
 POD_LOG_SUFFIX = ".log"
+POD_JOURNAL_SUFFIX = ".journal"
+POD_NONCE_SUFFIX = ".nonce"
+POD_PULSE_LOG_SUFFIX = ".pulselog.npz"
+PODS_DIR = "data/pods"
+RESULT_CACHE_FILE = "data/results.json"
+CAPTURE_FILE = "data/capture.ring"
 OMNIPY_LOGGER = "OMNIPY"
 OMNIPY_LOGFILE = "data/omnipy.log"
+OMNIPY_LOGFILE_MAX_BYTES = 4 * 1024 * 1024
+OMNIPY_LOGFILE_BACKUP_COUNT = 5
+OMNIPY_TRACE_LOGGER = "OMNIPY_TRACE"
+TRACE_FILE = "data/trace.log"
+TRACE_FILE_MAX_BYTES = 1024 * 1024
+TRACE_FILE_BACKUP_COUNT = 3
 
 API_VERSION_MAJOR = 1
 API_VERSION_MINOR = 0
 
+JOB_HISTORY_SIZE = 32
+JOB_WAIT_TIMEOUT_MAX = 30
+RESULT_CACHE_TTL = 3600
+STATE_HISTORY_SIZE = 16
+
+RILEYLINK_SCAN_WINDOW = 2.0
+RILEYLINK_SCAN_ATTEMPTS = 5
+RILEYLINK_MAX_FAILURES = 3
+RILEYLINK_FAILURE_BACKOFF = 300
+RILEYLINK_PRECONNECT_GRACE = 10
+# unauthenticated token requests may not keep the RileyLink connected
+RILEYLINK_PRECONNECT_INTERVAL = 60
+
+# the pod repeats an unacknowledged response at intervals shorter than this
+RADIO_SILENCE_WINDOW = 2.5
+RADIO_SILENCE_MAX_WAIT = 20
+DIVERSITY_LISTEN_WINDOW = 0.25
+
+CAPTURE_SLOTS = 4096
+CAPTURE_MAX_DATA = 64
+CAPTURE_LISTEN_WINDOW = 0.5
+CAPTURE_IDLE_DELAY = 5
+CAPTURE_RETRY_DELAY = 30
+CAPTURE_LOOKBACK = 60
+
+DECODER_CONVERSATION_GAP = 30
+DECODER_CAPTURE_CHUNK = 256
+DECODER_OUTPUT_SUFFIX = ".conversations.jsonl"
+
+MEMORY_TRACE_FRAMES = 8
+MEMORY_REPORT_LIMIT = 25
+
+NONCE_RESERVATION_BLOCK = 4
+
+RADIO_HOST_PORT = 4445
+RADIO_HOST_MAX_FRAME = 1024
+RADIO_HOST_CHALLENGE_SIZE = 16
+RADIO_HOST_OPEN_TIMEOUT = 30
+RADIO_HOST_LATENCY_MARGIN = 2.0
+RADIO_HOST_KEEPALIVE_INTERVAL = 5
+RADIO_HOST_KEEPALIVE_MISSES = 3
+
+LINK_QUALITY_WINDOW = 64
+LINK_QUALITY_RSSI_OFFSET = 73
+LINK_QUALITY_WEAK_RSSI = -95
+LINK_QUALITY_MAX_LOSS_RATE = 0.3
+LINK_QUALITY_MAX_COUNTER_GAP = 16
+LINK_QUALITY_DEGRADED_RETRIES = 5
+
 REST_URL_GET_VERSION = "/omnipy/version"
 REST_URL_OMNIPY_SHUTDOWN = "/omnipy/shutdown"
 REST_URL_OMNIPY_RESTART = "/omnipy/restart"
+REST_URL_METRICS = "/omnipy/metrics"
+REST_URL_CAPTURE = "/omnipy/capture"
+REST_URL_HEALTH = "/omnipy/health"
+REST_URL_MEMORY = "/omnipy/memory"
 
 REST_URL_TOKEN = "/omnipy/token"
 REST_URL_CHECK_PASSWORD = "/omnipy/pwcheck"
 
+REST_URL_JOB_STATUS = "/omnipy/job"
+REST_URL_JOB_WAIT = "/omnipy/jobwait"
+REST_URL_JOB_LIST = "/omnipy/jobs"
+
 REST_URL_NEW_POD = "/omnipy/newpod"
 REST_URL_SET_POD_PARAMETERS = "/omnipy/parameters"
 REST_URL_GET_PDM_ADDRESS = "/omnipy/pdmspy"
 REST_URL_SET_LIMITS = "/omnipy/limits"
+REST_URL_POD_LIST = "/omnipy/pods"
+REST_URL_POD_SCOPE = "/pods/<pod_id>"
 
 REST_URL_RL_INFO = "/rl/info"
+REST_URL_RL_DEVICES = "/rl/devices"
 
 REST_URL_STATUS = "/pdm/status"
 REST_URL_PDM_BUSY = "/pdm/isbusy"
@@ -39,6 +116,43 @@ REST_URL_BOLUS = "/pdm/bolus"
 REST_URL_CANCEL_BOLUS = "/pdm/cancelbolus"
 REST_URL_SET_TEMP_BASAL = "/pdm/settempbasal"
 REST_URL_CANCEL_TEMP_BASAL = "/pdm/canceltempbasal"
+REST_URL_PULSE_LOG = "/pdm/pulselog"
+REST_URL_BATCH = "/pdm/batch"
+REST_URL_STATUS_ALL = "/pdm/statusall"
+
+BATCH_MAX_STEPS = 8
+
+
+class Lazy:
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def snapshot(obj):
+    return Lazy(str, copy.copy(obj))
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # arguments that could change before the writer thread formats them are rendered here
+    immutable_args = (str, int, float, bytes, type(None), Lazy)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg if isinstance(arg, self.immutable_args) else str(arg) for arg in record.args)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_log_listener = None
 
 
 def getLogger():
@@ -46,17 +160,24 @@ def getLogger():
 
 
 def configureLogging():
+    global _log_listener
+    if _log_listener is not None:
+        return
     logger = getLogger()
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh = logging.FileHandler(OMNIPY_LOGFILE)
+    fh = logging.handlers.RotatingFileHandler(OMNIPY_LOGFILE, maxBytes=OMNIPY_LOGFILE_MAX_BYTES,
+                                              backupCount=OMNIPY_LOGFILE_BACKUP_COUNT)
     ch = logging.StreamHandler()
     fh.setLevel(logging.DEBUG)
     ch.setLevel(logging.INFO)
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    log_queue = queue.Queue()
+    _log_listener = logging.handlers.QueueListener(log_queue, fh, ch, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logger.addHandler(LogQueueHandler(log_queue))
 
 
 class BolusState(IntEnum):
@@ -10,6 +10,11 @@ class RileyLinkError(OmnipyError):
         self.err_code = err_code
 
 
+class TransportError(RileyLinkError):
+    def __init__(self, message="Unknown transport error"):
+        RileyLinkError.__init__(self, message)
+
+
 class ProtocolError(OmnipyError):
     def __init__(self, message="Unknown protocol error"):
         OmnipyError.__init__(self, message)
@@ -0,0 +1,168 @@
+from .definitions import *
+from .exceptions import OmnipyError
+from . import trace
+from collections import OrderedDict
+from enum import IntEnum
+import queue
+import threading
+import time
+import uuid
+
+
+class JobState(IntEnum):
+    Queued = 0
+    Running = 1
+    Succeeded = 2
+    Failed = 3
+
+
+class Job:
+    def __init__(self, name, func, asynchronous=False, key=None, timing=False):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.func = func
+        self.asynchronous = asynchronous
+        self.key = key
+        self.timing = timing
+        self.collector = None
+        self.cached = False
+        self.state = JobState.Queued
+        self.result = None
+        self.error = None
+        self.exception = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    @staticmethod
+    def from_cache(key, entry):
+        job = Job(entry["name"], None, key=key)
+        job.cached = True
+        job.result = entry["result"]
+        job.error = entry["error"]
+        job.submitted = entry["stored"]
+        job.finished = entry["stored"]
+        if entry["success"]:
+            job.state = JobState.Succeeded
+        else:
+            job.state = JobState.Failed
+        job.done.set()
+        return job
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def is_finished(self):
+        return self.state == JobState.Succeeded or self.state == JobState.Failed
+
+    def as_dict(self, with_result=True):
+        d = {"id": self.id,
+             "name": self.name,
+             "state": JobState(self.state).name,
+             "submitted": self.submitted,
+             "started": self.started,
+             "finished": self.finished,
+             "error": self.error,
+             "key": self.key,
+             "cached": self.cached}
+        if with_result:
+            d["result"] = self.result
+        if self.timing and self.collector is not None:
+            d["timing"] = self.collector.as_list()
+        return d
+
+
+class JobManager:
+    def __init__(self, history_size=JOB_HISTORY_SIZE, cache=None):
+        self.logger = getLogger()
+        self.history_size = history_size
+        self.cache = cache
+        self.jobs = OrderedDict()
+        self.keyed_jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = None
+
+    def submit(self, name, func, asynchronous=False, key=None, timing=False):
+        with self.lock:
+            if key is not None:
+                job = self.keyed_jobs.get(key)
+                if job is not None:
+                    self.logger.debug("Attaching to job %s with key %s" % (job.id, key))
+                    return job
+                if self.cache is not None:
+                    entry = self.cache.get(key)
+                    if entry is not None:
+                        self.logger.debug("Returning cached result for key %s" % key)
+                        job = Job.from_cache(key, entry)
+                        self.jobs[job.id] = job
+                        self._trim_history()
+                        return job
+
+            job = Job(name, func, asynchronous, key, timing)
+            if key is not None:
+                self.keyed_jobs[key] = job
+            self.jobs[job.id] = job
+            self._trim_history()
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name="omnipy-jobs", daemon=True)
+                self.worker.start()
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def pending_count(self):
+        with self.lock:
+            return len([job for job in self.jobs.values() if not job.is_finished()])
+
+    def _trim_history(self):
+        excess = len(self.jobs) - self.history_size
+        if excess <= 0:
+            return
+        for job_id in [job.id for job in self.jobs.values() if job.is_finished()][:excess]:
+            del self.jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            job.state = JobState.Running
+            job.started = time.time()
+            try:
+                with trace.collect(job.name, force=job.timing) as collector:
+                    job.collector = collector
+                    job.result = job.func()
+                job.state = JobState.Succeeded
+            except Exception as e:
+                job.exception = e
+                if isinstance(e, OmnipyError):
+                    job.error = e.error_message
+                else:
+                    job.error = "Other error. Please check log files."
+                job.state = JobState.Failed
+                if job.asynchronous:
+                    self.logger.exception("Error while running job %s (%s)" % (job.name, job.id))
+            finally:
+                job.func = None
+                job.finished = time.time()
+                if job.asynchronous:
+                    trace.write(job.collector)
+                if job.key is not None:
+                    self._store_result(job)
+                job.done.set()
+                self.queue.task_done()
+
+    def _store_result(self, job):
+        try:
+            if self.cache is not None:
+                self.cache.put(job.key, job.name, job.state == JobState.Succeeded, job.result, job.error)
+        finally:
+            with self.lock:
+                self.keyed_jobs.pop(job.key, None)
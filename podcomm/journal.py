@@ -0,0 +1,152 @@
+from .definitions import *
+from .metrics import PDM_NONCE_RESERVATIONS, PDM_NONCE_RESERVATION_SECONDS
+from .nonce import Nonce
+import simplejson as json
+import binascii
+import os
+import struct
+import time
+
+# lot, tid, seed and the range of nonces generated from the seed that may have been sent
+NONCE_RESERVATION_RECORD = struct.Struct(">IIIHH")
+
+
+class CommandJournal:
+    def __init__(self, path, lot, tid):
+        self.logger = getLogger()
+        self.path = path
+        self.lot = lot
+        self.tid = tid
+        entries = self.pending()
+        self.last_id = max([entry["begin"]["id"] for entry in entries], default=0)
+        # radio state when the newest nonce since the last checkpoint was sent
+        self.last_nonce_state = None
+        for entry in reversed(entries):
+            if entry["begin"]["nonce"] is not None:
+                self.last_nonce_state = entry["begin"]["state"]
+                break
+
+    def begin(self, message, request_msg, nonce, state, pod):
+        self.last_id += 1
+        self._append({"event": "begin",
+                      "id": self.last_id,
+                      "lot": self.lot,
+                      "tid": self.tid,
+                      "time": time.time(),
+                      "request": request_msg,
+                      "contents": [[ctype, binascii.hexlify(content).decode("ascii")]
+                                   for ctype, content in message.getContents()],
+                      "nonce": nonce,
+                      "state": state,
+                      "pod": {"totalInsulin": pod.totalInsulin,
+                              "alert_states": pod.alert_states,
+                              "progress": pod.progress,
+                              "bolusState": pod.bolusState,
+                              "basalState": pod.basalState}})
+        return self.last_id
+
+    def end(self, entry_id, outcome, state):
+        self._append({"event": "end",
+                      "id": entry_id,
+                      "time": time.time(),
+                      "outcome": outcome,
+                      "state": state})
+
+    def checkpoint(self):
+        self.last_nonce_state = None
+        if self.path is None:
+            return
+        try:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+        except Exception:
+            self.logger.exception("Error while clearing the command journal")
+
+    def pending(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return []
+        entries = []
+        by_id = {}
+        with open(self.path, "r") as stream:
+            for line in stream:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.logger.warning("Ignoring incomplete journal record: %s" % line.strip())
+                    continue
+                if record["event"] == "begin":
+                    if record.get("lot") != self.lot or record.get("tid") != self.tid:
+                        # left behind by an earlier pod stored under the same path
+                        by_id.pop(record["id"], None)
+                        continue
+                    entry = {"begin": record, "end": None}
+                    by_id[record["id"]] = entry
+                    entries.append(entry)
+                elif record["id"] in by_id:
+                    by_id[record["id"]]["end"] = record
+        return entries
+
+    def _append(self, record):
+        if self.path is None:
+            return
+        with open(self.path, "a") as stream:
+            stream.write(json.dumps(record) + "\n")
+            stream.flush()
+            os.fsync(stream.fileno())
+
+
+class NonceReservation:
+    def __init__(self, path, lot, tid):
+        self.logger = getLogger()
+        self.path = path
+        self.lot = lot
+        self.tid = tid
+        self.seed = None
+        self.start = 0
+        self.limit = 0
+        self._read()
+
+    def reserve(self, nonce):
+        # called before every nonce is taken, the disk is only written once a block is used up
+        if self.path is None or (nonce.seed == self.seed and nonce.nonce_runs < self.limit):
+            return
+        start = time.perf_counter()
+        self._write(nonce.seed, nonce.nonce_runs, nonce.nonce_runs + NONCE_RESERVATION_BLOCK)
+        PDM_NONCE_RESERVATIONS.inc()
+        PDM_NONCE_RESERVATION_SECONDS.observe(time.perf_counter() - start)
+
+    def is_ahead_of(self, nonce):
+        # a pod file saved after the block was reserved already holds the position, one saved before it
+        # may be behind nonces sent from the block. A seed the pod file does not know is not trusted,
+        # it may be older than a reset of the pod parameters.
+        return self.seed is not None and self.seed == nonce.seed and nonce.nonce_runs <= self.start < self.limit
+
+    def get_nonce(self):
+        nonce = Nonce(self.lot, self.tid, seed=self.seed)
+        nonce.fastForward(self.limit)
+        return nonce
+
+    def _read(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        with open(self.path, "rb") as stream:
+            data = stream.read()
+        if len(data) != NONCE_RESERVATION_RECORD.size:
+            self.logger.warning("Ignoring nonce reservation of unexpected size %d" % len(data))
+            return
+        lot, tid, seed, start, limit = NONCE_RESERVATION_RECORD.unpack(data)
+        # left behind by an earlier pod stored under the same path
+        if lot != self.lot or tid != self.tid:
+            return
+        self.seed, self.start, self.limit = seed, start, limit
+
+    def _write(self, seed, start, limit):
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, NONCE_RESERVATION_RECORD.pack(self.lot, self.tid, seed, start, limit), 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.seed = seed
+        self.start = start
+        self.limit = limit
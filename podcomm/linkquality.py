@@ -0,0 +1,85 @@
+from .definitions import *
+from collections import deque
+import threading
+import time
+
+
+def decode_rssi(value):
+    # cc111x register value, two's complement in half dB steps
+    if value >= 128:
+        value -= 256
+    return value / 2.0 - LINK_QUALITY_RSSI_OFFSET
+
+
+class LinkQuality:
+    def __init__(self, size=LINK_QUALITY_WINDOW):
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, rssi, attempts, timeouts, invalid, missed, duration, success):
+        with self.lock:
+            self.records.append({"time": time.time(),
+                                 "rssi": rssi,
+                                 "attempts": attempts,
+                                 "timeouts": timeouts,
+                                 "invalid": invalid,
+                                 "missed": missed,
+                                 "duration": duration,
+                                 "success": success})
+
+    def is_degraded(self):
+        summary = self.summary()
+        if summary["exchanges"] == 0:
+            return False
+        if summary["rssi_avg"] is not None and summary["rssi_avg"] < LINK_QUALITY_WEAK_RSSI:
+            return True
+        return summary["loss_rate"] > LINK_QUALITY_MAX_LOSS_RATE
+
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+        rssi_values = [r["rssi"] for r in records if r["rssi"] is not None]
+        attempts = sum(r["attempts"] for r in records)
+        lost = sum(r["timeouts"] + r["invalid"] for r in records)
+        result = {"exchanges": len(records),
+                  "failed": len([r for r in records if not r["success"]]),
+                  "attempts": attempts,
+                  "timeouts": sum(r["timeouts"] for r in records),
+                  "invalid": sum(r["invalid"] for r in records),
+                  "missed_packets": sum(r["missed"] for r in records),
+                  "loss_rate": lost / attempts if attempts > 0 else 0.0,
+                  "rssi_last": rssi_values[-1] if len(rssi_values) > 0 else None,
+                  "rssi_avg": None,
+                  "rssi_min": None,
+                  "rssi_max": None,
+                  "last_exchange": records[-1]["time"] if len(records) > 0 else None}
+        if len(rssi_values) > 0:
+            result["rssi_avg"] = round(sum(rssi_values) / len(rssi_values), 1)
+            result["rssi_min"] = min(rssi_values)
+            result["rssi_max"] = max(rssi_values)
+        return result
+
+    def describe(self):
+        summary = self.summary()
+        if summary["exchanges"] == 0:
+            return "no link quality data"
+        if summary["rssi_avg"] is None:
+            rssi = "no replies"
+        else:
+            rssi = "rssi avg %.1f dBm, last %.1f dBm" % (summary["rssi_avg"], summary["rssi_last"])
+        return "%s link, %s, loss %d%% over %d exchanges" % ("degraded" if self.is_degraded() else "good",
+                                                           rssi, summary["loss_rate"] * 100,
+                                                           summary["exchanges"])
+
+
+_links = dict()
+_links_lock = threading.Lock()
+
+
+def get_link_quality(address):
+    with _links_lock:
+        link = _links.get(address)
+        if link is None:
+            link = LinkQuality()
+            _links[address] = link
+        return link
@@ -0,0 +1,49 @@
+from .definitions import *
+import os
+import resource
+import tracemalloc
+
+
+def get_rss():
+    try:
+        with open("/proc/self/status", "r") as stream:
+            for line in stream:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    # ru_maxrss is the peak rather than the current size, but better than nothing
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_tracing(frames=MEMORY_TRACE_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def start_tracing_from_environment():
+    frames = os.environ.get("OMNIPY_TRACEMALLOC")
+    if frames is not None:
+        start_tracing(int(frames or MEMORY_TRACE_FRAMES))
+
+
+def report(limit=MEMORY_REPORT_LIMIT, group_by="lineno"):
+    result = {"rss": get_rss(), "tracing": tracemalloc.is_tracing()}
+    if not tracemalloc.is_tracing():
+        return result
+
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>")))
+    statistics = snapshot.statistics(group_by)
+    result["traced_current"] = current
+    result["traced_peak"] = peak
+    result["traced_overhead"] = tracemalloc.get_tracemalloc_memory()
+    result["top"] = [{"file": s.traceback[0].filename,
+                      "line": s.traceback[0].lineno,
+                      "size": s.size,
+                      "count": s.count} for s in statistics[:limit]]
+    return result
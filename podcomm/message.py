@@ -14,6 +14,8 @@ class MessageType(Enum):
     POD = 1
 
 class Message:
+    __slots__ = ("type", "address", "unknownBits", "sequence", "length", "body", "acknowledged", "state")
+
     def __init__(self, mtype, address, unknownBits = 0, sequence = 0):
         self.type = mtype
         self.address = address
@@ -152,16 +154,16 @@ class Message:
         return contents
 
     def __str__(self):
-        s = "%s %s %s\n" % (self.type, self.sequence, self.unknownBits)
+        lines = ["%s %s %s\n" % (self.type, self.sequence, self.unknownBits)]
         for contentType, content in self.getContents():
-            s += "Type: %02x " % contentType
+            lines.append("Type: %02x " % contentType)
             if contentType == 0x1a:
-                s += separate(content, [4, 1, 2, 1, 2]) + "\n"
+                lines.append(separate(content, [4, 1, 2, 1, 2]) + "\n")
             elif contentType == 0x16:
-                s += separate(content, [1, 1, 2, 4, 2, 4]) + "\n"
+                lines.append(separate(content, [1, 1, 2, 4, 2, 4]) + "\n")
             else:
-                s += "Type: %02x Body: %s\n" % (contentType, content.hex())
-        return s
+                lines.append("Type: %02x Body: %s\n" % (contentType, content.hex()))
+        return "".join(lines)
 
 
 def separate(content, separations):
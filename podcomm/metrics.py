@@ -0,0 +1,194 @@
+from functools import wraps
+import threading
+import time
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join(pairs)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        if len(labels) == 0:
+            self.values[()] = 0
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, _format_labels(self.labels, label_values),
+                                          _format_value(value)))
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s gauge" % self.name]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, _format_labels(self.labels, label_values),
+                                          _format_value(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, buckets, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = [0] * (len(self.buckets) + 2)
+                self.series[label_values] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                cumulative = 0
+                for i, bound in enumerate(self.buckets):
+                    cumulative += series[i]
+                    lines.append("%s_bucket%s %d" % (self.name,
+                                                     _format_labels(self.labels, label_values,
+                                                                    ("le", _format_value(float(bound)))),
+                                                     cumulative))
+                lines.append("%s_sum%s %s" % (self.name, _format_labels(self.labels, label_values),
+                                              repr(series[-2])))
+                lines.append("%s_count%s %d" % (self.name, _format_labels(self.labels, label_values),
+                                                series[-1]))
+        return lines
+
+
+def measured(histogram, *label_values):
+    with_outcome = len(histogram.labels) > len(label_values)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "success"
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                if with_outcome:
+                    histogram.observe(time.perf_counter() - start, *(label_values + (outcome,)))
+                else:
+                    histogram.observe(time.perf_counter() - start, *label_values)
+        return wrapper
+    return decorator
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+RADIO_EXCHANGES = Counter("omnipy_radio_exchanges_total",
+                          "Packet exchanges started with the pod")
+RADIO_RETRIES = Counter("omnipy_radio_retries_total",
+                        "Packet retransmissions during exchanges")
+RADIO_TIMEOUTS = Counter("omnipy_radio_timeouts_total",
+                         "Exchange attempts that received no response")
+RADIO_RESYNCS = Counter("omnipy_radio_resyncs_total",
+                        "Transmission out of sync errors")
+RADIO_DIVERSITY_RECEPTIONS = Counter("omnipy_radio_diversity_receptions_total",
+                                     "Replies missed by the transmitting RileyLink and received by the listener")
+RADIO_INVALID_PACKETS = Counter("omnipy_radio_invalid_packets_total",
+                                "Received packets that failed the crc check")
+RADIO_RSSI_DBM = Histogram("omnipy_radio_rssi_dbm",
+                           "Signal strength of packets received from the pod",
+                           (-110, -100, -95, -90, -80, -70, -60, -50))
+RADIO_EXCHANGE_SECONDS = Histogram("omnipy_radio_exchange_seconds",
+                                   "Duration of a packet exchange including retries",
+                                   (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+RADIO_MESSAGE_SECONDS = Histogram("omnipy_radio_message_seconds",
+                                  "Duration of a complete message conversation",
+                                  (0.25, 0.5, 1, 2.5, 5, 10, 20, 40))
+
+RILEYLINK_CONNECTS = Counter("omnipy_rileylink_connects_total",
+                             "Successful BLE connections to the RileyLink")
+RILEYLINK_CONNECT_RETRIES = Counter("omnipy_rileylink_connect_retries_total",
+                                    "Failed BLE connection attempts")
+RILEYLINK_FAILOVERS = Counter("omnipy_rileylink_failovers_total",
+                              "Switches to another RileyLink after the active one stopped responding")
+RILEYLINK_PRECONNECTS = Counter("omnipy_rileylink_preconnects_total",
+                                "Speculative connections opened ahead of a command by outcome", ("outcome",))
+RILEYLINK_BLE_ERRORS = Counter("omnipy_rileylink_ble_errors_total",
+                               "BLE or radio host connection errors raised while talking to the RileyLink",
+                               ("command",))
+RILEYLINK_COMMAND_SECONDS = Histogram("omnipy_rileylink_command_seconds",
+                                      "RileyLink command round trip time",
+                                      (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), ("command",))
+
+PDM_NONCE_RESYNCS = Counter("omnipy_pdm_nonce_resyncs_total",
+                            "Bad nonce responses that required renegotiation")
+PDM_NONCE_RESERVATIONS = Counter("omnipy_pdm_nonce_reservations_total",
+                                 "Nonce blocks reserved on disk before use")
+PDM_NONCE_RESERVATION_SECONDS = Histogram("omnipy_pdm_nonce_reservation_seconds",
+                                          "Time spent writing nonce reservations to disk",
+                                          (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+PDM_OPERATION_SECONDS = Histogram("omnipy_pdm_operation_seconds",
+                                  "Duration of pdm operations by outcome",
+                                  (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120), ("operation", "outcome"))
+
+PROCESS_RSS_BYTES = Gauge("omnipy_process_resident_memory_bytes",
+                          "Resident set size of the omnipy process")
+STARTUP_READY_SECONDS = Gauge("omnipy_startup_ready_seconds",
+                              "Seconds from process start until the startup warm-up finished")
+STARTUP_FIRST_COMMAND_SECONDS = Gauge("omnipy_startup_first_command_seconds",
+                                      "Seconds from process start until the first successful command")
@@ -4,6 +4,8 @@ FAKE_NONCE = 0xD012FA62
 
 
 class Nonce:
+    __slots__ = ("lot", "tid", "lastNonce", "seed", "ptr", "nonce_runs", "table")
+
     def __init__(self, lot, tid, seekNonce = None, seed = 0):
         self.lot = lot
         self.tid = tid
@@ -26,6 +28,10 @@ class Nonce:
         self.nonce_runs += 1
         return nonce
 
+    def fastForward(self, runs):
+        while self.nonce_runs < runs:
+            self.getNext(True)
+
     def sync(self, syncWord, msgSequence):
         w_sum = (self.lastNonce & 0xFFFF) + (crc16_table[msgSequence] & 0xFFFF) \
               + (self.lot & 0xFFFF) + (self.tid & 0xFFFF)
@@ -3,6 +3,8 @@ import struct
 from .exceptions import ProtocolError
 
 class Packet:
+    __slots__ = ("data", "address", "address2", "sequence", "type", "body", "ack_final", "final_ack")
+
     def __init__(self):
         self.data = None
         self.address = None
@@ -4,27 +4,75 @@ from .radio import Radio
 from .message import Message, MessageType
 from .exceptions import PdmError, OmnipyError, TransmissionOutOfSyncError
 from .definitions import *
+from .journal import CommandJournal, NonceReservation
+from .linkquality import get_link_quality
+from .responses import decode_content, ErrorResponse, InformationRecord
+from .trace import traced
+from .metrics import measured, PDM_OPERATION_SECONDS, PDM_NONCE_RESYNCS
 
+from contextlib import contextmanager
 from decimal import *
+import os
+import threading
 import time
 import struct
 from datetime import datetime, timedelta
 
+_session_locks = {}
+_session_locks_lock = threading.Lock()
+
+
+def get_session_lock(pod):
+    # every Pdm working on the same pod file shares one lock, so sessions of different threads never overlap
+    key = pod.path if pod.path is not None else id(pod)
+    with _session_locks_lock:
+        lock = _session_locks.get(key)
+        if lock is None:
+            lock = threading.RLock()
+            _session_locks[key] = lock
+        return lock
+
+
 class Pdm:
-    def __init__(self, pod):
+    def __init__(self, pod, rileylink=None, listener=None):
         self.nonce = Nonce(pod.lot, pod.tid, seekNonce=pod.lastNonce, seed=pod.nonceSeed)
         self.pod = pod
-        self.radio = Radio(pod.msgSequence, pod.packetSequence)
+        self.radio = Radio(pod.msgSequence, pod.packetSequence, rileylink, listener)
         self.logger = getLogger()
-
+        self.session_depth = 0
+        self.session_lock = get_session_lock(pod)
+        journal_path = None
+        if pod.path is not None:
+            journal_path = pod.path + POD_JOURNAL_SUFFIX
+        self.journal = CommandJournal(journal_path, pod.lot, pod.tid)
+        reservation_path = None
+        if pod.path is not None:
+            reservation_path = pod.path + POD_NONCE_SUFFIX
+        self.nonce_reservation = NonceReservation(reservation_path, pod.lot, pod.tid)
+        self._fast_forward_nonce()
+
+    @contextmanager
+    def session(self, save=True):
+        # the depth is only changed while the lock is held, nested sessions of the holding thread re-enter it
+        with self.radio.hold(), self.session_lock, pdmlock():
+            self.session_depth += 1
+            try:
+                yield self
+            finally:
+                self.session_depth -= 1
+                if self.session_depth == 0:
+                    self._end_operation(save)
+
+    @traced("pdm.status")
+    @measured(PDM_OPERATION_SECONDS, "status")
     def updatePodStatus(self, update_type=0):
         try:
-            self._assert_pod_address_assigned()
-            if update_type == 0 and \
-                    self.pod.lastUpdated is not None and \
-                    time.time() - self.pod.lastUpdated < 60:
-                return
-            with pdmlock():
+            with self.session():
+                self._assert_pod_address_assigned()
+                if update_type == 0 and \
+                        self.pod.lastUpdated is not None and \
+                        time.time() - self.pod.lastUpdated < 60:
+                    return
                 self.logger.debug("updating pod status")
                 self._update_status(update_type, stay_connected=False)
 
@@ -32,29 +80,58 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
 
+    @traced("pdm.ack")
+    @measured(PDM_OPERATION_SECONDS, "ack")
     def acknowledge_alerts(self, alert_mask):
         try:
-            self._assert_can_acknowledge_alerts()
-
-            with pdmlock():
-                self.logger.debug("acknowledging alerts with bitmask %d" % alert_mask)
+            with self.session():
+                self._assert_can_acknowledge_alerts()
+                self.logger.debug("acknowledging alerts with bitmask %d", alert_mask)
                 self._acknowledge_alerts(alert_mask)
 
         except OmnipyError:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
+
+    @traced("pdm.recover")
+    def recover(self):
+        entries = self.journal.pending()
+        if len(entries) == 0:
+            return None
+
+        try:
+            with self.session(save=False):
+                last = entries[-1]
+                if last["end"] is not None:
+                    self._restore_radio_state(last["end"]["state"])
+                else:
+                    state = dict(last["begin"]["state"])
+                    if last["begin"]["nonce"] is not None:
+                        state["lastNonce"] = last["begin"]["nonce"]
+                    self._restore_radio_state(state)
+
+                commands = [entry for entry in entries if entry["begin"]["contents"][0][0] != 0x0e]
+                self.logger.info("Recovering pod state from %d journal entries", len(entries))
+                self._update_status(stay_connected=False)
+                self._savePod()
+
+                if len(commands) == 0:
+                    return {"request": None, "enacted": None}
+                command = commands[-1]
+                enacted = self._was_enacted(command["begin"])
+                self.logger.info("Interrupted command %s enacted: %s", command["begin"]["request"], enacted)
+                return {"request": command["begin"]["request"], "enacted": enacted}
+
+        except OmnipyError:
+            raise
+        except Exception as e:
+            raise PdmError("Unexpected error") from e
 
     def is_busy(self):
         try:
-            with pdmlock():
+            with self.session(save=False):
                 return self._is_bolus_running()
         except PdmBusyError:
             return True
@@ -62,15 +139,13 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
 
     # def clear_alert(self, alert_bit):
     #     try:
     #         self._assert_can_acknowledge_alerts()
     #
     #         with pdmlock():
-    #             self.logger.debug("clearing alert %d" % alert_bit)
+    #             self.logger.debug("clearing alert %d", alert_bit)
     #             self._configure_alert(alert_bit, clear=True)
     #     except PdmError:
     #         raise
@@ -81,9 +156,11 @@ class Pdm:
     #     finally:
     #         self._savePod()
 
+    @traced("pdm.bolus")
+    @measured(PDM_OPERATION_SECONDS, "bolus")
     def bolus(self, bolus_amount, beep=False):
         try:
-            with pdmlock():
+            with self.session():
                 self._assert_pod_address_assigned()
                 self._assert_can_generate_nonce()
                 self._assert_immediate_bolus_not_active()
@@ -147,14 +224,13 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
 
 
+    @traced("pdm.cancel_bolus")
+    @measured(PDM_OPERATION_SECONDS, "cancel_bolus")
     def cancelBolus(self, beep=False):
         try:
-            with pdmlock():
+            with self.session():
                 self._assert_pod_address_assigned()
                 self._assert_can_generate_nonce()
                 self._assert_not_faulted()
@@ -175,13 +251,12 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
 
+    @traced("pdm.cancel_temp_basal")
+    @measured(PDM_OPERATION_SECONDS, "cancel_temp_basal")
     def cancelTempBasal(self, beep=False):
         try:
-            with pdmlock():
+            with self.session():
                 self._assert_pod_address_assigned()
                 self._assert_can_generate_nonce()
                 self._assert_immediate_bolus_not_active()
@@ -189,14 +264,7 @@ class Pdm:
                 self._assert_status_running()
 
                 if self._is_temp_basal_active():
-                    self.logger.debug("Canceling temp basal")
-                    self._cancelActivity(cancelTempBasal=True, beep=beep)
-                    if self.pod.basalState == BasalState.TempBasal:
-                        raise PdmError("Failed to cancel temp basal")
-                    else:
-                        self.pod.last_enacted_temp_basal_duration = float(-1)
-                        self.pod.last_enacted_temp_basal_start = time.time()
-                        self.pod.last_enacted_temp_basal_amount = float(-1)
+                    self._cancel_temp_basal(beep)
                 else:
                     self.logger.warning("Cancel temp basal received, while temp basal was not active. Ignoring.")
 
@@ -204,13 +272,12 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
 
+    @traced("pdm.set_temp_basal")
+    @measured(PDM_OPERATION_SECONDS, "set_temp_basal")
     def setTempBasal(self, basalRate, hours, confidenceReminder=False):
         try:
-            with pdmlock():
+            with self.session():
                 self._assert_pod_address_assigned()
                 self._assert_can_generate_nonce()
                 self._assert_immediate_bolus_not_active()
@@ -230,7 +297,7 @@ class Pdm:
                     raise PdmError("Requested rate exceeds maximum temp basal capability")
 
                 if self._is_temp_basal_active():
-                    self.cancelTempBasal()
+                    self._cancel_temp_basal()
 
                 halfHourUnits = [basalRate / Decimal(2)] * halfHours
                 pulseList = getPulsesForHalfHours(halfHourUnits)
@@ -286,13 +353,12 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
 
+    @traced("pdm.set_basal_schedule")
+    @measured(PDM_OPERATION_SECONDS, "set_basal_schedule")
     def set_basal_schedule(self, schedule):
         try:
-            with pdmlock():
+            with self.session():
                 self._assert_pod_address_assigned()
                 self._assert_can_generate_nonce()
                 self._assert_immediate_bolus_not_active()
@@ -376,14 +442,13 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
 
 
+    @traced("pdm.deactivate")
+    @measured(PDM_OPERATION_SECONDS, "deactivate")
     def deactivate_pod(self):
         try:
-            with pdmlock():
+            with self.session():
                 msg = self._createMessage(0x1c, bytes([0, 0, 0, 0]))
                 self._sendMessage(msg, with_nonce=True, request_msg="DEACTIVATE POD")
 
@@ -391,13 +456,57 @@ class Pdm:
             raise
         except Exception as e:
             raise PdmError("Unexpected error") from e
-        finally:
-            self.radio.disconnect()
-            self._savePod()
+
+    @traced("pdm.pulselog")
+    @measured(PDM_OPERATION_SECONDS, "pulselog")
+    def read_pulse_log(self, previous=True):
+        # numpy is only needed for pulse logs, so it is not imported with the rest of the pdm
+        from .pulselog import PulseLog, PULSE_LOG_PLUS, PULSE_LOG_RECENT, PULSE_LOG_PREVIOUS
+        try:
+            with self.session():
+                self._assert_pod_address_assigned()
+                if self.pod.faulted:
+                    info_types = [PULSE_LOG_PLUS]
+                elif previous:
+                    info_types = [PULSE_LOG_PREVIOUS, PULSE_LOG_RECENT]
+                else:
+                    info_types = [PULSE_LOG_RECENT]
+
+                # all parts are read in one connection, the last request lets the radio disconnect
+                responses = [self._request_information(info_type, stay_connected=i < len(info_types) - 1)
+                             for i, info_type in enumerate(info_types)]
+                log = PulseLog.from_responses(responses)
+
+                if self.pod.path is not None:
+                    path = self.pod.path + POD_PULSE_LOG_SUFFIX
+                    stored = None
+                    if os.path.isfile(path):
+                        stored = PulseLog.load(path, self.pod.lot, self.pod.tid)
+                    if stored is not None:
+                        stored.merge(log)
+                        log = stored
+                    log.save(path, self.pod.lot, self.pod.tid)
+                self.pod.pulse_log_updated = log.updated
+                self.pod.pulse_log_last_pulse = log.summary()["last_pulse"]
+                return log
+
+        except OmnipyError:
+            raise
+        except Exception as e:
+            raise PdmError("Unexpected error") from e
+
+    def _cancel_temp_basal(self, beep=False):
+        self.logger.debug("Canceling temp basal")
+        self._cancelActivity(cancelTempBasal=True, beep=beep)
+        if self.pod.basalState == BasalState.TempBasal:
+            raise PdmError("Failed to cancel temp basal")
+        self.pod.last_enacted_temp_basal_duration = float(-1)
+        self.pod.last_enacted_temp_basal_start = time.time()
+        self.pod.last_enacted_temp_basal_amount = float(-1)
 
     def _cancelActivity(self, cancelBasal=False, cancelBolus=False, cancelTempBasal=False, beep=False):
-        self.logger.debug("Running cancel activity for basal: %s - bolus: %s - tempBasal: %s" % (
-        cancelBasal, cancelBolus, cancelTempBasal))
+        self.logger.debug("Running cancel activity for basal: %s - bolus: %s - tempBasal: %s",
+                          cancelBasal, cancelBolus, cancelTempBasal)
         commandBody = struct.pack(">I", 0)
         if beep:
             c = 0x60
@@ -424,6 +533,12 @@ class Pdm:
         msg.addCommand(commandType, commandBody)
         return msg
 
+    def _end_operation(self, save=True):
+        self.radio.disconnect()
+        if save:
+            self._savePod()
+
+    @traced("pdm.save")
     def _savePod(self):
         try:
             self.logger.debug("Saving pod status")
@@ -431,7 +546,9 @@ class Pdm:
             self.pod.packetSequence = self.radio.packetSequence
             self.pod.lastNonce = self.nonce.lastNonce
             self.pod.nonceSeed = self.nonce.seed
+            self.pod.radio_link_quality = get_link_quality(self.pod.address).summary()
             self.pod.Save()
+            self.journal.checkpoint()
             self.logger.debug("Saved pod status")
         except Exception as e:
             raise PdmError("Pod status was not saved") from e
@@ -439,14 +556,21 @@ class Pdm:
     def _sendMessage(self, message, with_nonce=False, nonce_retry_count=0, stay_connected=False, request_msg=None,
                      resync_allowed=True):
         requested_stay_connected = stay_connected
+        if self.session_depth > 0:
+            stay_connected = True
         if with_nonce:
+            self.nonce_reservation.reserve(self.nonce)
             nonce = self.nonce.getNext()
             if nonce == FAKE_NONCE:
                 stay_connected = True
             message.setNonce(nonce)
+        entry_id = self.journal.begin(message, request_msg, self.nonce.lastNonce if with_nonce else None,
+                                      self._get_radio_state(), self.pod)
         try:
             response_message = self.radio.send_request_get_response(message, stay_connected=stay_connected)
+            self.journal.end(entry_id, "received", self._get_radio_state())
         except TransmissionOutOfSyncError:
+            self.journal.end(entry_id, "out_of_sync", self._get_radio_state())
             if resync_allowed:
                 self._interim_resync()
                 return self._sendMessage(message, with_nonce=with_nonce, nonce_retry_count=nonce_retry_count,
@@ -454,35 +578,77 @@ class Pdm:
                                          resync_allowed=False)
             else:
                 raise
+        except Exception:
+            self.journal.end(entry_id, "failed", self._get_radio_state())
+            raise
 
-        contents = response_message.getContents()
-        for (ctype, content) in contents:
-            # if ctype == 0x01:  # pod info response
-            #     self.pod.setupPod(content)
-            if ctype == 0x1d:  # status response
-                self.pod.handle_status_response(content, original_request=request_msg)
-            elif ctype == 0x02:  # pod faulted or information
-                self.pod.handle_information_response(content, original_request=request_msg)
-            elif ctype == 0x06:
-                if content[0] == 0x14:  # bad nonce error
-                    if nonce_retry_count == 0:
-                        self.logger.debug("Bad nonce error - renegotiating")
-                    elif nonce_retry_count > 3:
-                        raise PdmError("Nonce re-negotiation failed")
-                    nonce_sync_word = struct.unpack(">H", content[1:])[0]
-                    self.nonce.sync(nonce_sync_word, message.sequence)
-                    self.radio.messageSequence = message.sequence
-                    return self._sendMessage(message, with_nonce=True, nonce_retry_count=nonce_retry_count + 1,
-                                             stay_connected=requested_stay_connected, request_msg=request_msg)
+        records = [decode_content(ctype, content) for ctype, content in response_message.getContents()]
+        for record in records:
+            if isinstance(record, ErrorResponse) and record.is_bad_nonce():
+                PDM_NONCE_RESYNCS.inc()
+                if nonce_retry_count == 0:
+                    self.logger.debug("Bad nonce error - renegotiating")
+                elif nonce_retry_count > 3:
+                    raise PdmError("Nonce re-negotiation failed")
+                self.nonce.sync(record.word, message.sequence)
+                self.radio.messageSequence = message.sequence
+                return self._sendMessage(message, with_nonce=True, nonce_retry_count=nonce_retry_count + 1,
+                                         stay_connected=requested_stay_connected, request_msg=request_msg)
+            elif record is not None:
+                self.pod.handle_response(record, original_request=request_msg)
+        return records
+
+    def _get_radio_state(self):
+        return {"msgSequence": self.radio.messageSequence,
+                "packetSequence": self.radio.packetSequence,
+                "lastNonce": self.nonce.lastNonce,
+                "nonceSeed": self.nonce.seed}
+
+    def _restore_radio_state(self, state):
+        self.radio.messageSequence = state["msgSequence"]
+        self.radio.packetSequence = state["packetSequence"]
+        self.nonce = Nonce(self.pod.lot, self.pod.tid, seekNonce=state["lastNonce"], seed=state["nonceSeed"])
+
+    def _fast_forward_nonce(self):
+        # the pod file is only saved after a command, if that never happened the pod has seen newer nonces
+        state = self.journal.last_nonce_state
+        if state is not None:
+            self.nonce = Nonce(self.pod.lot, self.pod.tid, seekNonce=state["lastNonce"], seed=state["nonceSeed"])
+            self.logger.info("Nonce fast-forwarded to the last journaled message")
+        elif self.nonce_reservation.is_ahead_of(self.nonce):
+            self.nonce = self.nonce_reservation.get_nonce()
+            self.logger.info("Nonce fast-forwarded past the block reserved after the pod was saved")
+
+    def _was_enacted(self, begin):
+        before = begin["pod"]
+        for ctype, content in begin["contents"]:
+            content = bytes.fromhex(content)
+            if ctype == 0x17:
+                return self.pod.totalInsulin > before["totalInsulin"] or self.pod.bolusState == BolusState.Immediate
+            elif ctype == 0x16:
+                return self.pod.basalState == BasalState.TempBasal
+            elif ctype == 0x1f:
+                if content[4] & 0x04 and self.pod.bolusState == BolusState.Immediate:
+                    return False
+                if content[4] & 0x02 and self.pod.basalState == BasalState.TempBasal:
+                    return False
+                return True
+            elif ctype == 0x11:
+                return self.pod.alert_states & content[4] == 0
+            elif ctype == 0x1c:
+                return self.pod.progress == PodProgress.Inactive
+            elif ctype == 0x0e:
+                return True
+        return None
 
+    @traced("pdm.resync")
     def _interim_resync(self):
-        time.sleep(15)
+        self.radio.wait_for_silence()
         commandType = 0x0e
         commandBody = bytes([0])
         msg = self._createMessage(commandType, commandBody)
         self._sendMessage(msg, stay_connected=True, request_msg="STATUS REQ %d" % 0,
                           resync_allowed=True)
-        time.sleep(5)
 
     def _update_status(self, update_type=0, stay_connected=True):
         commandType = 0x0e
@@ -490,6 +656,14 @@ class Pdm:
         msg = self._createMessage(commandType, commandBody)
         self._sendMessage(msg, stay_connected=stay_connected, request_msg="STATUS REQ %d" % update_type)
 
+    def _request_information(self, info_type, stay_connected=True):
+        msg = self._createMessage(0x0e, bytes([info_type]))
+        records = self._sendMessage(msg, stay_connected=stay_connected, request_msg="STATUS REQ %d" % info_type)
+        for record in records:
+            if isinstance(record, InformationRecord) and record.info_type == info_type:
+                return record
+        raise PdmError("Pod did not return information of type 0x%02x" % info_type)
+
     def _acknowledge_alerts(self, alert_mask):
         commandType = 0x11
         commandBody = bytes([0, 0, 0, 0, alert_mask])
@@ -75,10 +75,7 @@ def getRepeatCount(pulse, otherPulses):
 
 
 def getStringBodyFromTable(table):
-    st = bytes()
-    for val in table:
-        st += struct.pack(">H", val)
-    return st
+    return struct.pack(">%dH" % len(table), *table)
 
 
 def getChecksum(body):
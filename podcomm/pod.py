@@ -1,9 +1,7 @@
-from .exceptions import ProtocolError
 from .definitions import *
 import simplejson as json
-import struct
 from datetime import datetime, timedelta
-import binascii
+import os
 import time
 
 
@@ -29,6 +27,7 @@ class Pod:
         self.fault_progress_before = None
         self.radio_low_gain = None
         self.radio_rssi = None
+        self.radio_link_quality = None
         self.fault_progress_before_2 = None
         self.information_type2_last_word = None
 
@@ -58,14 +57,27 @@ class Pod:
         self.last_enacted_bolus_start = None
         self.last_enacted_bolus_amount = None
 
+        self.pulse_log_updated = None
+        self.pulse_log_last_pulse = None
+
     def Save(self, save_as = None):
         if save_as is not None:
             self.path = save_as
             self.log_file_path = save_as + POD_LOG_SUFFIX
         if self.path is None:
             raise ValueError("No filename given")
-        with open(self.path, "w") as stream:
+        # the command journal is cleared after a save, so the file must be complete and on disk by then
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as stream:
             json.dump(self.__dict__, stream, indent=4, sort_keys=True)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
 
     @staticmethod
     def Load(path, log_file_path=None):
@@ -97,6 +109,7 @@ class Pod:
             p.fault_progress_before = d["fault_progress_before"]
             p.radio_low_gain = d["radio_low_gain"]
             p.radio_rssi = d["radio_rssi"]
+            p.radio_link_quality = d.get("radio_link_quality")
             p.fault_progress_before_2 = d["fault_progress_before_2"]
             p.information_type2_last_word = d["information_type2_last_word"]
 
@@ -124,6 +137,9 @@ class Pod:
             p.last_enacted_bolus_start = d["last_enacted_bolus_start"]
             p.last_enacted_bolus_amount = d["last_enacted_bolus_amount"]
 
+            p.pulse_log_updated = d.get("pulse_log_updated")
+            p.pulse_log_last_pulse = d.get("pulse_log_last_pulse")
+
         return p
 
     def is_active(self):
@@ -131,75 +147,23 @@ class Pod:
             and (self.progress == PodProgress.Running or self.progress == PodProgress.RunningLow) \
             and not self.faulted
 
+    def is_bolus_running(self):
+        # estimated from the stored state only, Pdm.is_busy asks the pod when the estimate is not conclusive
+        if self.lastUpdated is not None and self.bolusState != BolusState.Immediate:
+            return False
+        if self.last_enacted_bolus_amount is None or self.last_enacted_bolus_start is None:
+            return self.bolusState == BolusState.Immediate
+        if self.last_enacted_bolus_amount < 0:
+            return False
+        return time.time() <= (self.last_enacted_bolus_amount * 45) + 10 + self.last_enacted_bolus_start
+
     def setupPod(self, messageBody):
         pass
 
-    def handle_information_response(self, response, original_request=None):
-        if response[0] == 0x01:
-            pass
-        elif response[0] == 0x02:
-            self.faulted = True
-            self.progress = response[1]
-            self.__parse_delivery_state(response[2])
-            self.canceledInsulin = struct.unpack(">H", response[3:5])[0] * 0.05
-            self.msgSequence = response[5]
-            self.totalInsulin = struct.unpack(">H", response[6:8])[0] * 0.05
-            self.fault_event = response[8]
-            self.fault_event_rel_time = struct.unpack(">H", response[9:11])[0]
-            self.reservoir = struct.unpack(">H", response[11:13])[0] * 0.05
-            self.minutes_since_activation = struct.unpack(">H", response[13:15])[0]
-            self.alert_states = response[15]
-            self.fault_table_access = response[16]
-            self.fault_insulin_state_table_corruption = response[17] >> 7
-            self.fault_internal_variables = (response[17] & 0x60) >> 6
-            self.fault_immediate_bolus_in_progress = (response[17] & 0x10) >> 4
-            self.fault_progress_before = (response[17] & 0x0F)
-            self.radio_low_gain = (response[18] & 0xC0) >> 6
-            self.radio_rssi = response[18] & 0x3F
-            self.fault_progress_before_2 = (response[19] & 0x0F)
-            self.information_type2_last_word = struct.unpack(">H", response[20:22])[0]
-        elif response[0] == 0x03:
-            pass
-        elif response[0] == 0x05:
-            pass
-        elif response[0] == 0x06:
-            pass
-        elif response[0] == 0x46:
-            pass
-        elif response[0] == 0x50:
-            pass
-        elif response[0] == 0x51:
-            pass
-        else:
-            raise ProtocolError("Failed to parse the information response of type 0x%2X with content: %s"
-                                % (response[0], binascii.hexlify(response)))
-
-        self._save_with_log(original_request)
-
-    def handle_status_response(self, response, original_request=None):
-        s = struct.unpack(">BII", response)
-        state = s[0]
-        insulin_pulses = (s[1] & 0x0FFF8000) >> 15
-        msg_sequence = (s[1] & 0x00007800) >> 11
-        canceled_pulses = s[1] & 0x000007FF
-
-        self.faulted = ((s[2] >> 31) != 0)
-        pod_alarm = (s[2] >> 23) & 0xFF
-        pod_active_time = (s[2] & 0x007FFC00) >> 10
-        pod_reservoir = s[2] & 0x000003FF
-
-        self.__parse_delivery_state(state >> 4)
-
-        self.progress = state & 0xF
-
-        self.alert_states = pod_alarm
-        self.reservoir = pod_reservoir * 0.05
-        self.msgSequence = msg_sequence
-        self.totalInsulin = insulin_pulses * 0.05
-        self.canceledInsulin = canceled_pulses * 0.05
-        self.minutes_since_activation = pod_active_time
-        self.lastUpdated = time.time()
-        self._save_with_log(original_request)
+    def handle_response(self, record, original_request=None):
+        record.apply(self)
+        if record.saves_pod:
+            self._save_with_log(original_request)
 
     def _save_with_log(self, original_request):
         ds = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
@@ -215,21 +179,6 @@ class Pod:
                   BolusState(self.bolusState).name, BasalState(self.basalState).name, self.reservoir, self.alert_states,
                   self.faulted, self.lot, self.tid, self.address))
 
-    def __parse_delivery_state(self, delivery_state):
-        if delivery_state & 8 > 0:
-            self.bolusState = BolusState.Extended
-        elif delivery_state & 4 > 0:
-            self.bolusState = BolusState.Immediate
-        else:
-            self.bolusState = BolusState.NotRunning
-
-        if delivery_state & 2 > 0:
-            self.basalState = BasalState.TempBasal
-        elif delivery_state & 1 > 0:
-            self.basalState = BasalState.Program
-        else:
-            self.basalState = BasalState.NotRunning
-
     def __str__(self):
         p = self
         state = "Lot %d Tid %d Address 0x%8X Faulted: %s\n" % (p.lot, p.tid, p.address, p.faulted)
@@ -0,0 +1,79 @@
+from .definitions import *
+from .pod import Pod
+import os
+import re
+from datetime import datetime
+
+POD_ID_PATTERN = re.compile("^[0-9a-f]{8}$")
+
+
+def get_pod_id(address):
+    return "%08x" % address
+
+
+def normalize_pod_id(pod_id):
+    if pod_id is None:
+        return None
+    pod_id = pod_id.lower()
+    if POD_ID_PATTERN.match(pod_id) is None:
+        raise ValueError("Invalid pod id: %s" % pod_id)
+    return pod_id
+
+
+def get_pod_path(pod_id=None):
+    if pod_id is None:
+        return POD_FILE + POD_FILE_SUFFIX
+    return os.path.join(PODS_DIR, normalize_pod_id(pod_id) + POD_FILE_SUFFIX)
+
+
+def get_log_path(pod_id=None):
+    if pod_id is None:
+        return POD_FILE + POD_LOG_SUFFIX
+    return os.path.join(PODS_DIR, normalize_pod_id(pod_id) + POD_LOG_SUFFIX)
+
+
+def pod_exists(pod_id=None):
+    return os.path.isfile(get_pod_path(pod_id))
+
+
+def load_pod(pod_id=None):
+    return Pod.Load(get_pod_path(pod_id), get_log_path(pod_id))
+
+
+def save_new_pod(pod, pod_id=None):
+    if pod_id is not None:
+        os.makedirs(PODS_DIR, exist_ok=True)
+    archive_pod(pod_id)
+    pod.Save(get_pod_path(pod_id))
+
+
+def archive_pod(pod_id=None):
+    archive_suffix = datetime.utcnow().strftime("_%Y%m%d_%H%M%S")
+    pod_path = get_pod_path(pod_id)
+    log_path = get_log_path(pod_id)
+    base = pod_path[:-len(POD_FILE_SUFFIX)]
+    if os.path.isfile(pod_path):
+        os.rename(pod_path, base + archive_suffix + POD_FILE_SUFFIX)
+    if os.path.isfile(log_path):
+        os.rename(log_path, base + archive_suffix + POD_LOG_SUFFIX)
+    # state kept next to the pod file moves with it, a new pod stored under the same path must not pick it up
+    for suffix in (POD_JOURNAL_SUFFIX, POD_NONCE_SUFFIX, POD_PULSE_LOG_SUFFIX):
+        if os.path.isfile(pod_path + suffix):
+            os.rename(pod_path + suffix, base + archive_suffix + POD_FILE_SUFFIX + suffix)
+
+
+def remove_radio_state(pod_id=None):
+    # journaled and reserved nonces belong to the old pod parameters
+    pod_path = get_pod_path(pod_id)
+    for suffix in (POD_JOURNAL_SUFFIX, POD_NONCE_SUFFIX):
+        if os.path.isfile(pod_path + suffix):
+            os.remove(pod_path + suffix)
+
+
+def list_pod_ids():
+    pod_ids = []
+    if os.path.isdir(PODS_DIR):
+        for name in sorted(os.listdir(PODS_DIR)):
+            if name.endswith(POD_FILE_SUFFIX) and POD_ID_PATTERN.match(name[:-len(POD_FILE_SUFFIX)]):
+                pod_ids.append(name[:-len(POD_FILE_SUFFIX)])
+    return pod_ids
@@ -0,0 +1,109 @@
+from .definitions import *
+import numpy as np
+import os
+import time
+
+PULSE_LOG_PLUS = 0x03
+PULSE_LOG_RECENT = 0x50
+PULSE_LOG_PREVIOUS = 0x51
+
+# bit legend of a pulse log entry as documented by the openomni project, most significant bit first:
+#   eeeeee0a pppliiib cccccccc dfgggggg
+# field names follow the letters of the legend
+PULSE_LOG_FIELDS = (("e", 26, 6), ("a", 24, 1), ("p", 21, 3), ("l", 20, 1), ("i", 17, 3),
+                    ("b", 16, 1), ("c", 8, 8), ("d", 7, 1), ("f", 6, 1), ("g", 0, 6))
+PULSE_LOG_SHIFTS = np.array([shift for _, shift, _ in PULSE_LOG_FIELDS], dtype=np.uint32)
+PULSE_LOG_MASKS = np.array([(1 << width) - 1 for _, _, width in PULSE_LOG_FIELDS], dtype=np.uint32)
+
+
+def decode_entries(entries):
+    # all fields of all entries in one pass, one column per field
+    return ((entries[:, np.newaxis] >> PULSE_LOG_SHIFTS) & PULSE_LOG_MASKS).astype(np.uint8)
+
+
+class PulseLog:
+    def __init__(self, pulses=None, entries=None, updated=None):
+        self.pulses = np.zeros(0, dtype=np.int64) if pulses is None else pulses
+        self.entries = np.zeros(0, dtype=np.uint32) if entries is None else entries
+        self.updated = updated
+        self.fault = None
+
+    @staticmethod
+    def from_responses(records):
+        log = PulseLog(updated=time.time())
+        recent = None
+        previous = None
+        for record in records:
+            entries = np.frombuffer(record.data, dtype=">u4").astype(np.uint32)
+            if record.info_type == PULSE_LOG_RECENT:
+                recent = record.last_pulse, entries
+            elif record.info_type == PULSE_LOG_PREVIOUS:
+                previous = entries[:record.count]
+            else:
+                log.fault = {"fault_event": record.fault_event, "fault_minutes": record.fault_minutes,
+                             "pod_minutes": record.pod_minutes}
+                # the plus log carries no pulse numbers, entries are numbered up to zero
+                log.pulses = np.arange(-len(entries) + 1, 1, dtype=np.int64)
+                log.entries = entries
+
+        if recent is not None:
+            last_pulse, entries = recent
+            if previous is not None:
+                entries = np.concatenate((previous, entries))
+            log.pulses = np.arange(last_pulse - len(entries) + 1, last_pulse + 1, dtype=np.int64)
+            log.entries = entries
+        return log
+
+    @staticmethod
+    def load(path, lot, tid):
+        # pulse numbers start over with every pod, entries of another pod are not merged
+        with np.load(path) as stored:
+            if "pod" not in stored.files or stored["pod"].tolist() != [lot, tid]:
+                return None
+            return PulseLog(stored["pulses"], stored["entries"], float(stored["updated"]))
+
+    def save(self, path, lot, tid):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as stream:
+            np.savez(stream, pulses=self.pulses, entries=self.entries,
+                     updated=np.float64(self.updated or 0), pod=np.array([lot, tid], dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    def merge(self, other):
+        # entries read again overwrite the stored ones, plus logs without pulse numbers are not merged
+        if other.fault is not None or len(self.pulses) == 0:
+            self.pulses, self.entries = other.pulses, other.entries
+        elif len(other.pulses) > 0:
+            pulses = np.concatenate((other.pulses, self.pulses))
+            entries = np.concatenate((other.entries, self.entries))
+            pulses, index = np.unique(pulses, return_index=True)
+            self.pulses, self.entries = pulses, entries[index]
+        self.updated = other.updated
+        self.fault = other.fault
+
+    def fields(self):
+        return decode_entries(self.entries)
+
+    def summary(self):
+        d = {"updated": self.updated,
+             "entry_count": int(len(self.entries)),
+             "first_pulse": None,
+             "last_pulse": None,
+             "missing_pulses": 0,
+             "insulin": None,
+             "fault": self.fault}
+        if len(self.pulses) > 0 and self.fault is None:
+            d["first_pulse"] = int(self.pulses[0])
+            d["last_pulse"] = int(self.pulses[-1])
+            d["missing_pulses"] = int(self.pulses[-1] - self.pulses[0] + 1 - len(self.pulses))
+            d["insulin"] = float(self.pulses[-1]) * 0.05
+        return d
+
+    def as_dict(self, with_entries=False):
+        d = self.summary()
+        if with_entries:
+            d["pulses"] = self.pulses.tolist()
+            d["entries"] = ["%08x" % e for e in self.entries.tolist()]
+            fields = self.fields()
+            d["fields"] = {name: fields[:, i].tolist() for i, (name, _, _) in enumerate(PULSE_LOG_FIELDS)}
+        return d
@@ -1,21 +1,89 @@
 import threading
-from .exceptions import ProtocolError, RileyLinkError, TransmissionOutOfSyncError
+import time
+from contextlib import nullcontext
+from .exceptions import OmnipyError, ProtocolError, RileyLinkError, TransmissionOutOfSyncError
 from podcomm import crc
 from podcomm.rileylink import RileyLink
+from podcomm.scheduler import SharedRileyLink
 from .message import Message, MessageState
 from .packet import Packet
 from .definitions import *
+from .trace import span, traced
+from .linkquality import decode_rssi, get_link_quality
+from .metrics import measured, RADIO_EXCHANGES, RADIO_RETRIES, RADIO_TIMEOUTS, RADIO_RESYNCS, \
+    RADIO_EXCHANGE_SECONDS, RADIO_MESSAGE_SECONDS, RADIO_DIVERSITY_RECEPTIONS, RADIO_INVALID_PACKETS, \
+    RADIO_RSSI_DBM
+
+
+class DiversityReception:
+    # both rileylinks offer the reply they hear, the first one offered wins
+    def __init__(self, address, packet_type, sequence):
+        self.address = address
+        self.packet_type = packet_type
+        self.sequence = sequence
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.received = None
+        self.receiver = None
+
+    def matches(self, data):
+        p = Radio._get_packet(data)
+        return p is not None and p.address == self.address and p.type == self.packet_type \
+            and p.sequence == self.sequence
+
+    def offer(self, data, receiver):
+        with self.lock:
+            if self.done.is_set():
+                return False
+            self.received = data
+            self.receiver = receiver
+            self.done.set()
+            return True
+
+    def close(self):
+        with self.lock:
+            self.done.set()
+
+
+class DiversityListener:
+    def __init__(self, rileylink, reception):
+        self.rileylink = rileylink
+        self.reception = reception
+        self.thread = threading.Thread(target=self._listen, name="omnipy-diversity", daemon=True)
+        self.logger = getLogger()
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def _listen(self):
+        try:
+            while not self.reception.done.is_set():
+                data = self.rileylink.get_packet(DIVERSITY_LISTEN_WINDOW)
+                if data is not None and self.reception.matches(data):
+                    self.reception.offer(data, self.rileylink)
+                    return
+        except OmnipyError as e:
+            self.logger.warning("Diversity listener stopped: %s", e)
 
 
 class Radio:
-    def __init__(self, msg_sequence=0, pkt_sequence=0):
+    def __init__(self, msg_sequence=0, pkt_sequence=0, rileylink=None, listener=None):
         self.stopRadioEvent = threading.Event()
         self.messageSequence = msg_sequence
         self.packetSequence = pkt_sequence
         self.lastPacketReceived = None
         self.logger = getLogger()
-        self.rileyLink = RileyLink()
+        if rileylink is None:
+            rileylink = RileyLink()
+        self.rileyLink = rileylink
+        self.listener = listener
+        self.active_listener = None
         self.last_packet_received = None
+        self.last_receiver = None
+        self.packet_counters = {}
 
     def send_request_get_response(self, message, stay_connected=True):
         try:
@@ -29,8 +97,32 @@ class Radio:
     def disconnect(self):
         try:
             self.rileyLink.disconnect(ignore_errors=True)
+            if self.listener is not None:
+                self._join_listener()
+                self.listener.disconnect(ignore_errors=True)
         except Exception as e:
-            self.logger.warning("Error while disconnecting %s" % str(e))
+            self.logger.warning("Error while disconnecting %s", e)
+
+    def hold(self):
+        # a rileylink shared through the scheduler is kept from capture and other pods until the session ends
+        if isinstance(self.rileyLink, SharedRileyLink):
+            return self.rileyLink.hold()
+        return nullcontext()
+
+    @traced("radio.wait_silence")
+    def wait_for_silence(self, window=RADIO_SILENCE_WINDOW, max_wait=RADIO_SILENCE_MAX_WAIT):
+        deadline = time.time() + max_wait
+        try:
+            while time.time() < deadline:
+                received = self.rileyLink.get_packet(window)
+                if received is None:
+                    self.logger.debug("Channel is silent")
+                    return True
+                self.logger.debug("Pod is still transmitting: %s", Lazy(bytes.hex, received))
+        except RileyLinkError as rle:
+            raise ProtocolError("Radio error while waiting for silence") from rle
+        self.logger.warning("Channel did not become silent in %d seconds", max_wait)
+        return False
 
     def _send_request_get_response(self, message, stay_connected=True):
         try:
@@ -42,9 +134,11 @@ class Radio:
             if not stay_connected:
                 self.rileyLink.disconnect()
 
+    @traced("radio.message")
+    @measured(RADIO_MESSAGE_SECONDS)
     def _send_request(self, message):
         message.setSequence(self.messageSequence)
-        self.logger.debug("SENDING MSG: %s" % message)
+        self.logger.debug("SENDING MSG: %s", snapshot(message))
         packets = message.getPackets()
         received = None
         packet_index = 1
@@ -77,7 +171,7 @@ class Radio:
         if pod_response.state == MessageState.Invalid:
             raise ProtocolError("Received message is not valid")
 
-        self.logger.debug("RECEIVED MSG: %s" % pod_response)
+        self.logger.debug("RECEIVED MSG: %s", snapshot(pod_response))
 
         self.logger.debug("Sending end of conversation")
         ack_packet = Packet.Ack(message.address, True)
@@ -87,65 +181,157 @@ class Radio:
         self.messageSequence = (pod_response.sequence + 1) % 16
         return pod_response
 
+    @traced("radio.exchange")
+    @measured(RADIO_EXCHANGE_SECONDS)
     def _exchange_packets(self, packet_to_send, expected_type):
         packet_to_send.setSequence(self.packetSequence)
         expected_sequence = (self.packetSequence + 1) % 32
         expected_address = packet_to_send.address
+        link_quality = get_link_quality(expected_address)
         send_retries = 3
-        while send_retries > 0:
-            try:
-                self.logger.debug("SENDING PACKET EXP RESPONSE: %s" % packet_to_send)
-                data = packet_to_send.data
-                data += bytes([crc.crc8(data)])
-
-                if packet_to_send.type == "PDM":
-                    send_retries -= 1
-                    received = self.rileyLink.send_and_receive_packet(data, 0, 300, 300, 10, 80)
-                else:
-                    received = self.rileyLink.send_and_receive_packet(data, 0, 20, 300, 10, 20)
+        if link_quality.is_degraded():
+            self.logger.debug("Allowing more retries on a degraded link: %s", Lazy(link_quality.describe))
+            send_retries = LINK_QUALITY_DEGRADED_RETRIES
+        attempts = 0
+        timeouts = 0
+        invalid = 0
+        missed = 0
+        rssi = None
+        success = False
+        start = time.time()
+        RADIO_EXCHANGES.inc()
+        try:
+            while send_retries > 0:
+                try:
+                    if attempts > 0:
+                        RADIO_RETRIES.inc()
+                    attempts += 1
+                    self.logger.debug("SENDING PACKET EXP RESPONSE: %s", snapshot(packet_to_send))
+                    data = packet_to_send.data
+                    data += bytes([crc.crc8(data)])
 
-                if received is None:
-                    self.logger.debug("Received nothing")
-                    continue
-                p = self._get_packet(received)
-                if p is None:
-                    self.logger.debug("Received illegal packet")
-                    continue
-                if p.address != expected_address:
-                    self.logger.debug("Received packet for a different address")
-                    continue
+                    if packet_to_send.type == "PDM":
+                        send_retries -= 1
+                        received = self._send_and_receive(data, packet_to_send.address, expected_type,
+                                                          expected_sequence, 0, 300, 300, 10, 80)
+                    else:
+                        received = self._send_and_receive(data, packet_to_send.address, expected_type,
+                                                          expected_sequence, 0, 20, 300, 10, 20)
+
+                    if received is None:
+                        RADIO_TIMEOUTS.inc()
+                        timeouts += 1
+                        self.logger.debug("Received nothing")
+                        continue
+                    missed += self._count_missed(received)
+                    p = self._get_packet(received)
+                    if p is None:
+                        RADIO_INVALID_PACKETS.inc()
+                        invalid += 1
+                        self.logger.debug("Received illegal packet")
+                        continue
+                    if p.address != expected_address:
+                        self.logger.debug("Received packet for a different address")
+                        continue
+                    rssi = decode_rssi(received[0])
+                    RADIO_RSSI_DBM.observe(rssi)
+
+                    if p.type != expected_type or p.sequence != expected_sequence:
+                        if self.last_packet_received is not None:
+                            if p.type == self.last_packet_received.type and \
+                                    p.sequence == self.last_packet_received.sequence:
+                                self.logger.debug("Received previous response")
+                                continue
+
+                        self.logger.debug("Resynchronization requested")
+                        RADIO_RESYNCS.inc()
+                        self.packetSequence = (p.sequence + 1) % 32
+                        self.messageSequence = 0
+                        success = True
+                        raise TransmissionOutOfSyncError()
+
+                    self.packetSequence = (self.packetSequence + 2) % 32
+                    self.last_packet_received = p
+                    self.logger.debug("SEND AND RECEIVE complete")
+                    success = True
+                    return p
+                except RileyLinkError as rle:
+                    raise ProtocolError("Radio error during send and receive") from rle
+            else:
+                raise ProtocolError("Exceeded retry count while send and receive, %s"
+                                    % self._describe_link(link_quality, attempts, timeouts, invalid))
+        finally:
+            link_quality.record(rssi, attempts, timeouts, invalid, missed, time.time() - start, success)
+
+    def _count_missed(self, received):
+        # the second byte is the rileylink's receive counter, gaps are packets it heard but did not report
+        if len(received) < 2:
+            return 0
+        receiver = id(self.last_receiver)
+        last_counter = self.packet_counters.get(receiver)
+        self.packet_counters[receiver] = received[1]
+        if last_counter is None:
+            return 0
+        gap = (received[1] - last_counter - 1) % 256
+        if gap > LINK_QUALITY_MAX_COUNTER_GAP:
+            return 0
+        return gap
+
+    @staticmethod
+    def _describe_link(link_quality, attempts, timeouts, invalid):
+        if timeouts + invalid == attempts:
+            problem = "no valid reply in %d attempts (%d timeouts, %d corrupt), likely an RF problem" \
+                      % (attempts, timeouts, invalid)
+        else:
+            problem = "pod replied but not as expected, likely a protocol problem"
+        return "%s; %s" % (problem, link_quality.describe())
+
+    def _send_and_receive(self, data, address, expected_type, expected_sequence, *params):
+        self.last_receiver = self.rileyLink
+        if self.listener is None:
+            return self.rileyLink.send_and_receive_packet(data, *params)
 
-                if p.type != expected_type or p.sequence != expected_sequence:
-                    if self.last_packet_received is not None:
-                        if p.type == self.last_packet_received.type and \
-                                p.sequence == self.last_packet_received.sequence:
-                            self.logger.debug("Received previous response")
-                            continue
-
-                    self.logger.debug("Resynchronization requested")
-                    self.packetSequence = (p.sequence + 1) % 32
-                    self.messageSequence = 0
-                    raise TransmissionOutOfSyncError()
-
-                self.packetSequence = (self.packetSequence + 2) % 32
-                self.last_packet_received = p
-                self.logger.debug("SEND AND RECEIVE complete")
-                return p
-            except RileyLinkError as rle:
-                raise ProtocolError("Radio error during send and receive") from rle
+        # a listener of an earlier exchange is not waited for, it sees its reception closed and ends by itself
+        reception = DiversityReception(address, expected_type, expected_sequence)
+        self.active_listener = DiversityListener(self.listener, reception)
+        self.active_listener.start()
+        try:
+            received = self.rileyLink.send_and_receive_packet(data, *params)
+        except Exception:
+            reception.close()
+            raise
+
+        if self._get_packet(received) is None:
+            # the listener may still be hearing the reply the primary missed
+            reception.done.wait(DIVERSITY_LISTEN_WINDOW)
         else:
-            raise ProtocolError("Exceeded retry count while send and receive")
+            reception.offer(received, self.rileyLink)
+        reception.close()
+
+        if reception.receiver is self.listener:
+            self.logger.debug("Using reply received by the listening RileyLink")
+            RADIO_DIVERSITY_RECEPTIONS.inc()
+            self.last_receiver = self.listener
+            return reception.received
+        return received
+
+    def _join_listener(self):
+        if self.active_listener is not None:
+            self.active_listener.join()
+            self.active_listener = None
 
+    @traced("radio.final")
     def _send_packet(self, packetToSend):
         packetToSend.setSequence(self.packetSequence)
         try:
             data = packetToSend.data
             data += bytes([crc.crc8(data)])
             while True:
-                self.logger.debug("SENDING FINAL PACKET: %s" % packetToSend)
+                self.logger.debug("SENDING FINAL PACKET: %s", snapshot(packetToSend))
                 received = self.rileyLink.send_and_receive_packet(data, 0, 20, 1000, 2, 40)
                 if received is None:
-                    received = self.rileyLink.get_packet(2.5)
+                    with span("radio.silence"):
+                        received = self.rileyLink.get_packet(RADIO_SILENCE_WINDOW)
                     if received is None:
                         self.logger.debug("Silence has fallen")
                         break
@@ -162,6 +348,7 @@ class Radio:
                         self.logger.debug("Received previous response")
                         continue
                 self.logger.warning("Resynchronization requested")
+                RADIO_RESYNCS.inc()
                 self.packetSequence = (self.packetSequence + 1) % 32
                 self.messageSequence = 0
                 raise TransmissionOutOfSyncError()
@@ -179,7 +366,7 @@ class Radio:
             if data[-1] == calc:
                 try:
                     p = Packet.from_data(data[2:-1])
-                    getLogger().debug("RECEIVED PACKET: %s" % p)
+                    getLogger().debug("RECEIVED PACKET: %s", snapshot(p))
                 except ProtocolError as pe:
-                    getLogger().warning("Crc match on an invalid packet, error: %s" % pe)
+                    getLogger().warning("Crc match on an invalid packet, error: %s", pe)
         return p
@@ -0,0 +1,235 @@
+from .definitions import *
+from .exceptions import ProtocolError
+import binascii
+import struct
+import time
+
+_decoders = {}
+
+
+def register(content_type, info_type=None):
+    def decorator(record_class):
+        _decoders[(content_type, info_type)] = record_class
+        return record_class
+    return decorator
+
+
+def decode_content(content_type, content):
+    info_type = None
+    if content_type == 0x02:
+        if len(content) == 0:
+            raise ProtocolError("Empty information response")
+        info_type = content[0]
+    record_class = _decoders.get((content_type, info_type))
+    if record_class is None:
+        if info_type is not None:
+            raise ProtocolError("Failed to parse the information response of type 0x%2X with content: %s"
+                                % (info_type, binascii.hexlify(content)))
+        return None
+    return record_class.decode(content)
+
+
+def get_delivery_states(delivery_state):
+    if delivery_state & 8 > 0:
+        bolus_state = BolusState.Extended
+    elif delivery_state & 4 > 0:
+        bolus_state = BolusState.Immediate
+    else:
+        bolus_state = BolusState.NotRunning
+
+    if delivery_state & 2 > 0:
+        basal_state = BasalState.TempBasal
+    elif delivery_state & 1 > 0:
+        basal_state = BasalState.Program
+    else:
+        basal_state = BasalState.NotRunning
+    return bolus_state, basal_state
+
+
+class Record:
+    __slots__ = ()
+    # fields unpacked by the layout in order, with_data keeps the bytes after the layout in data
+    layout = None
+    fields = ()
+    with_data = False
+    saves_pod = False
+
+    @classmethod
+    def decode(cls, content):
+        if len(content) < cls.layout.size:
+            raise ProtocolError("%s response too short: %s" % (cls.__name__, binascii.hexlify(content)))
+        record = cls()
+        for name, value in zip(cls.fields, cls.layout.unpack_from(content)):
+            setattr(record, name, value)
+        if cls.with_data:
+            record.data = content[cls.layout.size:]
+        record.parse()
+        return record
+
+    def parse(self):
+        pass
+
+    def apply(self, pod):
+        pass
+
+    def as_dict(self):
+        d = {"record": type(self).__name__}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                value = getattr(self, name, None)
+                d[name] = value.hex() if isinstance(value, bytes) else value
+        return d
+
+
+@register(0x1d)
+class StatusResponse(Record):
+    __slots__ = ("state", "word1", "word2", "progress", "bolus_state", "basal_state", "insulin", "msg_sequence",
+                 "canceled", "faulted", "alerts", "minutes", "reservoir")
+    layout = struct.Struct(">BII")
+    fields = ("state", "word1", "word2")
+    saves_pod = True
+
+    def parse(self):
+        self.progress = self.state & 0xF
+        self.bolus_state, self.basal_state = get_delivery_states(self.state >> 4)
+        self.insulin = ((self.word1 & 0x0FFF8000) >> 15) * 0.05
+        self.msg_sequence = (self.word1 & 0x00007800) >> 11
+        self.canceled = (self.word1 & 0x000007FF) * 0.05
+        self.faulted = (self.word2 >> 31) != 0
+        self.alerts = (self.word2 >> 23) & 0xFF
+        self.minutes = (self.word2 & 0x007FFC00) >> 10
+        self.reservoir = (self.word2 & 0x000003FF) * 0.05
+
+    def apply(self, pod):
+        pod.faulted = self.faulted
+        pod.bolusState = self.bolus_state
+        pod.basalState = self.basal_state
+        pod.progress = self.progress
+        pod.alert_states = self.alerts
+        pod.reservoir = self.reservoir
+        pod.msgSequence = self.msg_sequence
+        pod.totalInsulin = self.insulin
+        pod.canceledInsulin = self.canceled
+        pod.minutes_since_activation = self.minutes
+        pod.lastUpdated = time.time()
+
+
+@register(0x06)
+class ErrorResponse(Record):
+    __slots__ = ("code", "word")
+    layout = struct.Struct(">BH")
+    fields = ("code", "word")
+
+    def is_bad_nonce(self):
+        return self.code == 0x14
+
+
+class InformationRecord(Record):
+    __slots__ = ("info_type",)
+    saves_pod = True
+
+
+@register(0x02, 0x01)
+class ConfiguredAlerts(InformationRecord):
+    __slots__ = ("unknown", "alerts")
+    layout = struct.Struct(">BH8H")
+    fields = ("info_type", "unknown")
+
+    @classmethod
+    def decode(cls, content):
+        record = super().decode(content)
+        record.alerts = list(cls.layout.unpack_from(content)[2:])
+        return record
+
+
+@register(0x02, 0x02)
+class DetailedStatus(InformationRecord):
+    __slots__ = ("progress", "delivery_state", "canceled_pulses", "msg_sequence", "total_pulses", "fault_event",
+                 "fault_event_rel_time", "reservoir_pulses", "minutes_since_activation", "alert_states",
+                 "fault_table_access", "fault_flags", "radio", "fault_progress_flags",
+                 "information_type2_last_word")
+    layout = struct.Struct(">BBBHBHBHHHBBBBBH")
+    fields = ("info_type",) + __slots__
+
+    def apply(self, pod):
+        pod.faulted = True
+        pod.progress = self.progress
+        pod.bolusState, pod.basalState = get_delivery_states(self.delivery_state)
+        pod.canceledInsulin = self.canceled_pulses * 0.05
+        pod.msgSequence = self.msg_sequence
+        pod.totalInsulin = self.total_pulses * 0.05
+        pod.fault_event = self.fault_event
+        pod.fault_event_rel_time = self.fault_event_rel_time
+        pod.reservoir = self.reservoir_pulses * 0.05
+        pod.minutes_since_activation = self.minutes_since_activation
+        pod.alert_states = self.alert_states
+        pod.fault_table_access = self.fault_table_access
+        pod.fault_insulin_state_table_corruption = self.fault_flags >> 7
+        pod.fault_internal_variables = (self.fault_flags & 0x60) >> 6
+        pod.fault_immediate_bolus_in_progress = (self.fault_flags & 0x10) >> 4
+        pod.fault_progress_before = self.fault_flags & 0x0F
+        pod.radio_low_gain = (self.radio & 0xC0) >> 6
+        pod.radio_rssi = self.radio & 0x3F
+        pod.fault_progress_before_2 = self.fault_progress_flags & 0x0F
+        pod.information_type2_last_word = self.information_type2_last_word
+
+
+class PulseLogRecord(InformationRecord):
+    # pulse logs do not change the pod state, Pdm.read_pulse_log decodes and stores the entries
+    __slots__ = ("data",)
+    with_data = True
+    saves_pod = False
+
+    def parse(self):
+        if len(self.data) % 4 != 0:
+            raise ProtocolError("Pulse log of type 0x%02x has a partial entry" % self.info_type)
+
+
+@register(0x02, 0x03)
+class PulseLogPlus(PulseLogRecord):
+    __slots__ = ("fault_event", "fault_minutes", "pod_minutes", "entry_size", "max_entries")
+    layout = struct.Struct(">BBHHBB")
+    fields = ("info_type",) + __slots__
+
+    def parse(self):
+        if self.entry_size != 4:
+            raise ProtocolError("Unsupported pulse log entry size %d" % self.entry_size)
+        super().parse()
+
+
+@register(0x02, 0x50)
+class PulseLogRecent(PulseLogRecord):
+    __slots__ = ("last_pulse",)
+    layout = struct.Struct(">BH")
+    fields = ("info_type", "last_pulse")
+
+
+@register(0x02, 0x51)
+class PulseLogPrevious(PulseLogRecord):
+    __slots__ = ("count",)
+    layout = struct.Struct(">BH")
+    fields = ("info_type", "count")
+
+
+@register(0x02, 0x05)
+class FaultEventInfo(InformationRecord):
+    __slots__ = ("fault_event", "fault_event_rel_time", "reserved", "init_month", "init_day", "init_year",
+                 "init_hour", "init_minute")
+    layout = struct.Struct(">BBH8sBBBBB")
+    fields = ("info_type",) + __slots__
+
+
+@register(0x02, 0x06)
+class HardcodedValues(InformationRecord):
+    __slots__ = ("data",)
+    layout = struct.Struct(">B")
+    fields = ("info_type",)
+    with_data = True
+
+
+@register(0x02, 0x46)
+class FlashLog(InformationRecord):
+    __slots__ = ("data",)
+    layout = struct.Struct(">B")
+    fields = ("info_type",)
+    with_data = True
@@ -0,0 +1,60 @@
+from .definitions import *
+import simplejson as json
+import os
+import threading
+import time
+
+
+class ResultCache:
+    def __init__(self, path=RESULT_CACHE_FILE, ttl=RESULT_CACHE_TTL):
+        self.logger = getLogger()
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self._load()
+
+    def get(self, key):
+        with self.lock:
+            self._evict()
+            return self.entries.get(key)
+
+    def put(self, key, name, success, result, error):
+        with self.lock:
+            self._evict()
+            self.entries[key] = {"name": name,
+                                 "stored": time.time(),
+                                 "success": success,
+                                 "result": result,
+                                 "error": error}
+            self._save()
+
+    def _evict(self):
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if now - entry["stored"] > self.ttl]
+        for key in expired:
+            del self.entries[key]
+
+    def _load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as stream:
+                self.entries = json.load(stream)
+            self._evict()
+        except Exception:
+            self.logger.exception("Error while loading result cache, starting with an empty cache")
+            self.entries = {}
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as stream:
+                json.dump(self.entries, stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            self.logger.exception("Error while saving result cache")
@@ -3,18 +3,15 @@ import logging
 import os
 import struct
 import time
+import simplejson as json
 from .definitions import *
 from enum import IntEnum
-from threading import Event
-from .exceptions import RileyLinkError
-
-from bluepy.btle import Peripheral, Scanner, BTLEException
-
-XGATT_BATTERYSERVICE_UUID = "180f"
-XGATT_BATTERY_CHAR_UUID = "2a19"
-RILEYLINK_SERVICE_UUID = "0235733b-99c5-4197-b856-69219c2a3845"
-RILEYLINK_DATA_CHAR_UUID = "c842e849-5028-42e2-867c-016adada9155"
-RILEYLINK_RESPONSE_CHAR_UUID = "6e6c7910-b89e-43a5-a0fe-50c5e2b81f4a"
+from threading import Lock
+from .exceptions import RileyLinkError, TransportError
+from .trace import span, traced
+from .metrics import RILEYLINK_CONNECTS, RILEYLINK_CONNECT_RETRIES, RILEYLINK_BLE_ERRORS, \
+    RILEYLINK_COMMAND_SECONDS, RILEYLINK_FAILOVERS
+from .transport import create_transport, RILEYLINK_SERVICE_UUID
 
 class Command(IntEnum):
     GET_STATE = 1
@@ -78,93 +75,160 @@ class Encoding(IntEnum):
     FOURBSIXB = 2
 
 
+class RileyLinkRegistry:
+    def __init__(self, path=RILEYLINK_REGISTRY_FILE):
+        self.path = path
+        self.lock = Lock()
+        self.devices = {}
+        self._load()
+        if os.path.exists(RILEYLINK_MAC_FILE):
+            with open(RILEYLINK_MAC_FILE, "r") as stream:
+                address = stream.read().strip()
+            if len(address) > 0 and address not in self.devices:
+                self.devices[address] = self._new_device()
+
+    @traced("rl.scan")
+    def scan(self, window=RILEYLINK_SCAN_WINDOW, attempts=RILEYLINK_SCAN_ATTEMPTS):
+        from bluepy.btle import Scanner
+        scanner = Scanner()
+        found = 0
+        logging.debug("Scanning for RileyLinks")
+        while found == 0 and attempts > 0:
+            attempts -= 1
+            results = scanner.scan(window)
+            with self.lock:
+                for result in results:
+                    if result.getValueText(7) == RILEYLINK_SERVICE_UUID:
+                        device = self.devices.setdefault(result.addr, self._new_device())
+                        device["rssi"] = result.rssi
+                        device["last_seen"] = time.time()
+                        found += 1
+                        logging.debug("Found RileyLink %s with rssi %d", result.addr, result.rssi)
+                self._save()
+        return self.ranked()
+
+    def ranked(self, exclude=()):
+        now = time.time()
+        with self.lock:
+            candidates = [(address, device) for address, device in self.devices.items() if address not in exclude]
+
+        def rank(candidate):
+            device = candidate[1]
+            failures = device["failures"]
+            if failures > 0 and now - device["last_failure"] > RILEYLINK_FAILURE_BACKOFF:
+                failures = 0
+            rssi = device["rssi"] if device["rssi"] is not None else -255
+            return failures >= RILEYLINK_MAX_FAILURES, failures, -rssi
+
+        return [address for address, device in sorted(candidates, key=rank)]
+
+    def add(self, address):
+        with self.lock:
+            if address not in self.devices:
+                self.devices[address] = self._new_device()
+                self._save()
+
+    def mark_ok(self, address):
+        with self.lock:
+            device = self.devices.setdefault(address, self._new_device())
+            changed = device["failures"] > 0 or device["last_connected"] is None
+            device["failures"] = 0
+            device["last_connected"] = time.time()
+            if changed:
+                self._save()
+
+    def mark_failed(self, address):
+        with self.lock:
+            device = self.devices.setdefault(address, self._new_device())
+            device["failures"] += 1
+            device["last_failure"] = time.time()
+            self._save()
+
+    def as_dict(self):
+        with self.lock:
+            return {address: dict(device) for address, device in self.devices.items()}
+
+    @staticmethod
+    def _new_device():
+        return {"rssi": None, "last_seen": None, "last_connected": None, "failures": 0, "last_failure": None}
+
+    def _load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as stream:
+                self.devices = json.load(stream)
+        except Exception:
+            logging.exception("Error while loading the rileylink registry")
+            self.devices = {}
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as stream:
+                json.dump(self.devices, stream, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            logging.exception("Error while saving the rileylink registry")
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = RileyLinkRegistry()
+    return _registry
+
+
 class RileyLink:
-    def __init__(self, address = None):
-        self.peripheral = None
-        self.data_handle = None
+    def __init__(self, address=None, registry=None, failover=True):
+        self.transport = None
+        self.failover = failover
+        if registry is None:
+            registry = get_registry()
+        self.registry = registry
         if address is None:
-            if os.path.exists(RILEYLINK_MAC_FILE):
-                with open(RILEYLINK_MAC_FILE, "r") as stream:
-                    address = stream.read()
+            ranked = registry.ranked()
+            if len(ranked) > 0:
+                address = ranked[0]
         self.address = address
-        self.service = None
-        self.response_handle = None
-        self.notify_event = Event()
 
+    @traced("rl.connect")
     def connect(self, force_initialize=False):
         try:
             if self.address is None:
                 self.address = self._findRileyLink()
 
-            if self.peripheral is None:
-                self.peripheral = Peripheral()
-
-            try:
-                state = self.peripheral.getState()
-                if state == "conn":
-                    return
-            except BTLEException:
-                pass
-
-            self._connect_retry(3)
-
-            self.service = self.peripheral.getServiceByUUID(RILEYLINK_SERVICE_UUID)
-            data_char = self.service.getCharacteristics(RILEYLINK_DATA_CHAR_UUID)[0]
-            self.data_handle = data_char.getHandle()
-
-            char_response = self.service.getCharacteristics(RILEYLINK_RESPONSE_CHAR_UUID)[0]
-            self.response_handle = char_response.getHandle()
-
-            response_notify_handle = self.response_handle + 1
-            notify_setup = b"\x01\x00"
-            self.peripheral.writeCharacteristic(response_notify_handle, notify_setup)
-
-            while self.peripheral.waitForNotifications(0.05):
-                self.peripheral.readCharacteristic(self.data_handle)
+            if self.transport is not None and self.transport.is_connected():
+                return
 
+            self._connect_any()
             self.init_radio(force_initialize)
-        except BTLEException:
-            if self.peripheral is not None:
+        except RileyLinkError:
+            if self.transport is not None:
                 self.disconnect()
             raise
 
     def disconnect(self, ignore_errors=True):
-        try:
-            if self.peripheral is None:
-                logging.info("Already disconnected")
-                return
-            logging.info("Disconnecting..")
-            if self.response_handle is not None:
-                response_notify_handle = self.response_handle + 1
-                notify_setup = b"\x00\x00"
-                self.peripheral.writeCharacteristic(response_notify_handle, notify_setup)
-        except BTLEException:
-            if not ignore_errors:
-                raise
-        finally:
-            try:
-                if self.peripheral is not None:
-                    self.peripheral.disconnect()
-                    self.peripheral = None
-            except BTLEException as btlee:
-                if ignore_errors:
-                    logging.warning("Ignoring btle exception during disconnect: %s" % btlee)
-                else:
-                    raise
+        if self.transport is None:
+            logging.info("Already disconnected")
+            return
+        self.transport.close(ignore_errors)
 
     def get_info(self):
         try:
             self.connect()
-            bs = self.peripheral.getServiceByUUID(XGATT_BATTERYSERVICE_UUID)
-            bc = bs.getCharacteristics(XGATT_BATTERY_CHAR_UUID)[0]
-            bch = bc.getHandle()
-            battery_value = int(self.peripheral.readCharacteristic(bch)[0])
+            battery_value = self.transport.read_battery_level()
             logging.debug("Battery level read: %d", battery_value)
             version, v_major, v_minor = self._read_version()
             return { "battery_level": battery_value, "mac_address": self.address,
                     "version_string": version, "version_major": v_major, "version_minor": v_minor }
-        except BTLEException as btlee:
-            raise RileyLinkError("Error communicating with RileyLink") from btlee
+        except TransportError as te:
+            raise RileyLinkError("Error communicating with RileyLink") from te
         finally:
             self.disconnect()
 
@@ -178,7 +242,7 @@ class RileyLink:
                 response = self._command(Command.GET_VERSION)
                 if response is not None and len(response) > 0:
                     version = response.decode("ascii")
-                    logging.debug("RL reports version string: %s" % version)
+                    logging.debug("RL reports version string: %s", version)
 
                     try:
                         with open(RILEYLINK_VERSION_FILE, "w") as stream:
@@ -196,7 +260,7 @@ class RileyLink:
 
                 v_major = int(m.group(1))
                 v_minor = int(m.group(2))
-                logging.debug("Interpreted version major: %d minor: %d" % (v_major, v_minor))
+                logging.debug("Interpreted version major: %d minor: %d", v_major, v_minor)
 
                 return version, v_major, v_minor
 
@@ -211,7 +275,7 @@ class RileyLink:
         response = self._command(Command.GET_VERSION)
         if response is not None and len(response) > 0:
             version = response.decode("ascii")
-            logging.debug("RL reports version string: %s" % version)
+            logging.debug("RL reports version string: %s", version)
             try:
                 m = re.search(".+([0-9]+)\\.([0-9]+)", version)
                 if m is None:
@@ -219,7 +283,7 @@ class RileyLink:
 
                 v_major = int(m.group(1))
                 v_minor = int(m.group(2))
-                logging.debug("Interpreted version major: %d minor: %d" % (v_major, v_minor))
+                logging.debug("Interpreted version major: %d minor: %d", v_major, v_minor)
 
                 return (version, v_major, v_minor)
             except RileyLinkError:
@@ -227,6 +291,7 @@ class RileyLink:
             except Exception as ex:
                 raise RileyLinkError("Failed to parse firmware version string: %s" % version) from ex
 
+    @traced("rl.init_radio")
     def init_radio(self, force_init=False):
         try:
             version, v_major, v_minor = self._read_version()
@@ -244,33 +309,35 @@ class RileyLink:
                 if response is not None and len(response) > 0 and response[0] == 0xA5:
                     return
 
-            self._command(Command.RADIO_RESET_CONFIG)
-            self._command(Command.SET_SW_ENCODING, bytes([Encoding.MANCHESTER]))
             frequency = int(433910000 / (24000000 / pow(2, 16)))
-            self._command(Command.SET_PREAMBLE, bytes([0x66, 0x65]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FREQ0, frequency & 0xff]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FREQ1, (frequency >> 8) & 0xff]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FREQ2, (frequency >> 16) & 0xff]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.PKTCTRL1, 0x20]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.PKTCTRL0, 0x00]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FSCTRL1, 0x06]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.MDMCFG4, 0xCA]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.MDMCFG3, 0xBC]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.MDMCFG2, 0x06]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.MDMCFG1, 0x70]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.MDMCFG0, 0x11]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.DEVIATN, 0x44]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.MCSM0, 0x18]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FOCCFG, 0x17]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FSCAL3, 0xE9]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FSCAL2, 0x2A]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FSCAL1, 0x00]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.FSCAL0, 0x1F]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.TEST1, 0x31]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.TEST0, 0x09]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.PATABLE0, 0x84]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.SYNC1, 0xA5]))
-            self._command(Command.UPDATE_REGISTER, bytes([Register.SYNC0, 0x5A]))
+            self._commands([
+                (Command.RADIO_RESET_CONFIG, None),
+                (Command.SET_SW_ENCODING, bytes([Encoding.MANCHESTER])),
+                (Command.SET_PREAMBLE, bytes([0x66, 0x65])),
+                (Command.UPDATE_REGISTER, bytes([Register.FREQ0, frequency & 0xff])),
+                (Command.UPDATE_REGISTER, bytes([Register.FREQ1, (frequency >> 8) & 0xff])),
+                (Command.UPDATE_REGISTER, bytes([Register.FREQ2, (frequency >> 16) & 0xff])),
+                (Command.UPDATE_REGISTER, bytes([Register.PKTCTRL1, 0x20])),
+                (Command.UPDATE_REGISTER, bytes([Register.PKTCTRL0, 0x00])),
+                (Command.UPDATE_REGISTER, bytes([Register.FSCTRL1, 0x06])),
+                (Command.UPDATE_REGISTER, bytes([Register.MDMCFG4, 0xCA])),
+                (Command.UPDATE_REGISTER, bytes([Register.MDMCFG3, 0xBC])),
+                (Command.UPDATE_REGISTER, bytes([Register.MDMCFG2, 0x06])),
+                (Command.UPDATE_REGISTER, bytes([Register.MDMCFG1, 0x70])),
+                (Command.UPDATE_REGISTER, bytes([Register.MDMCFG0, 0x11])),
+                (Command.UPDATE_REGISTER, bytes([Register.DEVIATN, 0x44])),
+                (Command.UPDATE_REGISTER, bytes([Register.MCSM0, 0x18])),
+                (Command.UPDATE_REGISTER, bytes([Register.FOCCFG, 0x17])),
+                (Command.UPDATE_REGISTER, bytes([Register.FSCAL3, 0xE9])),
+                (Command.UPDATE_REGISTER, bytes([Register.FSCAL2, 0x2A])),
+                (Command.UPDATE_REGISTER, bytes([Register.FSCAL1, 0x00])),
+                (Command.UPDATE_REGISTER, bytes([Register.FSCAL0, 0x1F])),
+                (Command.UPDATE_REGISTER, bytes([Register.TEST1, 0x31])),
+                (Command.UPDATE_REGISTER, bytes([Register.TEST0, 0x09])),
+                (Command.UPDATE_REGISTER, bytes([Register.PATABLE0, 0x84])),
+                (Command.UPDATE_REGISTER, bytes([Register.SYNC1, 0xA5])),
+                (Command.UPDATE_REGISTER, bytes([Register.SYNC0, 0x5A]))
+            ])
 
             response = self._command(Command.GET_STATE)
             if response != b"OK":
@@ -280,93 +347,165 @@ class RileyLink:
             logging.error("Error while initializing rileylink radio: %s", rle)
             raise
 
+    def is_connected(self):
+        return self.transport is not None and self.transport.is_connected()
+
     def get_packet(self, timeout=5.0):
         try:
-            self.connect()
-            return self._command(Command.GET_PACKET, struct.pack(">BL", 0, int(timeout * 1000)), timeout=float(timeout)+0.5)
+            return self._with_failover(lambda: self.receive(timeout))
         except RileyLinkError as rle:
             logging.error("Error while receiving data: %s", rle)
             raise
 
+    def receive(self, timeout):
+        # listens on the open connection only, it neither connects nor fails over
+        return self._command(Command.GET_PACKET, struct.pack(">BL", 0, int(timeout * 1000)),
+                             timeout=float(timeout)+0.5)
+
     def send_and_receive_packet(self, packet, repeat_count, delay_ms, timeout_ms, retry_count, preamble_ext_ms):
 
-        logging.debug("sending packet: %s" % packet.hex())
+        logging.debug("sending packet: %s", Lazy(bytes.hex, packet))
         try:
-            self.connect()
-            return self._command(Command.SEND_AND_LISTEN,
-                                  struct.pack(">BBHBLBH",
-                                              0,
-                                              repeat_count,
-                                              delay_ms,
-                                              0,
-                                              timeout_ms,
-                                              retry_count,
-                                              preamble_ext_ms)
-                                              + packet,
-                                  timeout=30)
+            return self._with_failover(lambda: self._command(Command.SEND_AND_LISTEN,
+                                                             struct.pack(">BBHBLBH",
+                                                                         0,
+                                                                         repeat_count,
+                                                                         delay_ms,
+                                                                         0,
+                                                                         timeout_ms,
+                                                                         retry_count,
+                                                                         preamble_ext_ms)
+                                                             + packet,
+                                                             timeout=30))
         except RileyLinkError as rle:
             logging.error("Error while sending and receiving data: %s", rle)
             raise
 
     def send_packet(self, packet, repeat_count, delay_ms, preamble_extension_ms):
         try:
-            self.connect()
-            result = self._command(Command.SEND_PACKET, struct.pack(">BBHH", 0, repeat_count, delay_ms,
-                                                                   preamble_extension_ms) + packet,
-                                  timeout=30)
-            return result
+            return self._with_failover(lambda: self._command(Command.SEND_PACKET,
+                                                             struct.pack(">BBHH", 0, repeat_count, delay_ms,
+                                                                         preamble_extension_ms) + packet,
+                                                             timeout=30))
         except RileyLinkError as rle:
             logging.error("Error while sending data: %s", rle)
             raise
 
     def _findRileyLink(self):
-        scanner = Scanner()
-        found = None
-        logging.debug("Scanning for RileyLink")
-        retries = 10
-        while found is None and retries > 0:
-            retries -= 1
-            for result in scanner.scan(1.0):
-                if result.getValueText(7) == RILEYLINK_SERVICE_UUID:
-                    logging.debug("Found RileyLink")
-                    found = result.addr
-                    try:
-                        with open(RILEYLINK_MAC_FILE, "w") as stream:
-                            stream.write(result.addr)
-                    except IOError:
-                        logging.warning("Cannot store rileylink mac address for later")
-                    break
-
-        if found is None:
+        ranked = self.registry.ranked()
+        if len(ranked) == 0:
+            ranked = self.registry.scan()
+        if len(ranked) == 0:
             raise RileyLinkError("Could not find RileyLink")
 
+        found = ranked[0]
+        try:
+            with open(RILEYLINK_MAC_FILE, "w") as stream:
+                stream.write(found)
+        except IOError:
+            logging.warning("Cannot store rileylink mac address for later")
         return found
 
+    def _connect_any(self):
+        if not self.failover:
+            if not self._connect_retry(3):
+                raise RileyLinkError("Could not connect to RileyLink %s" % self.address)
+            return
+
+        tried = []
+        while True:
+            alternatives = self.registry.ranked(exclude=tried + [self.address])
+            if self._connect_retry(1 if len(alternatives) > 0 else 3):
+                self.registry.mark_ok(self.address)
+                return
+
+            self.registry.mark_failed(self.address)
+            tried.append(self.address)
+            if len(alternatives) == 0:
+                alternatives = [address for address in self.registry.scan() if address not in tried]
+            if len(alternatives) == 0:
+                raise RileyLinkError("Could not connect to any RileyLink")
+            self._switch_to(alternatives[0])
+
+    def _with_failover(self, command):
+        try:
+            self.connect()
+            return command()
+        except RileyLinkError as e:
+            if not self.failover or isinstance(e, RileyLinkError) and e.err_code is not None:
+                raise
+            logging.warning("RileyLink %s stopped responding: %s", self.address, e)
+            self.registry.mark_failed(self.address)
+            alternatives = self.registry.ranked(exclude=[self.address])
+            if len(alternatives) == 0:
+                raise
+            self.disconnect()
+            self._switch_to(alternatives[0])
+            self.connect()
+            return command()
+
+    def _switch_to(self, address):
+        logging.warning("Switching from RileyLink %s to %s", self.address, address)
+        RILEYLINK_FAILOVERS.inc()
+        self.address = address
+        try:
+            with open(RILEYLINK_MAC_FILE, "w") as stream:
+                stream.write(address)
+        except IOError:
+            logging.warning("Cannot store rileylink mac address for later")
+
+    @traced("rl.ble_connect")
     def _connect_retry(self, retries):
+        self.transport = create_transport(self.address, self.transport)
         while retries > 0:
             retries -= 1
-            logging.info("Connecting to RileyLink, retries left: %d" % retries)
+            logging.info("Connecting to RileyLink, retries left: %d", retries)
             try:
-                self.peripheral.connect(self.address)
+                self.transport.open(self.address)
+                RILEYLINK_CONNECTS.inc()
                 logging.info("Connected")
-                break
-            except BTLEException as btlee:
-                logging.warning("BTLE exception trying to connect: %s" % btlee)
+                return True
+            except TransportError as te:
+                RILEYLINK_CONNECT_RETRIES.inc()
+                logging.warning("Transport error trying to connect: %s", te.error_message)
+            except RileyLinkError as rle:
+                RILEYLINK_CONNECT_RETRIES.inc()
+                logging.warning("Error trying to connect: %s", rle.error_message)
+            if retries > 0:
                 time.sleep(2)
+        return False
 
     def _command(self, command_type, command_data=None, timeout=10.0):
-        if command_data is None:
-            data = bytes([1, command_type])
-        else:
-            data = bytes([len(command_data) + 1, command_type]) + command_data
-
-        self.peripheral.writeCharacteristic(self.data_handle, data, withResponse=True)
+        data = self._command_frame(command_type, command_data)
+        start = time.perf_counter()
+        with span("rl.command", command_type):
+            try:
+                response = self.transport.exchange(data, timeout)
+            except TransportError:
+                RILEYLINK_BLE_ERRORS.inc(Command(command_type).name)
+                raise
+            finally:
+                RILEYLINK_COMMAND_SECONDS.observe(time.perf_counter() - start, Command(command_type).name)
+        return self._parse_response(response)
 
-        if not self.peripheral.waitForNotifications(timeout):
-            raise RileyLinkError("Timed out while waiting for a response from RileyLink")
+    def _commands(self, commands, timeout=10.0):
+        frames = [self._command_frame(command_type, command_data) for command_type, command_data in commands]
+        with span("rl.commands", len(frames)):
+            try:
+                responses = self.transport.exchange_all(frames, timeout)
+            except TransportError:
+                RILEYLINK_BLE_ERRORS.inc("BATCH")
+                raise
+        return [self._parse_response(response) for response in responses]
 
-        response = self.peripheral.readCharacteristic(self.data_handle)
+    @staticmethod
+    def _command_frame(command_type, command_data):
+        if command_data is None:
+            return bytes([1, command_type])
+        return bytes([len(command_data) + 1, command_type]) + command_data
 
+    @staticmethod
+    def _parse_response(response):
         if response is None or len(response) == 0:
             raise RileyLinkError("RileyLink returned no response")
         else:
@@ -380,4 +519,3 @@ class RileyLink:
             else:
                 raise RileyLinkError("RileyLink returned error code: %02X. Additional response data: %s"
                                      % (response[0], response[1:]), response[0])
-
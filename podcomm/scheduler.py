@@ -0,0 +1,191 @@
+from .definitions import *
+from .exceptions import RileyLinkError, TransportError
+from .metrics import RILEYLINK_PRECONNECTS
+from .rileylink import RileyLink, get_registry
+from contextlib import contextmanager, ExitStack
+import threading
+import time
+
+
+class SharedRileyLink:
+    def __init__(self, rileylink):
+        self.rileylink = rileylink
+        self.lock = threading.RLock()
+        self.holds = 0
+        self.capture = None
+        self.last_used = 0
+        self.preconnect_lock = threading.Lock()
+        self.preconnect_thread = None
+        self.preconnect_timer = None
+        self.preconnected = 0
+
+    def __getattr__(self, name):
+        return getattr(self.rileylink, name)
+
+    def get_packet(self, timeout=5.0):
+        with self.lock:
+            self.last_used = time.time()
+            return self._captured(self.rileylink.get_packet(timeout))
+
+    def send_and_receive_packet(self, packet, *params):
+        with self.lock:
+            self.last_used = time.time()
+            self._captured(packet, transmitted=True)
+            return self._captured(self.rileylink.send_and_receive_packet(packet, *params))
+
+    def send_packet(self, packet, *params):
+        with self.lock:
+            self.last_used = time.time()
+            self._captured(packet, transmitted=True)
+            return self.rileylink.send_packet(packet, *params)
+
+    def listen(self, window):
+        # capture only uses a connection that is already open, a session that disconnected stays disconnected
+        with self.lock:
+            if self.holds > 0 or time.time() - self.last_used < CAPTURE_IDLE_DELAY \
+                    or not self.rileylink.is_connected():
+                return False
+            self._captured(self.rileylink.receive(window))
+            return True
+
+    def disconnect(self, ignore_errors=True):
+        with self.lock:
+            if self.holds == 0:
+                self.rileylink.disconnect(ignore_errors)
+
+    @contextmanager
+    def hold(self):
+        with self.lock:
+            self.holds += 1
+            try:
+                yield self
+            finally:
+                self.holds -= 1
+                self.disconnect()
+
+    def preconnect(self, grace=RILEYLINK_PRECONNECT_GRACE, interval=0):
+        # the connection is set up while the command is still on its way, it is closed again if none arrives.
+        # the radio lock is held for whole sessions, so requests only take the preconnect lock and the thread
+        # checks the holds again under the radio lock
+        with self.preconnect_lock:
+            if self.holds > 0 or (self.preconnect_thread is not None and self.preconnect_thread.is_alive()):
+                return
+            now = time.time()
+            if now - self.preconnected < interval:
+                return
+            self.preconnected = now
+            self.preconnect_thread = threading.Thread(target=self._preconnect, args=(grace,), daemon=True)
+            self.preconnect_thread.start()
+
+    def _preconnect(self, grace):
+        with self.lock:
+            if self.holds > 0:
+                return
+            try:
+                self.rileylink.connect()
+            except RileyLinkError as e:
+                getLogger().debug("Speculative connection to the RileyLink failed: %s" % e)
+                RILEYLINK_PRECONNECTS.inc("failed")
+                return
+            connected = time.time()
+            self.last_used = connected
+            # a later request extends the grace period of a connection that is still unused
+            if self.preconnect_timer is not None:
+                self.preconnect_timer.cancel()
+            self.preconnect_timer = threading.Timer(grace, self._preconnect_expired, (connected,))
+            self.preconnect_timer.daemon = True
+            self.preconnect_timer.start()
+
+    def _preconnect_expired(self, connected):
+        with self.lock:
+            if self.last_used != connected:
+                # the command that followed disconnects when it is done
+                RILEYLINK_PRECONNECTS.inc("used")
+                return
+            RILEYLINK_PRECONNECTS.inc("expired")
+            self.disconnect()
+
+    def _captured(self, data, transmitted=False):
+        if self.capture is not None and data is not None:
+            self.capture.append(data, transmitted)
+        return data
+
+
+class RadioScheduler:
+    def __init__(self, rileylinks=None):
+        self.logger = getLogger()
+        if rileylinks is None:
+            rileylinks = [RileyLink()]
+        self.rileylinks = [SharedRileyLink(r) for r in rileylinks]
+        self.listener = None
+        self.capture = None
+        self.capture_listeners = []
+        self.assignments = {}
+        self.lock = threading.Lock()
+
+    def get(self, pod_id=None):
+        with self.lock:
+            index = self.assignments.get(pod_id)
+            if index is None:
+                loads = [list(self.assignments.values()).count(i) for i in range(len(self.rileylinks))]
+                index = loads.index(min(loads))
+                self.assignments[pod_id] = index
+                self.logger.debug("Assigned pod %s to rileylink %d" % (pod_id, index))
+            return self.rileylinks[index]
+
+    def enable_diversity(self, address=None):
+        if address is None:
+            in_use = [r.address for r in self.rileylinks]
+            candidates = [a for a in get_registry().ranked() if a not in in_use]
+            if len(candidates) == 0:
+                raise RileyLinkError("No other RileyLink is known to listen for diversity receive")
+            address = candidates[0]
+        self.logger.info("Diversity receive enabled, listening with RileyLink %s" % address)
+        self.listener = SharedRileyLink(RileyLink(address, failover=False))
+        self.listener.capture = self.capture
+
+    def connect_all(self):
+        errors = []
+        for rileylink in self.rileylinks:
+            with rileylink.lock:
+                rileylink.last_used = time.time()
+                try:
+                    rileylink.connect()
+                except TransportError as te:
+                    errors.append("%s on %s" % (te.error_message, rileylink.address))
+                except RileyLinkError as rle:
+                    errors.append(rle.error_message)
+        if len(errors) > 0:
+            raise RileyLinkError("; ".join(errors))
+
+    def preconnect(self, pod_ids=None, interval=0):
+        if pod_ids is None:
+            rileylinks = self.rileylinks
+        else:
+            rileylinks = [self.get(pod_id) for pod_id in pod_ids]
+        for rileylink in rileylinks:
+            rileylink.preconnect(interval=interval)
+
+    def enable_capture(self, buffer):
+        from .capture import CaptureListener
+        self.logger.info("Passive capture enabled, writing packets to %s" % buffer.path)
+        self.capture = buffer
+        shared = list(self.rileylinks)
+        if self.listener is not None:
+            shared.append(self.listener)
+        for rileylink in shared:
+            rileylink.capture = buffer
+        for rileylink in self.rileylinks:
+            listener = CaptureListener(rileylink, buffer)
+            listener.start()
+            self.capture_listeners.append(listener)
+
+    @contextmanager
+    def hold(self, pod_ids):
+        # the diversity listener is not held, its thread has to reach it while the sessions run
+        needed = [self.get(pod_id) for pod_id in pod_ids]
+        with ExitStack() as stack:
+            for rileylink in self.rileylinks:
+                if rileylink in needed:
+                    stack.enter_context(rileylink.hold())
+            yield
@@ -0,0 +1,57 @@
+from .definitions import *
+from collections import OrderedDict
+import simplejson as json
+import hashlib
+import threading
+import uuid
+
+
+class StateTracker:
+    def __init__(self, history_size=STATE_HISTORY_SIZE):
+        self.instance = uuid.uuid4().hex[:8]
+        self.history_size = history_size
+        self.version = 0
+        self.digest = None
+        self.encoded = None
+        self.snapshots = OrderedDict()
+        self.lock = threading.Lock()
+
+    def update(self, state):
+        encoded, digest = self._encode(state)
+        with self.lock:
+            if digest != self.digest:
+                self.version += 1
+                self.digest = digest
+                self.encoded = encoded
+                self.snapshots[self.version] = (digest, dict(state))
+                while len(self.snapshots) > self.history_size:
+                    self.snapshots.popitem(last=False)
+            return self.version, self.encoded
+
+    def find(self, state):
+        # the version a state had when it was current, without making it current again
+        encoded, digest = self._encode(state)
+        with self.lock:
+            for version, (snapshot_digest, _) in reversed(self.snapshots.items()):
+                if snapshot_digest == digest:
+                    return version, encoded
+        return None, encoded
+
+    def etag(self, version):
+        return "%s-%d" % (self.instance, version)
+
+    def delta(self, since, state, keys=None):
+        # changed and added keys with their values, and the keys that are gone; keys limits what can be gone
+        with self.lock:
+            snapshot = self.snapshots.get(since)
+        if snapshot is None:
+            return None
+        snapshot = snapshot[1]
+        changes = {k: v for k, v in state.items() if k not in snapshot or snapshot[k] != v}
+        removed = sorted(k for k in snapshot if k not in state and (keys is None or k in keys))
+        return changes, removed
+
+    @staticmethod
+    def _encode(state):
+        encoded = json.dumps(state, sort_keys=True, separators=(",", ":"))
+        return encoded, hashlib.sha1(encoded.encode("utf-8")).digest()
@@ -0,0 +1,151 @@
+from .definitions import *
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+import simplejson as json
+import logging
+import logging.handlers
+import threading
+import time
+
+_local = threading.local()
+_trace_logger = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, collector, name, detail):
+        self.collector = collector
+        self.name = name
+        self.detail = detail
+        self.depth = 0
+        self.start = 0
+
+    def __enter__(self):
+        self.depth = self.collector.depth
+        self.collector.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        self.collector.depth -= 1
+        self.collector.spans.append((self.name, self.detail, self.depth, self.start, end, exc_type is not None))
+        return False
+
+
+class Collector:
+    def __init__(self, name):
+        self.name = name
+        self.time = time.time()
+        self.origin = time.perf_counter()
+        self.depth = 0
+        self.spans = []
+
+    def add(self, spans):
+        for name, detail, depth, start, end, failed in spans:
+            self.spans.append((name, detail, depth + self.depth, start, end, failed))
+
+    def as_list(self):
+        result = []
+        for name, detail, depth, start, end, failed in sorted(self.spans, key=lambda s: s[3]):
+            if detail is not None:
+                name = "%s:%s" % (name, getattr(detail, "name", detail))
+            result.append({"name": name, "depth": depth,
+                           "start_ms": round((start - self.origin) * 1000, 2),
+                           "duration_ms": round((end - start) * 1000, 2),
+                           "failed": failed})
+        return result
+
+    def server_timing(self):
+        totals = OrderedDict()
+        for name, detail, depth, start, end, failed in sorted(self.spans, key=lambda s: s[3]):
+            total, count = totals.get(name, (0, 0))
+            totals[name] = (total + end - start, count + 1)
+        return ", ".join('%s;dur=%.1f;desc="x%d"' % (name, total * 1000, count)
+                         for name, (total, count) in totals.items())
+
+
+def enable(path=TRACE_FILE):
+    global _trace_logger
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=TRACE_FILE_MAX_BYTES,
+                                                   backupCount=TRACE_FILE_BACKUP_COUNT)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger = logging.getLogger(OMNIPY_TRACE_LOGGER)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+    trace_logger.addHandler(handler)
+    _trace_logger = trace_logger
+
+
+def is_enabled():
+    return _trace_logger is not None
+
+
+def span(name, detail=None):
+    collector = getattr(_local, "collector", None)
+    if collector is None:
+        return NULL_SPAN
+    return Span(collector, name, detail)
+
+
+def traced(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def begin(name, force=False):
+    if not force and _trace_logger is None:
+        return None
+    collector = Collector(name)
+    _local.collector = collector
+    return collector
+
+
+def end(collector):
+    if collector is None:
+        return
+    if getattr(_local, "collector", None) is collector:
+        _local.collector = None
+    write(collector)
+
+
+def write(collector):
+    if collector is not None and _trace_logger is not None:
+        _trace_logger.info(json.dumps({"name": collector.name, "time": collector.time,
+                                       "spans": collector.as_list()}, separators=(",", ":")))
+
+
+@contextmanager
+def collect(name, force=False):
+    previous = getattr(_local, "collector", None)
+    if not force and _trace_logger is None:
+        yield None
+        return
+    collector = Collector(name)
+    _local.collector = collector
+    try:
+        yield collector
+    finally:
+        _local.collector = previous
+
+
+def attach(collector):
+    current = getattr(_local, "collector", None)
+    if current is not None and collector is not None:
+        current.add(collector.spans)
@@ -0,0 +1,352 @@
+import hashlib
+import hmac
+import logging
+import socket
+import struct
+import threading
+import time
+from enum import IntEnum
+from .definitions import *
+from .exceptions import RileyLinkError, TransportError
+
+XGATT_BATTERYSERVICE_UUID = "180f"
+XGATT_BATTERY_CHAR_UUID = "2a19"
+RILEYLINK_SERVICE_UUID = "0235733b-99c5-4197-b856-69219c2a3845"
+RILEYLINK_DATA_CHAR_UUID = "c842e849-5028-42e2-867c-016adada9155"
+RILEYLINK_RESPONSE_CHAR_UUID = "6e6c7910-b89e-43a5-a0fe-50c5e2b81f4a"
+
+RADIO_HOST_SCHEME = "tcp://"
+
+# frame: length of the rest, frame type, frame id, payload
+FRAME_HEADER = struct.Struct(">IBI")
+FRAME_TIMEOUT = struct.Struct(">I")
+
+
+class Frame(IntEnum):
+    OPEN = 0x01
+    CLOSE = 0x02
+    COMMAND = 0x03
+    BATTERY = 0x04
+    PING = 0x05
+    CHALLENGE = 0x06
+    AUTH = 0x07
+    RESPONSE = 0x80
+    ERROR = 0x81
+    PONG = 0x85
+
+
+def is_radio_host(address):
+    return address is not None and address.startswith(RADIO_HOST_SCHEME)
+
+
+def parse_radio_host(address):
+    host, _, port = address[len(RADIO_HOST_SCHEME):].rpartition(":")
+    if len(host) == 0:
+        return port, RADIO_HOST_PORT
+    return host, int(port)
+
+
+def create_transport(address, current=None):
+    transport_class = TcpTransport if is_radio_host(address) else BleTransport
+    if isinstance(current, transport_class):
+        return current
+    if current is not None:
+        current.close(ignore_errors=True)
+    return transport_class()
+
+
+def read_api_key(path=KEY_FILE):
+    # the radio host shares the api password with the rest api, set with set_api_password.py on both sides
+    with open(path, "rb") as stream:
+        return stream.read(32)
+
+
+def get_challenge_response(key, challenge):
+    return hmac.new(key, challenge, hashlib.sha256).digest()
+
+
+def write_frame(sock, frame_type, frame_id, payload=b""):
+    sock.sendall(FRAME_HEADER.pack(FRAME_HEADER.size - 4 + len(payload), frame_type, frame_id) + payload)
+
+
+def read_frame(sock):
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, frame_type, frame_id = FRAME_HEADER.unpack(header)
+    length -= FRAME_HEADER.size - 4
+    if length < 0 or length > RADIO_HOST_MAX_FRAME:
+        raise RileyLinkError("Invalid frame length %d received from radio host" % length)
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        return None
+    return frame_type, frame_id, payload
+
+
+def _recv_exactly(sock, count):
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return data
+
+
+class BleTransport:
+    def __init__(self):
+        # bluepy is only needed for rileylinks reached over bluetooth, its errors leave as TransportError
+        from bluepy import btle
+        self.btle = btle
+        self.peripheral = None
+        self.data_handle = None
+        self.response_handle = None
+
+    def is_connected(self):
+        if self.peripheral is None:
+            return False
+        try:
+            return self.peripheral.getState() == "conn"
+        except self.btle.BTLEException:
+            return False
+
+    def open(self, address):
+        if self.peripheral is None:
+            self.peripheral = self.btle.Peripheral()
+        try:
+            self.peripheral.connect(address)
+
+            service = self.peripheral.getServiceByUUID(RILEYLINK_SERVICE_UUID)
+            data_char = service.getCharacteristics(RILEYLINK_DATA_CHAR_UUID)[0]
+            self.data_handle = data_char.getHandle()
+
+            char_response = service.getCharacteristics(RILEYLINK_RESPONSE_CHAR_UUID)[0]
+            self.response_handle = char_response.getHandle()
+
+            response_notify_handle = self.response_handle + 1
+            notify_setup = b"\x01\x00"
+            self.peripheral.writeCharacteristic(response_notify_handle, notify_setup)
+
+            while self.peripheral.waitForNotifications(0.05):
+                self.peripheral.readCharacteristic(self.data_handle)
+        except self.btle.BTLEException as btlee:
+            self.close()
+            raise TransportError("BTLE error while connecting to %s: %s" % (address, btlee)) from btlee
+
+    def close(self, ignore_errors=True):
+        try:
+            if self.peripheral is None:
+                logging.info("Already disconnected")
+                return
+            logging.info("Disconnecting..")
+            if self.response_handle is not None:
+                response_notify_handle = self.response_handle + 1
+                notify_setup = b"\x00\x00"
+                self.peripheral.writeCharacteristic(response_notify_handle, notify_setup)
+        except self.btle.BTLEException as btlee:
+            if not ignore_errors:
+                raise TransportError("BTLE error while disconnecting: %s" % btlee) from btlee
+        finally:
+            try:
+                if self.peripheral is not None:
+                    self.peripheral.disconnect()
+                    self.peripheral = None
+                    self.response_handle = None
+            except self.btle.BTLEException as btlee:
+                if ignore_errors:
+                    logging.warning("Ignoring btle exception during disconnect: %s" % btlee)
+                else:
+                    raise TransportError("BTLE error while disconnecting: %s" % btlee) from btlee
+
+    def exchange(self, data, timeout):
+        try:
+            self.peripheral.writeCharacteristic(self.data_handle, data, withResponse=True)
+            if not self.peripheral.waitForNotifications(timeout):
+                raise RileyLinkError("Timed out while waiting for a response from RileyLink")
+            return self.peripheral.readCharacteristic(self.data_handle)
+        except self.btle.BTLEException as btlee:
+            raise TransportError("BTLE error: %s" % btlee) from btlee
+
+    def exchange_all(self, frames, timeout):
+        return [self.exchange(data, timeout) for data in frames]
+
+    def read_battery_level(self):
+        try:
+            bs = self.peripheral.getServiceByUUID(XGATT_BATTERYSERVICE_UUID)
+            bc = bs.getCharacteristics(XGATT_BATTERY_CHAR_UUID)[0]
+            return int(self.peripheral.readCharacteristic(bc.getHandle())[0])
+        except self.btle.BTLEException as btlee:
+            raise TransportError("BTLE error while reading the battery level: %s" % btlee) from btlee
+
+
+class _PendingFrame:
+    def __init__(self, frame_id):
+        self.frame_id = frame_id
+        self.event = threading.Event()
+        self.frame_type = None
+        self.payload = None
+
+
+class TcpTransport:
+    def __init__(self):
+        self.sock = None
+        self.address = None
+        self.active = False
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_id = 0
+        self.last_received = 0
+        self.closed_event = None
+
+    def is_connected(self):
+        return self.active and self.sock is not None
+
+    def open(self, address):
+        if self.sock is None or self.address != address:
+            self._connect_socket(address)
+        self._request(Frame.OPEN, b"", RADIO_HOST_OPEN_TIMEOUT)
+        self.active = True
+
+    def close(self, ignore_errors=True):
+        if not self.active:
+            return
+        self.active = False
+        try:
+            self._request(Frame.CLOSE, b"", RADIO_HOST_OPEN_TIMEOUT)
+        except RileyLinkError as rle:
+            if not ignore_errors:
+                raise
+            logging.warning("Ignoring radio host error during disconnect: %s" % rle.error_message)
+
+    def exchange(self, data, timeout):
+        return self.exchange_all([data], timeout)[0]
+
+    def exchange_all(self, frames, timeout):
+        # all commands are sent before waiting, the radio host runs them in order
+        pending = [self._submit(Frame.COMMAND, FRAME_TIMEOUT.pack(int(timeout * 1000)) + data)
+                   for data in frames]
+        return [self._wait(p, timeout + RADIO_HOST_LATENCY_MARGIN) for p in pending]
+
+    def read_battery_level(self):
+        return self._request(Frame.BATTERY, b"", RADIO_HOST_OPEN_TIMEOUT)[0]
+
+    def _request(self, frame_type, payload, timeout):
+        return self._wait(self._submit(frame_type, payload), timeout)
+
+    def _submit(self, frame_type, payload):
+        with self.lock:
+            if self.sock is None:
+                raise TransportError("Not connected to radio host %s" % self.address)
+            self.last_id = (self.last_id + 1) % 0x100000000
+            pending = _PendingFrame(self.last_id)
+            self.pending[pending.frame_id] = pending
+            try:
+                write_frame(self.sock, frame_type, pending.frame_id, payload)
+            except OSError as ose:
+                del self.pending[pending.frame_id]
+                self._drop_socket_locked()
+                raise TransportError("Error sending to radio host %s: %s" % (self.address, ose)) from ose
+        return pending
+
+    def _wait(self, pending, timeout):
+        if not pending.event.wait(timeout):
+            with self.lock:
+                self.pending.pop(pending.frame_id, None)
+            raise TransportError("Timed out while waiting for a response from radio host %s" % self.address)
+        if pending.frame_type == Frame.ERROR:
+            raise RileyLinkError("Radio host %s: %s" % (self.address, pending.payload.decode("utf-8")))
+        if pending.frame_type is None:
+            raise TransportError("Connection to radio host %s was lost" % self.address)
+        return pending.payload
+
+    def _connect_socket(self, address):
+        with self.lock:
+            self._drop_socket_locked()
+        host, port = parse_radio_host(address)
+        try:
+            sock = socket.create_connection((host, port), RADIO_HOST_OPEN_TIMEOUT)
+        except OSError as ose:
+            raise TransportError("Could not connect to radio host %s: %s" % (address, ose)) from ose
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self._authenticate(sock, address)
+            sock.settimeout(None)
+        except OSError as ose:
+            sock.close()
+            raise TransportError("Could not connect to radio host %s: %s" % (address, ose)) from ose
+        except RileyLinkError:
+            sock.close()
+            raise
+        logging.info("Connected to radio host %s" % address)
+        with self.lock:
+            self.sock = sock
+            self.address = address
+            self.last_received = time.time()
+            self.closed_event = threading.Event()
+        threading.Thread(target=self._read, args=(sock,), name="omnipy-radiohost-reader", daemon=True).start()
+        threading.Thread(target=self._keepalive, args=(sock, self.closed_event),
+                         name="omnipy-radiohost-keepalive", daemon=True).start()
+
+    def _authenticate(self, sock, address):
+        # the radio host sends a challenge first and handles nothing else until it is answered
+        frame = read_frame(sock)
+        if frame is None or frame[0] != Frame.CHALLENGE:
+            raise RileyLinkError("Radio host %s did not send an authentication challenge" % address)
+        write_frame(sock, Frame.AUTH, frame[1], get_challenge_response(read_api_key(), frame[2]))
+        frame = read_frame(sock)
+        if frame is None or frame[0] != Frame.RESPONSE:
+            raise RileyLinkError("Radio host %s did not accept the api password" % address)
+
+    def _read(self, sock):
+        try:
+            while True:
+                frame = read_frame(sock)
+                if frame is None:
+                    break
+                frame_type, frame_id, payload = frame
+                self.last_received = time.time()
+                if frame_type == Frame.PONG:
+                    continue
+                with self.lock:
+                    pending = self.pending.pop(frame_id, None)
+                if pending is not None:
+                    pending.frame_type = frame_type
+                    pending.payload = payload
+                    pending.event.set()
+        except (OSError, RileyLinkError) as e:
+            logging.warning("Radio host connection error: %s" % e)
+        with self.lock:
+            if self.sock is sock:
+                self._drop_socket_locked()
+
+    def _keepalive(self, sock, closed_event):
+        while not closed_event.wait(RADIO_HOST_KEEPALIVE_INTERVAL):
+            if time.time() - self.last_received > RADIO_HOST_KEEPALIVE_INTERVAL * RADIO_HOST_KEEPALIVE_MISSES:
+                logging.warning("Radio host %s stopped answering keepalives" % self.address)
+                with self.lock:
+                    if self.sock is sock:
+                        self._drop_socket_locked()
+                return
+            try:
+                with self.lock:
+                    if self.sock is not sock:
+                        return
+                    write_frame(sock, Frame.PING, 0)
+            except OSError:
+                return
+
+    def _drop_socket_locked(self):
+        if self.sock is None:
+            return
+        self.closed_event.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+        self.active = False
+        for pending in self.pending.values():
+            pending.event.set()
+        self.pending = {}
@@ -0,0 +1,82 @@
+from .definitions import *
+from .metrics import STARTUP_READY_SECONDS, STARTUP_FIRST_COMMAND_SECONDS
+from collections import OrderedDict
+import os
+import threading
+import time
+
+_imported = time.time()
+
+
+def process_start_time():
+    # the process is started by systemd, so this is also the time the service was started
+    try:
+        with open("/proc/self/stat", "r") as stream:
+            start_ticks = int(stream.read().rpartition(")")[2].split()[19])
+        with open("/proc/stat", "r") as stream:
+            boot_time = [int(line.split()[1]) for line in stream if line.startswith("btime ")][0]
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return _imported
+
+
+class WarmUp:
+    def __init__(self, started=None):
+        self.logger = getLogger()
+        self.started = process_start_time() if started is None else started
+        self.steps = OrderedDict()
+        self.ready_time = None
+        self.first_command_time = None
+        self.lock = threading.Lock()
+
+    def add(self, name, func):
+        self.steps[name] = {"func": func, "state": "pending", "duration": None, "error": None}
+
+    def run(self):
+        for name, step in self.steps.items():
+            step["state"] = "running"
+            start = time.time()
+            try:
+                step["func"]()
+                step["state"] = "done"
+            except Exception as e:
+                self.logger.exception("Warm-up step %s failed" % name)
+                step["state"] = "failed"
+                step["error"] = getattr(e, "error_message", None) or str(e) or type(e).__name__
+            finally:
+                step["duration"] = time.time() - start
+
+        with self.lock:
+            self.ready_time = time.time()
+        STARTUP_READY_SECONDS.set(self.ready_time - self.started)
+        self.logger.info("Warm-up finished %.1f seconds after process start" % (self.ready_time - self.started))
+
+    def command_succeeded(self):
+        with self.lock:
+            if self.first_command_time is not None:
+                return
+            self.first_command_time = time.time()
+        STARTUP_FIRST_COMMAND_SECONDS.set(self.first_command_time - self.started)
+        self.logger.info("First command succeeded %.1f seconds after process start"
+                         % (self.first_command_time - self.started))
+
+    def is_ready(self):
+        return self.ready_time is not None
+
+    def as_dict(self):
+        failed = [name for name, step in self.steps.items() if step["state"] == "failed"]
+        if not self.is_ready():
+            state = "starting"
+        elif len(failed) > 0:
+            state = "degraded"
+        else:
+            state = "ready"
+        return {"state": state,
+                "ready": self.is_ready(),
+                "uptime": time.time() - self.started,
+                "ready_after": None if self.ready_time is None else self.ready_time - self.started,
+                "first_command_after": None if self.first_command_time is None
+                else self.first_command_time - self.started,
+                "steps": OrderedDict((name, {"state": step["state"], "duration": step["duration"],
+                                             "error": step["error"]})
+                                     for name, step in self.steps.items())}
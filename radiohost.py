@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from podcomm.definitions import *
+from podcomm.exceptions import RileyLinkError, TransportError
+from podcomm.rileylink import RileyLink
+from podcomm.transport import Frame, FRAME_TIMEOUT, read_frame, write_frame, is_radio_host, read_api_key, \
+    get_challenge_response
+import argparse
+import hmac
+import os
+import queue
+import socket
+import threading
+
+
+class RadioHost:
+    def __init__(self, rileylink):
+        self.rileylink = rileylink
+        self.lock = threading.Lock()
+        self.users = set()
+        self.logger = getLogger()
+
+    def open(self, client):
+        with self.lock:
+            self.rileylink.connect()
+            self.users.add(client)
+
+    def close(self, client):
+        with self.lock:
+            self.users.discard(client)
+            if len(self.users) == 0:
+                self.rileylink.disconnect(ignore_errors=True)
+
+    def command(self, client, data, timeout):
+        with self.lock:
+            self.users.add(client)
+            self.rileylink.connect()
+            return self.rileylink.transport.exchange(data, timeout)
+
+    def battery_level(self, client):
+        with self.lock:
+            self.users.add(client)
+            self.rileylink.connect()
+            return bytes([self.rileylink.transport.read_battery_level()])
+
+    def reset(self):
+        with self.lock:
+            self.rileylink.disconnect(ignore_errors=True)
+
+
+class RadioHostHandler(BaseRequestHandler):
+    def setup(self):
+        self.logger = getLogger()
+        self.send_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.request.settimeout(RADIO_HOST_KEEPALIVE_INTERVAL * RADIO_HOST_KEEPALIVE_MISSES)
+
+    def handle(self):
+        host = self.server.radio_host
+        self.logger.info("Client connected from %s:%d" % self.client_address)
+        if not self._authenticate():
+            return
+        worker = threading.Thread(target=self._work, name="omnipy-radiohost-worker", daemon=True)
+        worker.start()
+        try:
+            while True:
+                frame = read_frame(self.request)
+                if frame is None:
+                    break
+                frame_type, frame_id, payload = frame
+                if frame_type == Frame.PING:
+                    self._send(Frame.PONG, frame_id)
+                else:
+                    # pipelined requests are queued and run in order while pings are answered right away
+                    self.requests.put(frame)
+        except (OSError, RileyLinkError) as e:
+            self.logger.warning("Client %s:%d connection error: %s" % (self.client_address + (e,)))
+        finally:
+            self.requests.put(None)
+            worker.join()
+            host.close(self)
+            self.logger.info("Client %s:%d disconnected" % self.client_address)
+
+    def _authenticate(self):
+        challenge = os.urandom(RADIO_HOST_CHALLENGE_SIZE)
+        self._send(Frame.CHALLENGE, 0, challenge)
+        try:
+            frame = read_frame(self.request)
+        except (OSError, RileyLinkError) as e:
+            self.logger.warning("Client %s:%d connection error: %s" % (self.client_address + (e,)))
+            return False
+        if frame is None:
+            return False
+        frame_type, frame_id, payload = frame
+        if frame_type != Frame.AUTH or \
+                not hmac.compare_digest(payload, get_challenge_response(self.server.key, challenge)):
+            self.logger.warning("Client %s:%d failed to authenticate" % self.client_address)
+            self._send(Frame.ERROR, frame_id, b"Authentication failed")
+            return False
+        self._send(Frame.RESPONSE, frame_id)
+        return True
+
+    def _work(self):
+        host = self.server.radio_host
+        while True:
+            frame = self.requests.get()
+            if frame is None:
+                return
+            frame_type, frame_id, payload = frame
+            try:
+                if frame_type == Frame.OPEN:
+                    host.open(self)
+                    response = b""
+                elif frame_type == Frame.CLOSE:
+                    host.close(self)
+                    response = b""
+                elif frame_type == Frame.COMMAND:
+                    timeout = FRAME_TIMEOUT.unpack(payload[:FRAME_TIMEOUT.size])[0] / 1000.0
+                    response = host.command(self, payload[FRAME_TIMEOUT.size:], timeout)
+                elif frame_type == Frame.BATTERY:
+                    response = host.battery_level(self)
+                else:
+                    raise RileyLinkError("Unknown frame type 0x%02x" % frame_type)
+                self._send(Frame.RESPONSE, frame_id, response)
+            except TransportError as te:
+                self.logger.warning("Transport error while serving client: %s" % te.error_message)
+                host.reset()
+                self._send(Frame.ERROR, frame_id, te.error_message.encode("utf-8"))
+            except RileyLinkError as rle:
+                self.logger.warning("RileyLink error while serving client: %s" % rle.error_message)
+                self._send(Frame.ERROR, frame_id, rle.error_message.encode("utf-8"))
+
+    def _send(self, frame_type, frame_id, payload=b""):
+        try:
+            with self.send_lock:
+                write_frame(self.request, frame_type, frame_id, payload)
+        except OSError as ose:
+            self.logger.warning("Error while sending to client: %s" % ose)
+
+
+class RadioHostServer(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, radio_host, key):
+        self.radio_host = radio_host
+        self.key = key
+        ThreadingTCPServer.__init__(self, address, RadioHostHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expose a local RileyLink to omnipy over the network")
+    parser.add_argument("-a", "--address", type=str, default=None,
+                        help="Bluetooth address of the RileyLink, default is the best known one")
+    parser.add_argument("-p", "--port", type=int, default=RADIO_HOST_PORT, help="TCP port to listen on")
+    parser.add_argument("-b", "--bind", type=str, default="127.0.0.1",
+                        help="Address to listen on, use 0.0.0.0 to accept clients from other hosts")
+    parser.add_argument("-k", "--key-file", type=str, default=KEY_FILE,
+                        help="Key file written by set_api_password.py, clients must use the same password")
+    args = parser.parse_args()
+
+    if is_radio_host(args.address):
+        parser.error("The radio host needs a local RileyLink")
+    try:
+        key = read_api_key(args.key_file)
+    except OSError:
+        parser.error("Key file %s not found, set the api password with set_api_password.py" % args.key_file)
+
+    configureLogging()
+    logger = getLogger()
+    try:
+        server = RadioHostServer((args.bind, args.port), RadioHost(RileyLink(args.address)), key)
+        logger.info("Radio host listening on %s:%d" % (args.bind, args.port))
+        server.serve_forever()
+    except Exception:
+        logger.exception("Error while running radio host")
+        raise
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,54 @@
 #!/usr/bin/python3
+from podcomm import memory
+# started before the other imports, so that their allocations show up in the memory report
+memory.start_tracing_from_environment()
+
 import base64
 import os
+import threading
+import time
 from decimal import *
 
-from Crypto.Cipher import AES
 import simplejson as json
-from flask import Flask, request, send_from_directory
-from datetime import datetime
+from flask import Flask, request, send_from_directory, make_response, g
 from podcomm.crc import crc8
+from podcomm.jobs import JobManager, JobState
+from podcomm.exceptions import OmnipyError
 from podcomm.packet import Packet
 from podcomm.pdm import Pdm
 from podcomm.pod import Pod
-from podcomm.rileylink import RileyLink
+from podcomm.podstore import get_pod_id, normalize_pod_id, pod_exists, load_pod, save_new_pod, archive_pod, \
+    list_pod_ids, remove_radio_state
+from podcomm.resultcache import ResultCache
+from podcomm.statetracker import StateTracker
+from podcomm import metrics, trace
+from podcomm.rileylink import RileyLink, get_registry
+from podcomm.scheduler import RadioScheduler
+from podcomm.warmup import WarmUp
+from podcomm.transport import RADIO_HOST_SCHEME
 from podcomm.definitions import *
 
 
+def get_radio_hosts():
+    radio_hosts = os.environ.get("OMNIPY_RADIO_HOSTS")
+    if radio_hosts is None:
+        return None
+    rileylinks = []
+    for radio_host in radio_hosts.split(","):
+        address = RADIO_HOST_SCHEME + radio_host.strip()
+        get_registry().add(address)
+        rileylinks.append(RileyLink(address))
+    return rileylinks
+
+
 app = Flask(__name__, static_url_path="/")
 configureLogging()
 logger = getLogger()
+warmup = WarmUp()
+jobs = JobManager(cache=ResultCache())
+scheduler = RadioScheduler(get_radio_hosts())
+pod_states = {}
+pod_states_lock = threading.Lock()
 
 
 class RestApiException(Exception):
@@ -28,30 +59,240 @@ class RestApiException(Exception):
         return self.error_message
 
 
-def get_pod():
-    return Pod.Load(POD_FILE + POD_FILE_SUFFIX, POD_FILE + POD_LOG_SUFFIX)
+def get_valid_pod_id(pod_id):
+    try:
+        return normalize_pod_id(pod_id)
+    except ValueError as ve:
+        raise RestApiException(str(ve))
 
 
-def get_pdm():
-    return Pdm(get_pod())
+def get_pod(pod_id=None):
+    pod_id = get_valid_pod_id(pod_id)
+    if pod_id is not None and not pod_exists(pod_id):
+        raise RestApiException("Unknown pod: %s" % pod_id)
+    with trace.span("pod.load"):
+        return load_pod(pod_id)
 
 
-def archive_pod():
-    archive_suffix = datetime.utcnow().strftime("_%Y%m%d_%H%M%S")
-    if os.path.isfile(POD_FILE + POD_FILE_SUFFIX):
-        os.rename(POD_FILE + POD_FILE_SUFFIX, POD_FILE + archive_suffix + POD_FILE_SUFFIX)
-    if os.path.isfile(POD_FILE + POD_LOG_SUFFIX):
-        os.rename(POD_FILE + POD_LOG_SUFFIX, POD_FILE + archive_suffix + POD_LOG_SUFFIX)
+def get_pdm(pod_id=None):
+    pod_id = get_valid_pod_id(pod_id)
+    return Pdm(get_pod(pod_id), scheduler.get(pod_id), scheduler.listener)
 
 
-def respond_ok(result):
-    return json.dumps({"success": True, "result": result}, indent=4, sort_keys=True)
+def is_busy(pod_id=None):
+    # answered without a pdm session, which would race a queued command for the radio
+    return jobs.pending_count() > 0 or get_pod(pod_id).is_bolus_running()
 
 
-def respond_error(msg):
-    return json.dumps({"success": False, "result": {"error": msg}}, indent=4, sort_keys=True)
+def get_pod_ids():
+    return [pod_id for pod_id in [None] + list_pod_ids() if pod_exists(pod_id)]
+
+
+def get_state_tracker(pod_id):
+    # requests are served on several threads, all of them have to share one tracker per pod
+    with pod_states_lock:
+        tracker = pod_states.get(pod_id)
+        if tracker is None:
+            tracker = StateTracker()
+            pod_states[pod_id] = tracker
+        return tracker
+
+
+def get_request_pod_id():
+    if request.view_args is None:
+        return None
+    return get_valid_pod_id(request.view_args.get("pod_id"))
+
 
+def recover_pods():
+    for pod_id in get_pod_ids():
+        start = time.time()
+        try:
+            result = get_pdm(pod_id).recover()
+            if result is not None:
+                logger.info("Pod %s state recovered in %.1f seconds, last command %s enacted: %s"
+                            % (pod_id, time.time() - start, result["request"], result["enacted"]))
+        except Exception:
+            logger.exception("Error while recovering state of pod %s from the command journal" % pod_id)
 
+
+def start_warm_up():
+    # commands run on the same job queue, so they wait for the warm-up instead of racing it
+    warmup.add("recover", recover_pods)
+    warmup.add("rileylink", scheduler.connect_all)
+    jobs.submit("warmup", warmup.run, asynchronous=True)
+
+
+def encode_response(response):
+    if is_flag_set(request, "pretty"):
+        return json.dumps(response, indent=4, sort_keys=True)
+    return json.dumps(response, sort_keys=True, separators=(",", ":"))
+
+
+def respond_ok(result):
+    return encode_response({"success": True, "result": result})
+
+
+def respond_error(msg):
+    return encode_response({"success": False, "result": {"error": msg}})
+
+
+def respond_pod(state, conditional=False):
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return respond_error("invalid since")
+
+    tracker = get_state_tracker(get_request_pod_id())
+    if g.get("cached_result", False):
+        # a replayed result is older than the current state, it keeps the version it had
+        version, encoded = tracker.find(state)
+    else:
+        version, encoded = tracker.update(state)
+    etag = None if version is None else tracker.etag(version)
+    if conditional and etag is not None and request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+
+    fields = request.args.get("fields")
+    if fields is None and since is None and not is_flag_set(request, "pretty"):
+        body = '{"result":%s,"success":true}' % encoded
+    else:
+        keys = None
+        if fields is not None:
+            keys = fields.split(",")
+            state = {k: state[k] for k in keys if k in state}
+        if since is not None:
+            # changes holds added and changed fields, removed lists the fields gone since the version.
+            # since is null when the version is no longer known, changes then holds the whole state
+            delta = tracker.delta(since, state, keys)
+            if delta is None:
+                result = {"version": version, "since": None, "changes": state, "removed": []}
+            else:
+                changes, removed = delta
+                result = {"version": version, "since": since, "changes": changes, "removed": removed}
+        else:
+            result = state
+        body = respond_ok(result)
+
+    response = make_response(body)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def is_flag_set(request_obj, name):
+    value = request_obj.args.get(name)
+    return value is not None and value.lower() not in ("", "0", "false", "no")
+
+
+def respond_batch(result):
+    success = len(result["steps"]) > 0 and all(step["success"] for step in result["steps"])
+    return encode_response({"success": success, "result": result})
+
+
+def parse_batch_step(step):
+    op = step.get("op")
+    if op == "status":
+        req_type = int(step.get("type", 0))
+        return lambda pdm: pdm.updatePodStatus(req_type)
+    elif op == "ack":
+        mask = int(step["alertmask"])
+        return lambda pdm: pdm.acknowledge_alerts(mask)
+    elif op == "bolus":
+        amount = Decimal(step["amount"])
+        return lambda pdm: pdm.bolus(amount, False)
+    elif op == "cancelbolus":
+        return lambda pdm: pdm.cancelBolus()
+    elif op == "settempbasal":
+        amount = Decimal(step["amount"])
+        hours = Decimal(step["hours"])
+        return lambda pdm: pdm.setTempBasal(amount, hours, False)
+    elif op == "canceltempbasal":
+        return lambda pdm: pdm.cancelTempBasal()
+    else:
+        raise RestApiException("Unknown batch operation: %s" % op)
+
+
+def parse_batch(request_obj):
+    if request_obj.method == "POST":
+        steps = request_obj.get_json(force=True)
+    else:
+        ops = request_obj.args.get("ops")
+        if ops is None:
+            raise RestApiException("No operations specified")
+        steps = json.loads(ops)
+
+    if not isinstance(steps, list) or len(steps) == 0:
+        raise RestApiException("Operations must be a non-empty list")
+    if len(steps) > BATCH_MAX_STEPS:
+        raise RestApiException("A batch cannot have more than %d operations" % BATCH_MAX_STEPS)
+
+    actions = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict):
+            raise RestApiException("Invalid operation at step %d" % index)
+        try:
+            actions.append((step.get("op"), parse_batch_step(step)))
+        except RestApiException:
+            raise
+        except Exception as e:
+            raise RestApiException("Invalid parameters at step %d (%s)" % (index, step.get("op"))) from e
+    return actions
+
+
+def get_idempotency_key(request_obj):
+    key = request_obj.args.get("idempotency_key")
+    if key is None:
+        key = request_obj.headers.get("Idempotency-Key")
+    return key
+
+
+def respond_pod_status(state):
+    return respond_pod(state, conditional=True)
+
+
+def run_command(name, func, respond=respond_ok, radio=True):
+    pod_id = get_request_pod_id()
+    if radio:
+        scheduler.preconnect([pod_id])
+    if pod_id is not None:
+        name = "%s:%s" % (name, pod_id)
+    asynchronous = is_flag_set(request, "async")
+    timing = is_flag_set(request, "timing")
+    job = jobs.submit(name, func, asynchronous, get_idempotency_key(request), timing)
+    if job.name != name:
+        raise RestApiException("Idempotency key was already used for a different command")
+    if asynchronous:
+        return respond_ok({"job": job.as_dict(with_result=False)})
+
+    with trace.span("job.wait"):
+        job.wait()
+        trace.attach(job.collector)
+    if job.state == JobState.Failed:
+        if job.exception is not None:
+            raise job.exception
+        raise RestApiException(job.error)
+    g.cached_result = job.cached
+    if not job.cached:
+        warmup.command_succeeded()
+    return respond(job.result)
+
+
+def get_job(request_obj):
+    job_id = request_obj.args.get("id")
+    if job_id is None:
+        raise RestApiException("Job id not specified")
+    job = jobs.get(job_id)
+    if job is None:
+        raise RestApiException("Job not found")
+    return job
+
+
+@trace.traced("auth")
 def verify_auth(request_obj):
     try:
         i = request_obj.args.get("i")
@@ -59,6 +300,8 @@ def verify_auth(request_obj):
         if i is None or a is None:
             raise RestApiException("Authentication failed")
 
+        from Crypto.Cipher import AES
+
         iv = base64.b64decode(i)
         auth = base64.b64decode(a)
 
@@ -100,6 +343,21 @@ def verify_auth(request_obj):
         raise
 
 
+@app.before_request
+def begin_request_trace():
+    g.trace = trace.begin(request.path, force=is_flag_set(request, "timing"))
+
+
+@app.after_request
+def end_request_trace(response):
+    collector = g.get("trace")
+    if collector is not None:
+        trace.end(collector)
+        if is_flag_set(request, "timing"):
+            response.headers["Server-Timing"] = collector.server_timing()
+    return response
+
+
 @app.route("/")
 def main_page():
     return app.send_static_file("omnipy.html")
@@ -121,12 +379,51 @@ def get_api_version():
         return respond_error("Other error. Please check log files.")
 
 
+@app.route(REST_URL_METRICS)
+def get_metrics():
+    try:
+        metrics.PROCESS_RSS_BYTES.set(memory.get_rss())
+        return make_response(metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"})
+    except Exception:
+        logger.exception("Error during metrics request")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_HEALTH)
+def get_health():
+    try:
+        health = warmup.as_dict()
+        health["pending_jobs"] = jobs.pending_count()
+        return respond_ok(health)
+    except Exception:
+        logger.exception("Error during health request")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_MEMORY)
+def get_memory():
+    try:
+        verify_auth(request)
+        limit = int(request.args.get("limit", MEMORY_REPORT_LIMIT))
+        group_by = request.args.get("group", "lineno")
+        if group_by not in ("lineno", "filename"):
+            raise RestApiException("Unknown grouping: %s" % group_by)
+        return respond_ok(memory.report(limit, group_by))
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error during memory report")
+        return respond_error("Other error. Please check log files.")
+
+
 @app.route(REST_URL_TOKEN)
 def create_token():
     try:
         with open(TOKENS_FILE, "a+b") as tokens:
             token = bytes(os.urandom(16))
             tokens.write(token)
+        # a command follows the token right away, the request is not authenticated so it is rate limited
+        scheduler.preconnect(interval=RILEYLINK_PRECONNECT_INTERVAL)
         return respond_ok({"token": base64.b64encode(token)})
     except RestApiException as rae:
         return respond_error(str(rae))
@@ -148,8 +445,58 @@ def check_password():
         return respond_error("Other error. Please check log files.")
 
 
+@app.route(REST_URL_JOB_STATUS)
+def get_job_status():
+    try:
+        verify_auth(request)
+
+        job = get_job(request)
+        return respond_ok(job.as_dict())
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error during get job status")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_JOB_WAIT)
+def wait_job():
+    try:
+        verify_auth(request)
+
+        job = get_job(request)
+        timeout = JOB_WAIT_TIMEOUT_MAX
+        if request.args.get('timeout') is not None:
+            timeout = int(request.args.get('timeout'))
+            if timeout > JOB_WAIT_TIMEOUT_MAX:
+                raise RestApiException("Timeout cannot be more than %d seconds" % JOB_WAIT_TIMEOUT_MAX)
+
+        job.wait(timeout)
+        return respond_ok(job.as_dict())
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error while waiting for job")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_JOB_LIST)
+def list_jobs():
+    try:
+        verify_auth(request)
+
+        return respond_ok({"jobs": [job.as_dict(with_result=False) for job in jobs.list()]})
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error during list jobs")
+        return respond_error("Other error. Please check log files.")
+
+
 @app.route(REST_URL_GET_PDM_ADDRESS)
 def get_pdm_address():
+    if scheduler.capture is not None:
+        return get_pdm_address_from_capture()
     r = RileyLink()
     try:
         verify_auth(request)
@@ -183,8 +530,64 @@ def get_pdm_address():
         r.disconnect(ignore_errors=True)
 
 
+def get_pdm_address_from_capture():
+    try:
+        verify_auth(request)
+        timeout = 30
+        if request.args.get('timeout') is not None:
+            timeout = int(request.args.get('timeout'))
+            if timeout > 30:
+                raise RestApiException("Timeout cannot be more than 30 seconds")
+
+        # a pdm packet heard before the request counts, so the pdm can be triggered first
+        since_time = time.time() - CAPTURE_LOOKBACK
+        deadline = time.time() + timeout
+        since = 0
+        while True:
+            records = scheduler.capture.read(since)
+            for record in reversed(records):
+                if record["type"] == "PDM" and not record["transmitted"] and record["time"] >= since_time:
+                    return respond_ok({"address": record["address"], "rssi": record["rssi"],
+                                       "time": record["time"]})
+            if len(records) > 0:
+                since = records[-1]["sequence"] + 1
+            if time.time() >= deadline:
+                return respond_error("No pdm packet detected")
+            time.sleep(CAPTURE_LISTEN_WINDOW)
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error while trying to read address")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_CAPTURE)
+def get_capture():
+    try:
+        verify_auth(request)
+        if scheduler.capture is None:
+            raise RestApiException("Passive capture is not enabled")
+
+        limit = int(request.args.get("limit", 256))
+        if request.args.get("since") is not None:
+            since = int(request.args.get("since"))
+        else:
+            since = max(0, scheduler.capture.next_sequence() - limit)
+        records = scheduler.capture.read(since, limit)
+        if request.args.get("address") is not None:
+            address = int(request.args.get("address"), 16)
+            records = [record for record in records if record["address"] == address]
+        return respond_ok({"next": scheduler.capture.next_sequence(), "packets": records})
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error while reading the capture buffer")
+        return respond_error("Other error. Please check log files.")
+
+
 @app.route(REST_URL_NEW_POD)
-def new_pod():
+@app.route(REST_URL_POD_SCOPE + REST_URL_NEW_POD)
+def new_pod(pod_id=None):
     try:
         verify_auth(request)
 
@@ -197,9 +600,18 @@ def new_pod():
         if request.args.get('address') is not None:
             pod.address = int(request.args.get('address'))
 
-        archive_pod()
-        pod.Save(POD_FILE + POD_FILE_SUFFIX)
-        return respond_ok({})
+        if pod_id is not None:
+            pod_id = get_valid_pod_id(pod_id)
+            if request.args.get('address') is None:
+                pod.address = int(pod_id, 16)
+            elif get_pod_id(pod.address) != pod_id:
+                raise RestApiException("Pod address does not match the pod id")
+
+        def execute():
+            save_new_pod(pod, pod_id)
+            return {}
+
+        return run_command("newpod", execute, radio=False)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -208,24 +620,33 @@ def new_pod():
 
 
 @app.route(REST_URL_SET_POD_PARAMETERS)
-def set_pod_parameters():
+@app.route(REST_URL_POD_SCOPE + REST_URL_SET_POD_PARAMETERS)
+def set_pod_parameters(pod_id=None):
     try:
         verify_auth(request)
 
-        pod = get_pod()
-        if request.args.get('lot') is not None:
-            pod.lot = int(request.args.get('lot'))
-        if request.args.get('tid') is not None:
-            pod.tid = int(request.args.get('tid'))
-        if request.args.get('address') is not None:
-            pod.address = int(request.args.get('address'))
-
-        pod.nonceSeed = 0
-        pod.lastNonce = None
-        pod.packetSequence = 0
-        pod.msgSequence = 0
-        pod.Save()
-        return respond_ok({})
+        lot = request.args.get('lot')
+        tid = request.args.get('tid')
+        address = request.args.get('address')
+
+        def execute():
+            pod = get_pod(pod_id)
+            if lot is not None:
+                pod.lot = int(lot)
+            if tid is not None:
+                pod.tid = int(tid)
+            if address is not None:
+                pod.address = int(address)
+
+            pod.nonceSeed = 0
+            pod.lastNonce = None
+            pod.packetSequence = 0
+            pod.msgSequence = 0
+            pod.Save()
+            remove_radio_state(pod_id)
+            return {}
+
+        return run_command("parameters", execute, radio=False)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -234,15 +655,22 @@ def set_pod_parameters():
 
 
 @app.route(REST_URL_SET_LIMITS)
-def set_limits():
+@app.route(REST_URL_POD_SCOPE + REST_URL_SET_LIMITS)
+def set_limits(pod_id=None):
     try:
         verify_auth(request)
 
-        pod = get_pod()
-        pod.maximumBolus = Decimal(request.args.get('maxbolus'))
-        pod.maximumTempBasal = Decimal(request.args.get('maxbasal'))
-        pod.Save()
-        return respond_ok({})
+        max_bolus = Decimal(request.args.get('maxbolus'))
+        max_basal = Decimal(request.args.get('maxbasal'))
+
+        def execute():
+            pod = get_pod(pod_id)
+            pod.maximumBolus = max_bolus
+            pod.maximumTempBasal = max_basal
+            pod.Save()
+            return {}
+
+        return run_command("limits", execute, radio=False)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -265,8 +693,28 @@ def get_rl_info():
         return respond_error("Other error. Please check log files.")
 
 
+@app.route(REST_URL_RL_DEVICES)
+def get_rl_devices():
+    try:
+        verify_auth(request)
+
+        registry = get_registry()
+        if is_flag_set(request, "scan"):
+            def execute():
+                registry.scan()
+                return {"devices": registry.as_dict(), "ranked": registry.ranked()}
+            return run_command("rlscan", execute, radio=False)
+        return respond_ok({"devices": registry.as_dict(), "ranked": registry.ranked()})
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error during get RL devices")
+        return respond_error("Other error. Please check log files.")
+
+
 @app.route(REST_URL_STATUS)
-def get_status():
+@app.route(REST_URL_POD_SCOPE + REST_URL_STATUS)
+def get_status(pod_id=None):
     try:
         verify_auth(request)
 
@@ -276,9 +724,12 @@ def get_status():
         else:
             req_type = 0
 
-        pdm = get_pdm()
-        pdm.updatePodStatus(req_type)
-        return respond_ok(pdm.pod.__dict__)
+        def execute():
+            pdm = get_pdm(pod_id)
+            pdm.updatePodStatus(req_type)
+            return pdm.pod.__dict__
+
+        return run_command("status", execute, respond_pod_status)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -287,13 +738,18 @@ def get_status():
 
 
 @app.route(REST_URL_ACK_ALERTS)
-def acknowledge_alerts():
+@app.route(REST_URL_POD_SCOPE + REST_URL_ACK_ALERTS)
+def acknowledge_alerts(pod_id=None):
     try:
         verify_auth(request)
         mask = Decimal(request.args.get('alertmask'))
-        pdm = get_pdm()
-        pdm.acknowledge_alerts(mask)
-        return respond_ok(pdm.pod.__dict__)
+
+        def execute():
+            pdm = get_pdm(pod_id)
+            pdm.acknowledge_alerts(mask)
+            return pdm.pod.__dict__
+
+        return run_command("ack", execute, respond_pod)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -302,13 +758,18 @@ def acknowledge_alerts():
 
 
 @app.route(REST_URL_DEACTIVATE_POD)
-def deactivate_pod():
+@app.route(REST_URL_POD_SCOPE + REST_URL_DEACTIVATE_POD)
+def deactivate_pod(pod_id=None):
     try:
         verify_auth(request)
-        pdm = get_pdm()
-        pdm.deactivate_pod()
-        archive_pod()
-        return respond_ok(pdm.pod.__dict__)
+
+        def execute():
+            pdm = get_pdm(pod_id)
+            pdm.deactivate_pod()
+            archive_pod(pod_id)
+            return pdm.pod.__dict__
+
+        return run_command("deactivate", execute, respond_pod)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -317,14 +778,19 @@ def deactivate_pod():
 
 
 @app.route(REST_URL_BOLUS)
-def bolus():
+@app.route(REST_URL_POD_SCOPE + REST_URL_BOLUS)
+def bolus(pod_id=None):
     try:
         verify_auth(request)
 
-        pdm = get_pdm()
         amount = Decimal(request.args.get('amount'))
-        pdm.bolus(amount, False)
-        return respond_ok(pdm.pod.__dict__)
+
+        def execute():
+            pdm = get_pdm(pod_id)
+            pdm.bolus(amount, False)
+            return pdm.pod.__dict__
+
+        return run_command("bolus", execute, respond_pod)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -333,13 +799,17 @@ def bolus():
 
 
 @app.route(REST_URL_CANCEL_BOLUS)
-def cancel_bolus():
+@app.route(REST_URL_POD_SCOPE + REST_URL_CANCEL_BOLUS)
+def cancel_bolus(pod_id=None):
     try:
         verify_auth(request)
 
-        pdm = get_pdm()
-        pdm.cancelBolus()
-        return respond_ok(pdm.pod.__dict__)
+        def execute():
+            pdm = get_pdm(pod_id)
+            pdm.cancelBolus()
+            return pdm.pod.__dict__
+
+        return run_command("cancelbolus", execute, respond_pod)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -348,15 +818,20 @@ def cancel_bolus():
 
 
 @app.route(REST_URL_SET_TEMP_BASAL)
-def set_temp_basal():
+@app.route(REST_URL_POD_SCOPE + REST_URL_SET_TEMP_BASAL)
+def set_temp_basal(pod_id=None):
     try:
         verify_auth(request)
 
-        pdm = get_pdm()
         amount = Decimal(request.args.get('amount'))
         hours = Decimal(request.args.get('hours'))
-        pdm.setTempBasal(amount, hours, False)
-        return respond_ok(pdm.pod.__dict__)
+
+        def execute():
+            pdm = get_pdm(pod_id)
+            pdm.setTempBasal(amount, hours, False)
+            return pdm.pod.__dict__
+
+        return run_command("settempbasal", execute, respond_pod)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -365,13 +840,17 @@ def set_temp_basal():
 
 
 @app.route(REST_URL_CANCEL_TEMP_BASAL)
-def cancel_temp_basal():
+@app.route(REST_URL_POD_SCOPE + REST_URL_CANCEL_TEMP_BASAL)
+def cancel_temp_basal(pod_id=None):
     try:
         verify_auth(request)
 
-        pdm = get_pdm()
-        pdm.cancelTempBasal()
-        return respond_ok(pdm.pod.__dict__)
+        def execute():
+            pdm = get_pdm(pod_id)
+            pdm.cancelTempBasal()
+            return pdm.pod.__dict__
+
+        return run_command("canceltempbasal", execute, respond_pod)
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -379,12 +858,116 @@ def cancel_temp_basal():
         return respond_error("Other error. Please check log files.")
 
 
+@app.route(REST_URL_PULSE_LOG)
+@app.route(REST_URL_POD_SCOPE + REST_URL_PULSE_LOG)
+def read_pulse_log(pod_id=None):
+    try:
+        verify_auth(request)
+
+        recent_only = is_flag_set(request, "recent")
+        with_entries = is_flag_set(request, "entries")
+
+        def execute():
+            pdm = get_pdm(pod_id)
+            log = pdm.read_pulse_log(previous=not recent_only)
+            return {"pulse_log": log.as_dict(with_entries), "pod": pdm.pod.__dict__}
+
+        return run_command("pulselog", execute)
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error during pulse log read")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_BATCH, methods=["GET", "POST"])
+@app.route(REST_URL_POD_SCOPE + REST_URL_BATCH, methods=["GET", "POST"])
+def batch(pod_id=None):
+    try:
+        verify_auth(request)
+        actions = parse_batch(request)
+
+        def execute():
+            pdm = get_pdm(pod_id)
+            steps = []
+            with pdm.session():
+                for op, action in actions:
+                    try:
+                        action(pdm)
+                        steps.append({"op": op, "success": True})
+                    except OmnipyError as oe:
+                        logger.warning("Batch stopped at %s: %s" % (op, oe.error_message))
+                        steps.append({"op": op, "success": False, "error": oe.error_message})
+                        break
+            for op, action in actions[len(steps):]:
+                steps.append({"op": op, "success": False, "error": "Not executed"})
+            return {"steps": steps, "pod": pdm.pod.__dict__}
+
+        return run_command("batch", execute, respond_batch)
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error during batch")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_POD_LIST)
+def list_pods():
+    try:
+        verify_auth(request)
+
+        pods = {}
+        for pod_id in get_pod_ids():
+            pod = get_pod(pod_id)
+            pods[pod_id or "default"] = {"address": pod.address, "lot": pod.lot, "tid": pod.tid,
+                                         "progress": pod.progress, "lastUpdated": pod.lastUpdated}
+        return respond_ok(pods)
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error while listing pods")
+        return respond_error("Other error. Please check log files.")
+
+
+@app.route(REST_URL_STATUS_ALL)
+def get_status_all():
+    try:
+        verify_auth(request)
+
+        t = request.args.get('type')
+        if t is not None:
+            req_type = int(t)
+        else:
+            req_type = 0
+
+        pod_ids = get_pod_ids()
+
+        def execute():
+            result = {}
+            with scheduler.hold(pod_ids):
+                for pod_id in pod_ids:
+                    try:
+                        pdm = get_pdm(pod_id)
+                        pdm.updatePodStatus(req_type)
+                        result[pod_id or "default"] = {"success": True, "pod": pdm.pod.__dict__}
+                    except (OmnipyError, RestApiException) as e:
+                        logger.warning("Status sweep failed for pod %s: %s" % (pod_id, e.error_message))
+                        result[pod_id or "default"] = {"success": False, "error": e.error_message}
+            return result
+
+        return run_command("statusall", execute)
+    except RestApiException as rae:
+        return respond_error(str(rae))
+    except Exception:
+        logger.exception("Error during status sweep")
+        return respond_error("Other error. Please check log files.")
+
+
 @app.route(REST_URL_PDM_BUSY)
-def is_pdm_busy():
+@app.route(REST_URL_POD_SCOPE + REST_URL_PDM_BUSY)
+def is_pdm_busy(pod_id=None):
     try:
-        pdm = get_pdm()
-        result = pdm.is_busy();
-        return respond_ok({"busy": result})
+        return respond_ok({"busy": is_busy(pod_id)})
     except RestApiException as rae:
         return respond_error(str(rae))
     except Exception:
@@ -395,8 +978,9 @@ def is_pdm_busy():
 @app.route(REST_URL_OMNIPY_SHUTDOWN)
 def shutdown():
     try:
-        pdm = get_pdm()
-        if pdm.is_busy():
+        if jobs.pending_count() > 0:
+            return respond_error("cannot shutdown while commands are pending")
+        if is_busy():
             return respond_error("cannot shutdown while pdm is busy")
     except RestApiException as rae:
         return respond_error(str(rae))
@@ -408,8 +992,9 @@ def shutdown():
 @app.route(REST_URL_OMNIPY_RESTART)
 def restart():
     try:
-        pdm = get_pdm()
-        if pdm.is_busy():
+        if jobs.pending_count() > 0:
+            return respond_error("cannot restart while commands are pending")
+        if is_busy():
             return respond_error("cannot restart while pdm is busy")
     except RestApiException as rae:
         return respond_error(str(rae))
@@ -421,6 +1006,9 @@ def restart():
 if __name__ == '__main__':
     try:
         logger.info("Rest api is starting")
+        if os.environ.get("OMNIPY_TRACE") is not None:
+            logger.info("Tracing enabled, writing spans to %s" % TRACE_FILE)
+            trace.enable()
         if os.path.isfile(TOKENS_FILE):
             logger.debug("removing tokens from previous session")
             os.remove(TOKENS_FILE)
@@ -430,8 +1018,23 @@ if __name__ == '__main__':
     except IOError as ioe:
         logger.warning("Error while removing stale files: %s", exc_info=ioe)
 
+    if os.environ.get("OMNIPY_DIVERSITY") is not None:
+        try:
+            scheduler.enable_diversity(os.environ.get("OMNIPY_DIVERSITY") or None)
+        except OmnipyError as oe:
+            logger.warning("Diversity receive is not enabled: %s" % oe.error_message)
+
+    if os.environ.get("OMNIPY_CAPTURE") is not None:
+        try:
+            from podcomm.capture import CaptureBuffer
+            scheduler.enable_capture(CaptureBuffer(os.environ.get("OMNIPY_CAPTURE") or CAPTURE_FILE))
+        except OSError as ose:
+            logger.warning("Passive capture is not enabled: %s" % ose)
+
+    start_warm_up()
+
     try:
-        app.run(host='0.0.0.0', port=4444)
+        app.run(host='0.0.0.0', port=4444, threaded=True)
     except Exception:
         logger.exception("Error while running rest api, exiting")
         raise
@@ -9,6 +9,8 @@ logging.basicConfig(level=logging.WARNING)
 
 if os.path.exists(RILEYLINK_MAC_FILE):
     os.remove(RILEYLINK_MAC_FILE)
+if os.path.exists(RILEYLINK_REGISTRY_FILE):
+    os.remove(RILEYLINK_REGISTRY_FILE)
 
 print("connecting to RL..")
 r = RileyLink()